@@ -7,13 +7,20 @@ from collections import namedtuple
 from itertools import groupby, izip
 import abc
 import csv
+import os
+import tempfile
+import threading
+import time
 
 import numpy as np
+import scipy.sparse as sp
 import pandas
 from patsy import DesignInfo, EvalEnvironment
 
 import rerpy.events
-from rerpy.rerp import rERPRequest, multi_rerp_impl
+from rerpy.util import process_time
+from rerpy.rerp import (rERPRequest, rERPSolver, rERPUpdater,
+                        multi_rerp_impl)
 
 # TODO: add sensor metadata, esp. locations, referencing. make units be
 # by-sensor. (There's some code for locations that may be resurrectable from
@@ -30,7 +37,11 @@ from rerpy.rerp import rERPRequest, multi_rerp_impl
 # that one has no sensor location information in it, then we can totally
 # combine that data (and should be able to union the sensor metadata).
 class DataFormat(object):
-    def __init__(self, exact_sample_rate_hz, units, channel_names):
+    # dtype is the floating point type used to store and load data. Sums in
+    # the rERP fitting code are always accumulated in float64, so float32 is
+    # a reasonable choice for large datasets where memory is tight.
+    def __init__(self, exact_sample_rate_hz, units, channel_names,
+                 dtype=np.float64):
         self.exact_sample_rate_hz = exact_sample_rate_hz
         sample_period_ms = 1. / exact_sample_rate_hz * 1000
         # If sample period is exactly an integer, use an integer type to store
@@ -45,7 +56,13 @@ class DataFormat(object):
         self.num_channels = self.channel_names.shape[0]
         if not len(self.channel_names) == len(set(self.channel_names)):
             raise ValueError("sensor names must be distinct")
+        self.dtype = np.dtype(dtype)
+        if not np.issubdtype(self.dtype, np.floating):
+            raise ValueError("dtype must be a floating point type")
 
+    # dtype is just a storage detail, so it doesn't count for equality; data
+    # from two datasets with the same format but different dtypes can be
+    # combined (it's converted on the way out, see Dataset.raw_slice).
     def __eq__(self, other):
         return (self.exact_sample_rate_hz == other.exact_sample_rate_hz
                 and self.units == other.units
@@ -113,6 +130,11 @@ def test_DataFormat():
     assert df.num_channels == 3
     # no duplicate channel names
     assert_raises(ValueError, DataFormat, 1024, "uV", ["MiCe", "MiCe"])
+    assert df.dtype == np.float64
+    df32 = DataFormat(1024, "uV", ["MiCe", "A2", "rle"], dtype=np.float32)
+    assert df32.dtype == np.float32
+    assert df32 == df
+    assert_raises(ValueError, DataFormat, 1024, "uV", [], dtype=int)
 
     assert df.ms_to_ticks(1000) == 1024
     assert df.ticks_to_ms(1024) == 1000
@@ -160,14 +182,197 @@ def test_DataFormat():
     assert_raises(ValueError, df.compute_symbolic_transform, "A2/2, A2/3")
     assert_raises(ValueError, df.compute_symbolic_transform, "A2/2 + 1")
 
+class _ReadCounts(object):
+    # Running totals for Dataset.raw_slice: how many calls, how many bytes
+    # they returned, how many were served from recspans held in memory
+    # (rather than by a lazy loader), and the wall-clock and CPU time spent
+    # in them. rERP.timings reports the difference over a fit. by-epoch
+    # fits may read from several threads at once, hence the lock.
+    FIELDS = ("calls", "bytes", "in_memory", "wall", "cpu")
+
+    def __init__(self):
+        self._totals = dict.fromkeys(self.FIELDS, 0)
+        self._lock = threading.Lock()
+
+    def add(self, deltas):
+        with self._lock:
+            for field, delta in deltas.items():
+                self._totals[field] += delta
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._totals)
+
+    def since(self, snapshot):
+        now = self.snapshot()
+        return dict([(field, now[field] - snapshot[field])
+                     for field in self.FIELDS])
+
+    # Locks can't be pickled
+    def __getstate__(self):
+        return self.snapshot()
+
+    def __setstate__(self, totals):
+        self._totals = totals
+        self._lock = threading.Lock()
+
+def test__ReadCounts():
+    counts = _ReadCounts()
+    start = counts.snapshot()
+    counts.add({"calls": 1, "bytes": 80})
+    counts.add({"calls": 2, "in_memory": 1, "wall": 0.5})
+    assert counts.since(start) == {"calls": 3, "bytes": 80, "in_memory": 1,
+                                   "wall": 0.5, "cpu": 0}
+    middle = counts.snapshot()
+    counts.add({"bytes": 8})
+    assert counts.since(middle)["bytes"] == 8
+    assert counts.since(middle)["calls"] == 0
+    counts2 = cPickle.loads(cPickle.dumps(counts))
+    assert counts2.snapshot() == counts.snapshot()
+    counts2.add({"calls": 1})
+    assert counts2.snapshot()["calls"] == counts.snapshot()["calls"] + 1
+
+class MemmapRecspan(object):
+    """A lazy recspan whose data lives in a .npy file on disk.
+
+    The file is memory-mapped read-only, so get_slice just returns views into
+    it without copying anything, and the OS pages the data in and out as
+    needed. Pass one to Dataset.add_lazy_recspan, or see
+    Dataset.spill_to_disk.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._data = np.load(path, mmap_mode="r")
+        if self._data.ndim != 2:
+            raise ValueError("%s should hold a (ticks x channels) array"
+                             % (path,))
+
+    @property
+    def ticks(self):
+        return self._data.shape[0]
+
+    def get_slice(self, start_tick, stop_tick):
+        if stop_tick > self.ticks:
+            raise IndexError("attempt to index beyond end of recspan")
+        return self._data[start_tick:stop_tick, :]
+
+    # Pickling a memmap would copy all the data into the pickle; instead we
+    # just reopen the file.
+    def __getstate__(self):
+        return self.path
+
+    def __setstate__(self, path):
+        self.__init__(path)
+
+# Sparse transforms (like most re-references) are applied with a sparse
+# matrix product, in chunks of this many rows -- but only when there are
+# enough channels for that to beat a dense BLAS product.
+_SPARSE_TRANSFORM_MIN_CHANNELS = 32
+_SPARSE_TRANSFORM_MAX_DENSITY = 0.1
+_SPARSE_TRANSFORM_ROWS = 1024
+
+class _PendingTransform(object):
+    # A channel transform that hasn't been applied to a recspan's data yet;
+    # raw_slice applies it to just the rows that it reads. 'matrix' is the
+    # whole transform so far, with all of the Dataset.transform calls
+    # composed together. Diagonal transforms (like calibration) are just an
+    # elementwise multiply.
+    def __init__(self, matrix):
+        self.matrix = matrix
+        channels = matrix.shape[0]
+        diagonal = np.diagonal(matrix).copy()
+        self._scale = None
+        self._sparse = None
+        if np.count_nonzero(matrix) == np.count_nonzero(diagonal):
+            self._scale = diagonal
+        elif (channels >= _SPARSE_TRANSFORM_MIN_CHANNELS
+              and np.count_nonzero(matrix)
+                  <= _SPARSE_TRANSFORM_MAX_DENSITY * matrix.size):
+            self._sparse = sp.csc_matrix(matrix)
+
+    def then(self, matrix):
+        # Returns the _PendingTransform that applies this one and then
+        # 'matrix', or None if that's the identity.
+        return _pending_transform(np.dot(matrix, self.matrix))
+
+    def apply(self, data):
+        if self._scale is not None:
+            return data * self._scale
+        elif self._sparse is not None:
+            result = np.empty((data.shape[0], self.matrix.shape[0]))
+            for i in xrange(0, data.shape[0], _SPARSE_TRANSFORM_ROWS):
+                chunk = data[i:i + _SPARSE_TRANSFORM_ROWS]
+                result[i:i + _SPARSE_TRANSFORM_ROWS] = (
+                    self._sparse.dot(chunk.T).T)
+            return result
+        else:
+            return np.dot(data, self.matrix.T)
+
+def _pending_transform(matrix):
+    matrix = np.asarray(matrix, dtype=float)
+    if np.array_equal(matrix, np.eye(matrix.shape[0])):
+        return None
+    return _PendingTransform(matrix)
+
+def test__PendingTransform():
+    global _SPARSE_TRANSFORM_MIN_CHANNELS, _SPARSE_TRANSFORM_ROWS
+    r = np.random.RandomState(0)
+    data = r.normal(size=(50, 4))
+    assert _pending_transform(np.eye(4)) is None
+    scale = _pending_transform(np.diag([1.0, 2.0, 0.0, -1.0]))
+    assert scale._scale is not None
+    assert np.allclose(scale.apply(data), data * [1, 2, 0, -1])
+    reref = np.eye(4)
+    reref[:, 0] -= 0.5
+    old = (_SPARSE_TRANSFORM_MIN_CHANNELS, _SPARSE_TRANSFORM_ROWS)
+    try:
+        _SPARSE_TRANSFORM_MIN_CHANNELS = 1
+        _SPARSE_TRANSFORM_ROWS = 7
+        # Too dense for a sparse product
+        assert _pending_transform(reref)._sparse is None
+        big = np.eye(40)
+        big[:, 0] -= 0.5
+        big_data = r.normal(size=(50, 40))
+        sparse = _pending_transform(big)
+        assert sparse._sparse is not None
+        assert np.allclose(sparse.apply(big_data), np.dot(big_data, big.T))
+        assert sparse.apply(big_data[:0]).shape == (0, 40)
+    finally:
+        _SPARSE_TRANSFORM_MIN_CHANNELS, _SPARSE_TRANSFORM_ROWS = old
+    # Not enough channels for a sparse product
+    medium = np.eye(24)
+    medium[:, 0] -= 0.5
+    assert _pending_transform(medium)._sparse is None
+    assert _pending_transform(big)._sparse is not None
+    dense = _pending_transform(reref)
+    assert np.allclose(dense.apply(data), np.dot(data, reref.T))
+    # Composition
+    both = scale.then(reref)
+    assert np.allclose(both.apply(data),
+                       np.dot(np.dot(data, np.diag([1, 2, 0, -1]).T),
+                              reref.T))
+    inverse = _pending_transform(np.diag([2.0, 0.5, 1.0, 1.0]))
+    assert inverse.then(np.diag([0.5, 2.0, 1.0, 1.0])) is None
+
 class Dataset(object):
     def __init__(self, data_format):
         self.data_format = data_format
         self._events = rerpy.events.Events()
+        # In-memory recspans are kept as plain (ticks x channels) ndarrays, so
+        # that raw_slice (which the fitting code calls a *lot*) is just numpy
+        # slicing; the DataFrame that users see is only built by __getitem__.
+        # Lazy recspans have None here.
         self._recspans = []
         self._lazy_recspans = []
-        self._lazy_transforms = []
+        # Transforms aren't applied to the stored data (which would mean a
+        # full copy of it for every transform call), but saved up as a
+        # _PendingTransform (or None) for each recspan, that raw_slice
+        # applies as the data is read.
+        self._transforms = []
         self.recspan_infos = []
+        # Bumped whenever existing data changes (see rERPUpdater)
+        self._data_version = 0
+        self._read_counts = _ReadCounts()
 
     def transform(self, matrix, exclude=[]):
         if isinstance(matrix, basestring):
@@ -177,19 +382,21 @@ class Dataset(object):
             if exclude:
                 raise ValueError("exclude= can only be specified if matrix= "
                                  "is a symbolic expression")
-        matrix = np.asarray(matrix)
+        matrix = np.asarray(matrix, dtype=float)
+        self._data_version += 1
+        # Most datasets only have one distinct transform in effect, so only
+        # compose each distinct one once. (Keeping the old transforms in
+        # 'composed' keeps their ids from being reused.)
+        composed = {}
         for i in xrange(len(self._recspans)):
-            if self._recspans[i] is not None:
-                recspan = self._recspans[i]
-                new_data = np.dot(recspan, matrix.T)
-                self._recspans[i] = pandas.DataFrame(new_data,
-                                                     columns=recspan.columns,
-                                                     index=recspan.index)
-            else:
-                old_transform = self._lazy_transforms[i]
+            old_transform = self._transforms[i]
+            if id(old_transform) not in composed:
                 if old_transform is None:
-                    old_transform = np.eye(self.data_format.num_channels)
-                self._lazy_transforms[i] = np.dot(matrix, old_transform)
+                    new_transform = _pending_transform(matrix)
+                else:
+                    new_transform = old_transform.then(matrix)
+                composed[id(old_transform)] = (old_transform, new_transform)
+            self._transforms[i] = composed[id(old_transform)][1]
 
     def _add_recspan_info(self, ticks, metadata):
         recspan_id = len(self.recspan_infos)
@@ -208,22 +415,48 @@ class Dataset(object):
         return df
 
     def add_recspan(self, data, metadata):
-        data = np.asarray(data, dtype=np.float64)
+        data = np.ascontiguousarray(data, dtype=self.data_format.dtype)
         if data.shape[1] != self.data_format.num_channels:
             raise ValueError("wrong number of channels, array should have "
                              "shape (ticks, %s)"
                              % (self.data_format.num_channels,))
         ticks = data.shape[0]
         self._add_recspan_info(ticks, metadata)
-        self._recspans.append(self._decorate_recspan(data))
+        self._recspans.append(data)
         self._lazy_recspans.append(None)
-        self._lazy_transforms.append(None)
+        self._transforms.append(None)
 
     def add_lazy_recspan(self, loader, ticks, metadata):
         self._add_recspan_info(ticks, metadata)
         self._recspans.append(None)
         self._lazy_recspans.append(loader)
-        self._lazy_transforms.append(None)
+        self._transforms.append(None)
+
+    def spill_to_disk(self, directory):
+        """Moves the data for all in-memory recspans out to .npy files in
+        'directory' (which is created if necessary), and replaces them by
+        memory-mapped lazy recspans (see MemmapRecspan).
+
+        This doesn't change the data at all, just where it lives: afterwards
+        it only takes up memory while it's actually being read, so many more
+        recspans (or subjects) can share one machine. raw_slice on a spilled
+        recspan returns a view into the file, unless a transform is pending.
+        The files are not deleted when the Dataset goes away.
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for i in xrange(len(self._recspans)):
+            recspan = self._recspans[i]
+            if recspan is None:
+                continue
+            # Other datasets might have files open in the same directory
+            # (e.g., from add_dataset), so always make a new file.
+            fd, path = tempfile.mkstemp(prefix="recspan-%s-" % (i,),
+                                        suffix=".npy", dir=directory)
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, recspan)
+            self._recspans[i] = None
+            self._lazy_recspans[i] = MemmapRecspan(path)
 
     def add_dataset(self, dataset):
         # Metadata
@@ -235,7 +468,7 @@ class Dataset(object):
             self._add_recspan_info(recspan_info.ticks, dict(recspan_info))
         self._recspans += dataset._recspans
         self._lazy_recspans += dataset._lazy_recspans
-        self._lazy_transforms += dataset._lazy_transforms
+        self._transforms += dataset._transforms
         # Events
         for their_event in dataset.events_query():
             self.add_event(their_event.recspan_id + our_recspan_id_base,
@@ -251,18 +484,25 @@ class Dataset(object):
         if start_tick < 0 or stop_tick < 0:
             raise IndexError("only positive indexes allowed")
         ticks = stop_tick - start_tick
+        start_wall = time.time()
+        start_cpu = process_time()
         recspan = self._recspans[recspan_id]
         if recspan is not None:
-            result = np.asarray(recspan.iloc[start_tick:stop_tick, :])
+            result = recspan[start_tick:stop_tick]
         else:
             lr = self._lazy_recspans[recspan_id]
-            lazy_data = lr.get_slice(start_tick, stop_tick)
-            transform = self._lazy_transforms[recspan_id]
-            if transform is not None:
-                lazy_data = np.dot(lazy_data, transform.T)
-            result = lazy_data
+            result = lr.get_slice(start_tick, stop_tick)
         if result.shape[0] != ticks:
             raise IndexError("slice spans missing data")
+        transform = self._transforms[recspan_id]
+        if transform is not None:
+            result = transform.apply(result)
+        result = np.asarray(result, dtype=self.data_format.dtype)
+        self._read_counts.add({"calls": 1,
+                               "bytes": result.nbytes,
+                               "in_memory": int(recspan is not None),
+                               "wall": time.time() - start_wall,
+                               "cpu": process_time() - start_cpu})
         return result
 
     def __getitem__(self, key):
@@ -272,12 +512,11 @@ class Dataset(object):
             raise TypeError("Dataset indexing allows only a single integer "
                             "(no slicing or other fanciness!)")
         # May raise IndexError, which is what we want:
-        recspan = self._recspans[key]
-        if recspan is None:
+        raw = self._recspans[key]
+        if raw is None or self._transforms[key] is not None:
             ticks = self.recspan_infos[key].ticks
             raw = self.raw_slice(key, 0, ticks)
-            recspan = self._decorate_recspan(raw)
-        return recspan
+        return self._decorate_recspan(raw)
 
     def __iter__(self):
         for i in xrange(len(self)):
@@ -339,56 +578,227 @@ class Dataset(object):
              # rERPRequest arguments
              event_query, start_time, stop_time, formula,
              name=None, eval_env=0, bad_event_query=None,
-             all_or_nothing=False,
+             all_or_nothing=False, latency_basis=None, latency_basis_degree=3,
              # multi_rerp arguments
              artifact_query="has _ARTIFACT_TYPE",
              artifact_type_field="_ARTIFACT_TYPE",
              overlap_correction=True,
              regression_strategy="auto",
-             verbose=True):
+             verbose=True,
+             workers=1,
+             iterative_tolerance=1e-8,
+             iterative_max_iterations=None,
+             memory_limit=None,
+             penalty=0,
+             smoothness_penalty=0,
+             penalty_path=None,
+             checkpoint_path=None,
+             timing_callback=None):
         eval_env = EvalEnvironment.capture(eval_env, reference=1)
         request = rERPRequest(event_query, start_time, stop_time, formula,
                               name=name, eval_env=eval_env,
                               bad_event_query=bad_event_query,
-                              all_or_nothing=all_or_nothing)
+                              all_or_nothing=all_or_nothing,
+                              latency_basis=latency_basis,
+                              latency_basis_degree=latency_basis_degree)
         rerps = self.multi_rerp([request],
                                 artifact_query=artifact_query,
                                 artifact_type_field=artifact_type_field,
                                 overlap_correction=overlap_correction,
                                 regression_strategy=regression_strategy,
-                                verbose=verbose)
+                                verbose=verbose,
+                                workers=workers,
+                                iterative_tolerance=iterative_tolerance,
+                                iterative_max_iterations=
+                                  iterative_max_iterations,
+                                memory_limit=memory_limit,
+                                penalty=penalty,
+                                smoothness_penalty=smoothness_penalty,
+                                penalty_path=penalty_path,
+                                checkpoint_path=checkpoint_path,
+                                timing_callback=timing_callback)
         assert len(rerps) == 1
         return rerps[0]
 
-    # regression_strategy can be "continuous", "by-epoch", or "auto". If
-    # "continuous", we always build one giant regression model, treating the
-    # data as continuous. If "auto", we use the (much faster) approach of
-    # generating a single regression model and then applying it to each
-    # latency separately -- but *only* if this will produce the same result as
-    # doing the full regression. If "epoch", then we either use the fast
-    # method, or else error out. Changing this argument never affects the
-    # actual output of this function. If it does, that's a bug! In general, we
-    # can do the fast thing if:
+    # regression_strategy can be "continuous", "by-epoch", "by-latency",
+    # "iterative", or "auto". If "continuous", we always build one giant
+    # regression model, treating the data as continuous. If "auto", we use
+    # the (much faster) approach of generating a single regression model and
+    # then applying it to each latency separately -- but *only* if this will
+    # produce the same result as doing the full regression. If "epoch", then
+    # we either use the fast method, or else error out. Changing this
+    # argument never affects the actual output of this function. If it does,
+    # that's a bug! In general, we can do the fast thing if:
     # -- any artifacts affect either all or none of each
     #    epoch, and
     # -- either, overlap_correction=False,
     # -- or, overlap_correction=True and there are in fact no
     #    overlaps.
+    # If only the first condition fails (some epochs are partially rejected),
+    # then "auto" uses "by-latency" instead, which groups the latencies by
+    # which epochs survive there, and applies a separate small regression to
+    # each group. It gives the same result as "continuous", but doesn't work
+    # with latency_basis or any of the penalties.
+    #
+    # workers > 1 runs the expensive part of a "continuous" fit in that many
+    # worker processes (on Unix only), each handling large batches of
+    # recspans. For "by-epoch" and "by-latency" fits, it instead fits up to
+    # that many rERPs at once in threads (unless there's a memory_limit).
+    # Like regression_strategy, this never changes the output.
+    #
+    # regression_strategy="iterative" is for designs that are too wide for
+    # "continuous" to hold XtX in memory. It fits the same model, but solves
+    # it by conjugate gradients, making repeated passes over the (sparse)
+    # design matrix instead. Each channel is iterated until its
+    # normal-equations residual is below iterative_tolerance times its
+    # starting value, or until iterative_max_iterations (default: the number
+    # of design columns) is hit, in which case it's an error. The number of
+    # iterations and each channel's residual norm ||Y - X b|| are saved on
+    # the resulting rERPs as .iterations and .residual_norm. Unlike the
+    # other strategies, it can only detect the most blatant kinds of
+    # collinearity (like predictors that are always zero).
+    #
+    # memory_limit, if given, is a number of bytes that the big arrays used
+    # in fitting (X'X, the data, etc.) should fit into. Data is streamed
+    # through in pieces that fit, X'X is kept sparse if a dense copy won't
+    # fit, and by-epoch fits fall back on an incremental QR decomposition if
+    # there are too many epochs to hold the design matrix in memory. If the
+    # analysis can't be done within the limit, you get a ValueError. Either
+    # way, the (estimated) peak memory use is saved on the rERPs as
+    # .peak_memory.
+    #
+    # penalty and smoothness_penalty turn the least-squares fit into a
+    # penalized one, which minimizes
+    #   ||Y - X B||^2 + penalty * ||B||^2
+    #                 + smoothness_penalty * (sum of squared differences
+    #                                         between each beta and the one
+    #                                         at the next latency)
+    # i.e., ridge regression, plus (optionally) a penalty on wiggly
+    # waveforms. This trades a little bias for a lot less variance when the
+    # design is nearly collinear (or even makes exactly collinear designs
+    # fittable). Unlike the arguments above, these *do* change the output!
+    # Instead of a single penalty, you can give penalty_path, a list of
+    # penalties to try; each is scored by generalized cross-validation, and
+    # the best one is used for .betas. The rERPs record the chosen .penalty
+    # and .smoothness_penalty, and with penalty_path, the GCV score for each
+    # penalty (as a Series, .penalty_path) and the betas for each (as a
+    # list of Panels, .path_betas, with None for penalties that were too
+    # small to make the problem well-conditioned). penalty_path doesn't work
+    # with regression_strategy="iterative", or with multi_rerp_solver.
+    #
+    # checkpoint_path, if given, is a file where "continuous" fits
+    # periodically save their progress through the data (every few minutes,
+    # and once all the data has been read). If the fit is interrupted, then
+    # rerunning it with the same checkpoint_path picks up where it left off.
+    # The checkpoint records a fingerprint of the design and the dataset's
+    # layout, and you get a ValueError if you try to resume it with
+    # different requests or data; it's deleted once the fit succeeds. Other
+    # strategies are fast enough that they ignore it.
+    #
+    # Besides .betas, unpenalized rERPs also have .residual_variance (a
+    # latency x channel DataFrame; for continuous and iterative fits, which
+    # assume one error variance per channel, each column is constant), and,
+    # except for iterative fits, .stderr and .tvalues (Panels laid out like
+    # .betas). These come out of the same pass through the data as the
+    # betas do. (Continuous fits skip .stderr and .tvalues if memory_limit=
+    # doesn't leave room for the extra linear algebra they need.)
+    #
+    # Every rERP also has .timings, a rerpy.rerp.FitTimings giving the wall
+    # and CPU time spent in each phase of the fit (finding epochs and
+    # artifacts, accounting, the regression itself, and reading data), and
+    # counters like the design matrix's size and the number of bytes read.
+    # timing_callback, if given, is called as timing_callback(phase, wall,
+    # cpu) as each phase finishes, for live reporting.
     #
     # WARNING: if you modify this function's arguments in any way, you must
-    # also update rerp() to match!
+    # also update rerp(), multi_rerp_solver(), and
+    # rerpy.rerp.multi_dataset_rerp() to match!
     def multi_rerp(self, rerp_requests,
                    artifact_query="has _ARTIFACT_TYPE",
                    artifact_type_field="_ARTIFACT_TYPE",
                    overlap_correction=True,
                    regression_strategy="auto",
-                   verbose=True):
+                   verbose=True,
+                   workers=1,
+                   iterative_tolerance=1e-8,
+                   iterative_max_iterations=None,
+                   memory_limit=None,
+                   penalty=0,
+                   smoothness_penalty=0,
+                   penalty_path=None,
+                   checkpoint_path=None,
+                   timing_callback=None):
         return multi_rerp_impl(self, rerp_requests,
                                artifact_query=artifact_query,
                                artifact_type_field=artifact_type_field,
                                overlap_correction=overlap_correction,
                                regression_strategy=regression_strategy,
-                               verbose=verbose)
+                               verbose=verbose,
+                               workers=workers,
+                               iterative_tolerance=iterative_tolerance,
+                               iterative_max_iterations=
+                                 iterative_max_iterations,
+                               memory_limit=memory_limit,
+                               penalty=penalty,
+                               smoothness_penalty=smoothness_penalty,
+                               penalty_path=penalty_path,
+                               checkpoint_path=checkpoint_path,
+                               timing_callback=timing_callback)
+
+    # Like multi_rerp, but instead of fitting the requests, returns an
+    # rerpy.rerp.rERPSolver with the design already factored. Call its
+    # .fit(dataset) method to get the rERPs for this dataset, or for any
+    # transformed version of it (or another dataset with the same events).
+    def multi_rerp_solver(self, rerp_requests,
+                          artifact_query="has _ARTIFACT_TYPE",
+                          artifact_type_field="_ARTIFACT_TYPE",
+                          overlap_correction=True,
+                          regression_strategy="auto",
+                          verbose=True,
+                          workers=1,
+                          iterative_tolerance=1e-8,
+                          iterative_max_iterations=None,
+                          memory_limit=None,
+                          penalty=0,
+                          smoothness_penalty=0):
+        return rERPSolver(self, rerp_requests,
+                          artifact_query=artifact_query,
+                          artifact_type_field=artifact_type_field,
+                          overlap_correction=overlap_correction,
+                          regression_strategy=regression_strategy,
+                          verbose=verbose,
+                          workers=workers,
+                          iterative_tolerance=iterative_tolerance,
+                          iterative_max_iterations=iterative_max_iterations,
+                          memory_limit=memory_limit,
+                          penalty=penalty,
+                          smoothness_penalty=smoothness_penalty)
+
+    # Like multi_rerp, but returns an rerpy.rerp.rERPUpdater. Its .fit()
+    # method returns the rERPs for this dataset as it is now; calling it
+    # again after adding recspans (e.g. with add_dataset) or changing events
+    # only reads the data in the recspans that changed. It always uses the
+    # "continuous" regression strategy.
+    def multi_rerp_updater(self, rerp_requests,
+                           artifact_query="has _ARTIFACT_TYPE",
+                           artifact_type_field="_ARTIFACT_TYPE",
+                           overlap_correction=True,
+                           verbose=True,
+                           workers=1,
+                           memory_limit=None,
+                           penalty=0,
+                           smoothness_penalty=0,
+                           penalty_path=None):
+        return rERPUpdater(self, rerp_requests,
+                           artifact_query=artifact_query,
+                           artifact_type_field=artifact_type_field,
+                           overlap_correction=overlap_correction,
+                           verbose=verbose,
+                           workers=workers,
+                           memory_limit=memory_limit,
+                           penalty=penalty,
+                           smoothness_penalty=smoothness_penalty,
+                           penalty_path=penalty_path)
 
     ################################################################
     # Convenience methods
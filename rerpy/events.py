@@ -243,6 +243,11 @@ class Events(object):
         self._op_count = 0
         self._analyze_threshold = 1
 
+        # Bumped on every modification, so that things computed from the
+        # events (like a factored rERP design, see rerp.py) can tell whether
+        # they're stale.
+        self._version = 0
+
         self._objtypes = {}
 
         # Allocating ids ourselves is better than letting sqlite do it,
@@ -296,6 +301,7 @@ class Events(object):
     # WARNING: this should not be called inside a transaction, it might commit
     # it.
     def _incr_op_count(self, count=1):
+        self._version += 1
         self._op_count += count
         if self._op_count >= self._analyze_threshold:
             self._connection.execute("ANALYZE;")
@@ -471,6 +477,7 @@ class Events(object):
                           "    stop_tick = stop_tick + ? "
                           "WHERE id = ?",
                           [offset, offset, id])
+        self._version += 1
 
     def placeholder_event(self):
         return PlaceholderEvent(self)
@@ -504,7 +511,9 @@ class Events(object):
             raise ValueError("I don't know how to interpret %r as an event "
                              "query" % (restrict,))
 
-    def _query(self, sql_where, query_tables, query_vals):
+    # 'outer_joins' are extra "LEFT OUTER JOIN ..." clauses, used to pull out
+    # attributes that not every matching event has.
+    def _query(self, sql_where, query_tables, query_vals, outer_joins=[]):
         tables = set(["sys_events"])
         tables.update(query_tables)
         joins = []
@@ -515,7 +524,7 @@ class Events(object):
                              % (table, objtype.event_join_field))
         code = ("SELECT %s FROM %s WHERE (%s) "
                 % (", ".join(query_vals),
-                   ", ".join(tables),
+                   " ".join([", ".join(tables)] + list(outer_joins)),
                    sql_where.code))
         if joins:
             code += " AND (%s)" % (" AND ".join(joins),)
@@ -899,6 +908,50 @@ class Query(object):
         for (db_id,) in db_ids:
             yield Event(self._events, _decode_sql_value(db_id))
 
+    def _spans_and_values(self, key, default=None):
+        """Returns the location of every event matching this query, plus the
+        value of its attribute 'key' (or 'default', for events that don't
+        have that attribute).
+
+        This fetches everything in a single database query, which is much
+        faster than iterating over the matching events and looking up each
+        field separately.
+
+        Returns a tuple (recspan_ids, start_ticks, stop_ticks, values), where
+        the first three are integer arrays and 'values' is a list.
+        """
+        if self._value_type() is not _BOOL:
+            raise EventsError("top-level query must be boolean", self)
+        objtype = self._events._objtypes["event"]
+        self._events._ensure_table_for_key(objtype, key)
+        join = ("LEFT OUTER JOIN %s AS projected "
+                "ON projected.obj_id == sys_events.%s"
+                % (objtype.table_name(key), objtype.event_join_field))
+        rows = self._events._query(self._sql_where(),
+                                   ["sys_events"],
+                                   ["sys_events.recspan_id",
+                                    "sys_events.start_tick",
+                                    "sys_events.stop_tick",
+                                    "projected.obj_id IS NOT NULL",
+                                    "projected.value"],
+                                   outer_joins=[join])
+        value_type = objtype.value_type_for_key(key)
+        recspan_ids = np.empty(len(rows), dtype=int)
+        start_ticks = np.empty(len(rows), dtype=int)
+        stop_ticks = np.empty(len(rows), dtype=int)
+        values = []
+        for i, (recspan_id, start_tick, stop_tick,
+                has_value, value) in enumerate(rows):
+            recspan_ids[i] = recspan_id
+            start_ticks[i] = start_tick
+            stop_ticks[i] = stop_tick
+            if has_value:
+                values.append(_sql_value_to_value_type(
+                    _decode_sql_value(value), value_type))
+            else:
+                values.append(default)
+        return recspan_ids, start_ticks, stop_ticks, values
+
 class LiteralQuery(Query):
     def __init__(self, events, value, origin=None):
         Query.__init__(self, events, origin)
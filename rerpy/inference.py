@@ -0,0 +1,323 @@
+# This file is part of rERPy
+# Copyright (C) 2013 Nathaniel Smith <njs@pobox.com>
+# See file LICENSE.txt for license information.
+
+# Permutation tests and bootstrapping for rERPs. These implement the public
+# rERP.permutation_test and rERP.bootstrap methods; the code lives here to
+# keep rerp.py from growing any further.
+#
+# Both need to refit the same regression many times with slightly different
+# designs: in a permutation test, some predictors get shuffled between
+# epochs; in a bootstrap, the epochs themselves are resampled. Calling
+# Dataset.rerp over and over would redo the event queries and design
+# building every time, so instead we pull out the epoch-level X and Y once,
+# and then fit whole blocks of permutations at a time with a few big
+# (batched) matrix products. This only works for by-epoch rERPs -- in a
+# continuous (overlap-corrected) fit, shuffling the design changes XtX in a
+# way that requires going back over the whole data set.
+
+import numpy as np
+import pandas
+import scipy.stats
+
+from rerpy.rerp import (_by_epoch_X, _by_epoch_Y, _by_epoch_map,
+                        _MemoryBudget, _COLLINEAR_MSG, _MAX_CONDITION_NUMBER)
+
+# Permutations (or bootstrap samples) are fit in blocks which take about
+# this many bytes each (or less, if the rERP was fit with a memory_limit=
+# that doesn't leave room for that much).
+#
+# With workers > 1, the blocks are fit in threads (by _by_epoch_map), not in
+# forked processes like continuous fits use. Each block is a few big
+# batched BLAS/LAPACK calls, which release the GIL, so threads get the same
+# speedup -- and they share X and Y instead of each needing a copy, and hand
+# back their results without pickling them.
+_BLOCK_BYTES = 2 ** 26
+
+def _budget_for(rerp):
+    # A _MemoryBudget with the same memory_limit= the rERP was fit with
+    return _MemoryBudget(rerp._memory_limit)
+
+def _epoch_matrices(rerp, dataset, budget):
+    if rerp.regression_strategy != "by-epoch" or rerp._epochs is None:
+        raise ValueError("permutation tests and bootstrapping only work for "
+                         "rERPs fit with regression_strategy=\"by-epoch\"")
+    if rerp.penalty or rerp.smoothness_penalty:
+        raise ValueError("permutation tests and bootstrapping only work for "
+                         "unpenalized rERPs")
+    if dataset.data_format != rerp.data_format:
+        raise ValueError("dataset does not match the one this rERP was "
+                         "fit to")
+    X = _by_epoch_X(rerp, rerp._epochs)
+    num_epochs = len(rerp._epochs)
+    budget.set("epochs", 8 * num_epochs * (X.shape[1] + rerp.ticks
+                                           * dataset.data_format.num_channels))
+    Y = _by_epoch_Y(dataset, rerp, rerp._epochs)
+    return X, Y
+
+def _permuted_columns(design_info, permute):
+    # Converts permute= (None, a term name, or a list of term names) into an
+    # array of design matrix column indices.
+    if permute is None:
+        permute = [term_name for term_name in design_info.term_names
+                   if term_name != "Intercept"]
+    elif isinstance(permute, basestring):
+        permute = [permute]
+    all_columns = np.arange(len(design_info.column_names))
+    columns = []
+    for term_name in permute:
+        if term_name not in design_info.term_name_slices:
+            raise ValueError("no term named %r in this rERP" % (term_name,))
+        columns += list(all_columns[design_info.term_name_slices[term_name]])
+    if not columns:
+        raise ValueError("nothing to permute")
+    return np.asarray(sorted(set(columns)))
+
+def _blocks(n, bytes_per_item, budget):
+    # Splits range(n) into (start, stop) blocks of about _BLOCK_BYTES each,
+    # or as much as fits in 'budget'. (With a memory limit, _by_epoch_map
+    # runs the blocks one at a time, so they don't have to share.)
+    room = min(_BLOCK_BYTES, budget.available("block"))
+    block = int(min(n, max(1, room // bytes_per_item)))
+    budget.set("block", block * bytes_per_item)
+    return [(i, min(i + block, n)) for i in xrange(0, n, block)]
+
+def _batched_solve(XtX, XtY):
+    # XtX is (k, p, p), XtY is (k, p, m); returns the k betas (k, p, m),
+    # the diagonals of the k inverses of XtX (k, p) (which give the
+    # standard errors), and a boolean array saying which of the k XtX's
+    # were far enough from singular to solve. The others get NaN betas and
+    # diagonals.
+    eigenvalues = np.linalg.eigvalsh(XtX)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cond = (np.abs(eigenvalues).max(axis=1)
+                / np.abs(eigenvalues).min(axis=1))
+        ok = (cond <= _MAX_CONDITION_NUMBER)
+    betas = np.empty(XtY.shape)
+    betas.fill(np.nan)
+    inverse_diagonals = np.empty(XtX.shape[:2])
+    inverse_diagonals.fill(np.nan)
+    if np.any(ok):
+        inverses = np.linalg.inv(XtX[ok])
+        betas[ok] = np.matmul(inverses, XtY[ok])
+        inverse_diagonals[ok] = np.diagonal(inverses, axis1=1, axis2=2)
+    return betas, inverse_diagonals, ok
+
+def test__batched_solve():
+    r = np.random.RandomState(0)
+    X = r.normal(size=(3, 10, 2))
+    # The second design has two identical columns
+    X[1, :, 1] = X[1, :, 0]
+    Y = r.normal(size=(10, 4))
+    XtX = np.matmul(X.transpose((0, 2, 1)), X)
+    XtY = np.matmul(X.transpose((0, 2, 1)), Y)
+    betas, inverse_diagonals, ok = _batched_solve(XtX, XtY)
+    assert list(ok) == [True, False, True]
+    assert np.all(np.isnan(betas[1]))
+    assert np.all(np.isnan(inverse_diagonals[1]))
+    for i in [0, 2]:
+        assert np.allclose(betas[i], np.linalg.lstsq(X[i], Y, rcond=None)[0])
+        assert np.allclose(inverse_diagonals[i],
+                           np.diag(np.linalg.inv(XtX[i])))
+
+def _batched_stat(stat, betas, inverse_diagonals, XtY, YtY, dof):
+    if stat == "beta":
+        return betas
+    # stat == "t". The residual sum of squares is
+    #   Y'Y - 2 b'X'Y + b'X'X b = Y'Y - b'X'Y
+    # since X'X b = X'Y.
+    rss = YtY - np.sum(betas * XtY, axis=1)
+    sigma2 = np.maximum(rss, 0) / dof
+    stderr = np.sqrt(inverse_diagonals[:, :, np.newaxis]
+                     * sigma2[:, np.newaxis, :])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return betas / stderr
+
+def _permuted_stats(X, Y, YtY, columns, permutations, stat):
+    # Fits the design X with the given columns shuffled according to each
+    # row of 'permutations', and returns the statistics for those columns,
+    # as a (k, len(columns), m) array.
+    k = permutations.shape[0]
+    Xs = np.repeat(X[np.newaxis, :, :], k, axis=0)
+    Xs[:, :, columns] = X[permutations][:, :, columns]
+    Xts = Xs.transpose((0, 2, 1))
+    XtX = np.matmul(Xts, Xs)
+    # One big GEMM for all the XtY's at once
+    XtY = np.dot(Xts.reshape((-1, X.shape[0])), Y)
+    XtY = XtY.reshape((k, X.shape[1], -1))
+    betas, inverse_diagonals, ok = _batched_solve(XtX, XtY)
+    if not np.all(ok):
+        raise ValueError(_COLLINEAR_MSG)
+    stats = _batched_stat(stat, betas, inverse_diagonals, XtY,
+                          YtY[np.newaxis, :], X.shape[0] - X.shape[1])
+    return stats[:, columns, :]
+
+def _cluster_masses(stat, threshold):
+    # Finds the clusters in 'stat' (a ticks x channels array): runs of
+    # consecutive ticks within a single channel where stat is above
+    # threshold, or below -threshold. Returns arrays of channel, start tick,
+    # stop tick, and mass (the sum of stat over the cluster).
+    ticks, channels = stat.shape
+    cumsum = np.zeros((ticks + 1, channels))
+    np.cumsum(stat, axis=0, out=cumsum[1:])
+    results = []
+    for sign in [1, -1]:
+        over = np.zeros((channels, ticks + 2), dtype=np.int8)
+        over[:, 1:-1] = (sign * stat > threshold).T
+        # Transposed, so that nonzero lists each channel's edges in order
+        edges = np.diff(over, axis=1)
+        start_channels, starts = np.nonzero(edges == 1)
+        _, stops = np.nonzero(edges == -1)
+        masses = (cumsum[stops, start_channels]
+                  - cumsum[starts, start_channels])
+        results.append((start_channels, starts, stops, masses))
+    return [np.concatenate(parts) for parts in zip(*results)]
+
+def test__cluster_masses():
+    stat = np.asarray([[0, 3, -3],
+                       [3, 3, -3],
+                       [4, 0, 3],
+                       [0, 5, 3]], dtype=float)
+    channels, starts, stops, masses = _cluster_masses(stat, 2)
+    got = sorted(zip(channels, starts, stops, masses))
+    assert got == [(0, 1, 3, 7), (1, 0, 2, 6), (1, 3, 4, 5),
+                   (2, 0, 2, -6), (2, 2, 4, 6)]
+    channels, starts, stops, masses = _cluster_masses(stat, 10)
+    assert len(channels) == len(masses) == 0
+
+def _max_cluster_masses(stats, threshold):
+    # stats is (k, ticks, channels); returns the largest |cluster mass| in
+    # each of the k.
+    k, ticks, channels = stats.shape
+    flat = stats.transpose((1, 0, 2)).reshape((ticks, k * channels))
+    flat_channels, _, _, masses = _cluster_masses(flat, threshold)
+    result = np.zeros(k)
+    np.maximum.at(result, flat_channels // channels, np.abs(masses))
+    return result
+
+class rERPPermutationTest(object):
+    """The results of rERP.permutation_test.
+
+    Attributes:
+
+    .stat, .threshold, .n: what the test was run with.
+
+    .observed: a pandas.Panel of the test statistic for each permuted
+    predictor in the actual data, arranged like rERP.betas.
+
+    .null_distribution: a pandas.DataFrame with one row per permutation and
+    one column per permuted predictor, giving the largest absolute cluster
+    mass seen in that permutation.
+
+    .clusters: a pandas.DataFrame describing each cluster in the observed
+    statistics, with columns "predictor", "channel", "start_time",
+    "stop_time" (both inclusive, in ms), "mass", and "p_value" (the
+    permutation p value of the cluster's absolute mass).
+    """
+    def __init__(self, stat, threshold, observed, null_distribution,
+                 clusters):
+        self.stat = stat
+        self.threshold = threshold
+        self.n = null_distribution.shape[0]
+        self.observed = observed
+        self.null_distribution = null_distribution
+        self.clusters = clusters
+
+def _permutation_test(rerp, dataset, n, permute=None, stat="t",
+                     threshold=None, random_state=None, workers=1):
+    if stat not in ("t", "beta"):
+        raise ValueError("stat= must be \"t\" or \"beta\"")
+    if n < 1:
+        raise ValueError("need at least one permutation")
+    budget = _budget_for(rerp)
+    X, Y = _epoch_matrices(rerp, dataset, budget)
+    num_epochs, num_predictors = X.shape
+    dof = num_epochs - num_predictors
+    if threshold is None:
+        if stat != "t":
+            raise ValueError("stat=\"beta\" needs an explicit threshold=")
+        threshold = scipy.stats.t.ppf(0.975, dof)
+    columns = _permuted_columns(rerp.design_info, permute)
+    YtY = np.sum(Y ** 2, axis=0)
+    r = np.random.RandomState(random_state)
+    def stats_for(permutations):
+        stats = _permuted_stats(X, Y, YtY, columns, permutations, stat)
+        return stats.reshape((permutations.shape[0], len(columns),
+                              rerp.ticks, -1))
+    observed = stats_for(np.arange(num_epochs)[np.newaxis, :])[0]
+
+    # Each permutation gets its own seed, so that the results don't depend
+    # on how they're split into blocks (which depends on memory_limit=), or
+    # how the blocks are split between workers.
+    bytes_per_permutation = 8 * (2 * num_epochs * num_predictors
+                                 + 3 * num_predictors * Y.shape[1])
+    blocks = _blocks(n, bytes_per_permutation, budget)
+    seeds = r.randint(2 ** 31, size=n)
+    def null_for(start, stop):
+        permutations = np.asarray(
+            [np.random.RandomState(seed).permutation(num_epochs)
+             for seed in seeds[start:stop]])
+        stats = stats_for(permutations)
+        return [_max_cluster_masses(stats[:, i, :, :], threshold)
+                for i in xrange(len(columns))]
+    null_blocks = _by_epoch_map(null_for, blocks, workers, budget)
+    null = np.column_stack([np.concatenate([b[i] for b in null_blocks])
+                            for i in xrange(len(columns))])
+
+    column_names = [rerp.design_info.column_names[c] for c in columns]
+    tick_array = np.arange(rerp.start_tick, rerp.stop_tick)
+    time_array = rerp.data_format.ticks_to_ms(tick_array)
+    channel_names = rerp.data_format.channel_names
+    cluster_rows = []
+    for i, column_name in enumerate(column_names):
+        for channel, start, stop, mass in zip(
+                *_cluster_masses(observed[i], threshold)):
+            p_value = ((1 + np.sum(null[:, i] >= abs(mass)))
+                       / float(n + 1))
+            cluster_rows.append((column_name, channel_names[channel],
+                                 time_array[start], time_array[stop - 1],
+                                 mass, p_value))
+    clusters = pandas.DataFrame(cluster_rows,
+                                columns=["predictor", "channel",
+                                         "start_time", "stop_time",
+                                         "mass", "p_value"])
+    return rERPPermutationTest(
+        stat, threshold,
+        pandas.Panel(observed, items=column_names,
+                     major_axis=time_array, minor_axis=channel_names),
+        pandas.DataFrame(null, columns=column_names),
+        clusters)
+
+def _bootstrap(rerp, dataset, n, random_state=None, workers=1):
+    if n < 1:
+        raise ValueError("need at least one bootstrap sample")
+    budget = _budget_for(rerp)
+    X, Y = _epoch_matrices(rerp, dataset, budget)
+    num_epochs, num_predictors = X.shape
+    r = np.random.RandomState(random_state)
+    bytes_per_sample = 8 * (num_epochs * (num_predictors + 1)
+                            + 2 * num_predictors * Y.shape[1])
+    blocks = _blocks(n, bytes_per_sample, budget)
+    # One seed per sample, as in _permutation_test
+    seeds = r.randint(2 ** 31, size=n)
+    def betas_for(start, stop):
+        k = stop - start
+        # Resampling epochs with replacement is the same as giving each
+        # epoch a weight equal to the number of times it was drawn.
+        weights = np.zeros((k, num_epochs))
+        for i, seed in enumerate(seeds[start:stop]):
+            draws = np.random.RandomState(seed).randint(num_epochs,
+                                                         size=num_epochs)
+            weights[i] = np.bincount(draws, minlength=num_epochs)
+        XtW = X.T[np.newaxis, :, :] * weights[:, np.newaxis, :]
+        XtX = np.matmul(XtW, X)
+        XtY = np.dot(XtW.reshape((-1, num_epochs)), Y)
+        XtY = XtY.reshape((k, num_predictors, -1))
+        # Some samples may leave the design singular (e.g., by not drawing
+        # any epochs with a rare level of some factor). That's just part of
+        # the bootstrap distribution, not an error, so they get NaN betas.
+        betas, _, _ = _batched_solve(XtX, XtY)
+        return betas
+    betas = np.concatenate(_by_epoch_map(betas_for, blocks, workers,
+                                         budget))
+    return betas.reshape((n, num_predictors, rerp.ticks, -1))
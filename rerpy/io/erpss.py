@@ -8,6 +8,7 @@ import os
 import string
 import bisect
 import sys
+import threading
 
 import numpy as np
 import pandas
@@ -252,10 +253,37 @@ def read_raw(stream, dtype, lazy):
 # read_next_chunk has the invariants that at entry, the stream will always be
 # pointing to the beginning of the wanted chunk, and then on exit, the stream
 # will always be pointing to beginning of the next chunk.
-class RawChunkFetcher(object):
+#
+# get_chunk() seeks around in the underlying file. If we get forked (e.g. to
+# run a parallel rERP fit), then the child processes would all be seeking
+# around in the same OS-level file handle, and stomping on each other. So in
+# each new process, get_chunk() first re-opens the file by name (if it has
+# one).
+#
+# Threads (e.g. a by-epoch fit with workers > 1) share the one file handle,
+# so each seek() + read() pair has to happen under a lock. The lock is also
+# replaced in each new process, in case some other thread was holding it at
+# the time of the fork.
+class _ChunkFetcher(object):
     def __init__(self, stream, nchans):
         self._stream = stream
         self._nchans = nchans
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def _lock_for_this_process(self):
+        pid = os.getpid()
+        if pid != self._pid:
+            name = getattr(self._stream, "name", None)
+            if isinstance(name, basestring) and os.path.exists(name):
+                self._stream = open(name, "rb")
+            self._lock = threading.Lock()
+            self._pid = pid
+        return self._lock
+
+class RawChunkFetcher(_ChunkFetcher):
+    def __init__(self, stream, nchans):
+        _ChunkFetcher.__init__(self, stream, nchans)
         self._chunk_size_bytes = (nchans + 1) * 256 * 2
 
     def read_next_chunk(self, lazy):
@@ -272,15 +300,15 @@ class RawChunkFetcher(object):
 
     def get_chunk(self, chunk_number):
         offset = 512 + chunk_number * self._chunk_size_bytes
-        self._stream.seek(offset)
-        chunk_bytes = self._stream.read(self._chunk_size_bytes)
+        with self._lock_for_this_process():
+            self._stream.seek(offset)
+            chunk_bytes = self._stream.read(self._chunk_size_bytes)
         data = np.fromstring(chunk_bytes[512:], dtype="<i2")
         return data
 
-class CrwChunkFetcher(object):
+class CrwChunkFetcher(_ChunkFetcher):
     def __init__(self, stream, nchans):
-        self._stream = stream
-        self._nchans = nchans
+        _ChunkFetcher.__init__(self, stream, nchans)
         self._offsets = []
 
     def read_next_chunk(self, lazy):
@@ -314,9 +342,12 @@ class CrwChunkFetcher(object):
         return codes, data_chunk
 
     def get_chunk(self, chunk_number):
-        self._stream.seek(self._offsets[chunk_number])
-        (ncompressed_words,) = struct.unpack("<H", self._stream.read(2))
-        return _decompress_crw_chunk(self._stream.read(ncompressed_words * 2),
+        with self._lock_for_this_process():
+            self._stream.seek(self._offsets[chunk_number])
+            (ncompressed_words,) = struct.unpack("<H", self._stream.read(2))
+            compressed_data = self._stream.read(ncompressed_words * 2)
+        # Decompression doesn't touch the stream, so can run in parallel
+        return _decompress_crw_chunk(compressed_data,
                                      ncompressed_words,
                                      self._nchans)
 
@@ -368,6 +399,16 @@ def test_LazyRecspan():
                               (120, 130)]:
             assert np.all(lr.get_slice(start, stop)
                           == data[128 + start:128 + stop])
+        # Pretend we've been forked: the file gets re-opened, and everything
+        # keeps working.
+        old_stream = fetcher._stream
+        fetcher._pid = -1
+        assert np.all(lr.get_slice(10, 20) == data[128 + 10:128 + 20])
+        assert fetcher._stream is not old_stream
+        assert fetcher._stream.name == old_stream.name
+        new_stream = fetcher._stream
+        assert np.all(lr.get_slice(256, 266) == data[128 + 256:128 + 266])
+        assert fetcher._stream is new_stream
 
 def assert_files_match(p1, p2):
     (_, hz1, channames1, codes1, data1, info1) = read_raw(open(p1, "rb"), "u2", False)
@@ -503,8 +544,8 @@ def load_erpss(raw, log, calibration_events="condition == 0",
                calibrate_low_cursor_time=None,
                calibrate_high_cursor_time=None,
                calibrate_pulse_size=None,
-               calibrate_polarity=1):
-    dtype = np.float64
+               calibrate_polarity=1,
+               dtype=np.float64):
 
     metadata = {}
     if isinstance(raw, basestring):
@@ -523,7 +564,7 @@ def load_erpss(raw, log, calibration_events="condition == 0",
         units = "uV"
     else:
         units = "RAW"
-    data_format = DataFormat(hz, units, channel_names)
+    data_format = DataFormat(hz, units, channel_names, dtype=dtype)
 
     total_ticks = raw_codes.shape[0]
 
@@ -740,6 +781,16 @@ def test_load_erpss():
         log = open(test_data_path("erpss/tiny-complete.log"), "rb")
         assert len(load_erpss(crw, log, lazy=lazy)) == 2
 
+        # data can be stored as float32 (the raw data is only 16 bits
+        # anyway)
+        dataset32 = load_erpss(test_data_path("erpss/tiny-complete.crw"),
+                               test_data_path("erpss/tiny-complete.log"),
+                               lazy=lazy, dtype=np.float32)
+        assert dataset32.data_format.dtype == np.float32
+        assert dataset32.raw_slice(0, 10, 20).dtype == np.float32
+        assert np.array_equal(dataset32.raw_slice(0, 10, 20),
+                              dataset.raw_slice(0, 10, 20))
+
         # check that code/raw mismatch is detected
         from nose.tools import assert_raises
         for bad in ["bad-code", "bad-tick", "bad-tick2"]:
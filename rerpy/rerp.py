@@ -3,19 +3,36 @@
 # See file LICENSE.txt for license information.
 
 import itertools
+import hashlib
 from collections import namedtuple
+from contextlib import contextmanager
+import copy
 import inspect
 import sys
 import os
+import threading
+import time
+from operator import attrgetter
 
 import numpy as np
+import scipy.linalg
 import scipy.sparse as sp
+import scipy.sparse.linalg as spla
+from scipy.sparse.csgraph import connected_components
 import pandas
 from patsy import (EvalEnvironment, dmatrices, ModelDesc, Term,
-                   build_design_matrices)
+                   build_design_matrices, design_matrix_builders)
 from patsy.util import repr_pretty_delegate, repr_pretty_impl
 
-from rerpy.util import indent, ProgressBar
+from rerpy.util import indent, ProgressBar, process_time
+
+# CHOLMOD (via scikits.sparse) is optional; without it, sparse normal
+# equations get factored with SuperLU instead.
+try:
+    from sksparse.cholmod import (cholesky as _cholmod_cholesky,
+                                  CholmodError as _CholmodError)
+except ImportError:
+    _cholmod_cholesky = None
 
 ################################################################
 # Public interface
@@ -24,14 +41,30 @@ from rerpy.util import indent, ProgressBar
 class rERPRequest(object):
     # WARNING: if you modify this function's arguments in any way, you must
     # also update DataSet.rerp() to match!
+    #
+    # latency_basis, if given, makes "continuous" fits estimate each
+    # predictor's waveform as a combination of a few smooth functions of
+    # latency, rather than as a separate value at every tick. It can be an
+    # integer n, for n B-splines of degree latency_basis_degree with evenly
+    # spaced knots across the epoch (degree 1 gives overlapping "tent"
+    # functions, i.e. linear interpolation between n evenly spaced
+    # latencies), or an array with one row per tick in the epoch and one
+    # column per basis function. This shrinks the design from (ticks x
+    # predictors) columns to (n x predictors), and so XtX by a factor of
+    # (ticks / n)**2. The resulting betas are still given at every tick.
     def __init__(self, event_query, start_time, stop_time, formula,
                  name=None, eval_env=0,
-                 bad_event_query=None, all_or_nothing=False):
+                 bad_event_query=None, all_or_nothing=False,
+                 latency_basis=None, latency_basis_degree=3):
         if name is None:
             name = "%s: %s" % (event_query, formula)
         if stop_time < start_time:
             raise ValueError("start time %s comes after stop time %s"
                              % (start_time, stop_time))
+        if isinstance(latency_basis, (int, long)) and latency_basis < 1:
+            raise ValueError("latency_basis= must be at least 1")
+        if latency_basis_degree < 0:
+            raise ValueError("latency_basis_degree= can't be negative")
         self.event_query = event_query
         self.start_time = start_time
         self.stop_time = stop_time
@@ -40,6 +73,8 @@ class rERPRequest(object):
         self.eval_env = EvalEnvironment.capture(eval_env, reference=1)
         self.bad_event_query = bad_event_query
         self.all_or_nothing = all_or_nothing
+        self.latency_basis = latency_basis
+        self.latency_basis_degree = latency_basis_degree
 
     __repr__ = repr_pretty_delegate
     def _repr_pretty_(self, p, cycle):
@@ -49,6 +84,10 @@ class rERPRequest(object):
             kwargs.append(("bad_event_query", self.bad_event_query))
         if self.all_or_nothing:
             kwargs.append(("all_or_nothing", self.all_or_nothing))
+        if self.latency_basis is not None:
+            kwargs.append(("latency_basis", self.latency_basis))
+            kwargs.append(("latency_basis_degree",
+                           self.latency_basis_degree))
         return repr_pretty_impl(p, self,
                                 [self.event_query,
                                  self.start_time, self.stop_time,
@@ -71,48 +110,834 @@ def test_rERPRequest():
     repr(rERPRequest("useful query", -100, 1000, "x"))
     repr(rERPRequest("useful query", -100, 1000, "x",
                      all_or_nothing=True, bad_event_query="asdf"))
+    repr(rERPRequest("useful query", -100, 1000, "x", latency_basis=10))
+    assert_raises(ValueError, rERPRequest, "asdf", 0, 100, "1",
+                  latency_basis=0)
+    assert_raises(ValueError, rERPRequest, "asdf", 0, 100, "1",
+                  latency_basis=10, latency_basis_degree=-1)
+
+def _check_fit_options(workers, iterative_tolerance, memory_limit,
+                       penalty=0, smoothness_penalty=0, penalty_path=None):
+    if workers < 1:
+        raise ValueError("workers= must be at least 1")
+    if not iterative_tolerance > 0:
+        raise ValueError("iterative_tolerance= must be positive")
+    if memory_limit is not None and not memory_limit > 0:
+        raise ValueError("memory_limit= must be positive")
+    _check_penalty_options(penalty, smoothness_penalty, penalty_path)
+
+def _check_penalty_path_strategy(penalty_path, regression_strategy):
+    # Scoring a penalty path needs an eigendecomposition of XtX, which is
+    # exactly what the "iterative" strategy exists to avoid.
+    if penalty_path is not None and regression_strategy == "iterative":
+        raise ValueError("penalty_path= doesn't work with the "
+                         "'iterative' regression strategy")
+
+def _report_memory(rerps, budget, log_stream):
+    log_stream.write("  peak memory use: about %0.1f MiB\n"
+                     % (budget.peak / 2.0 ** 20,))
+    for rerp in rerps:
+        rerp._set_peak_memory(budget.peak, budget.limit)
+
+def _report_timings(rerps, analysis_subspans, timer, results=None):
+    # 'results', if given, are the rERPs to attach the timings to, when
+    # they're not the same as the ones that 'analysis_subspans' refers to
+    # (see rERPSolver.fit).
+    if results is None:
+        results = rerps
+    width, nonzeros = _design_size(rerps, analysis_subspans)
+    timer.count("subspans", len(analysis_subspans))
+    timer.count("design_width", width)
+    timer.count("nonzeros", nonzeros)
+    timings = timer.finish()
+    for result in results:
+        result._set_timings(timings)
+
+def _log_stream(verbose):
+    if verbose:
+        return sys.stdout
+    else:
+        return open(os.devnull, "w")
 
 def multi_rerp_impl(dataset, rerp_requests,
                     artifact_query, artifact_type_field,
                     overlap_correction,
                     regression_strategy,
-                    verbose):
+                    verbose,
+                    workers=1,
+                    iterative_tolerance=1e-8,
+                    iterative_max_iterations=None,
+                    memory_limit=None,
+                    penalty=0,
+                    smoothness_penalty=0,
+                    penalty_path=None,
+                    checkpoint_path=None,
+                    timing_callback=None,
+                    builders=None):
+    _check_fit_options(workers, iterative_tolerance, memory_limit,
+                       penalty, smoothness_penalty, penalty_path)
+    if not rerp_requests:
+        return []
+    log_stream = _log_stream(verbose)
+    budget = _MemoryBudget(memory_limit)
+    timer = _FitTimer(dataset, timing_callback)
+    rerps, analysis_subspans = _prepare_rerps(dataset, rerp_requests,
+                                              artifact_query,
+                                              artifact_type_field,
+                                              overlap_correction,
+                                              regression_strategy,
+                                              log_stream,
+                                              builders=builders,
+                                              timer=timer,
+                                              penalized=bool(
+                                                  penalty
+                                                  or smoothness_penalty
+                                                  or penalty_path is not None))
+    regression_strategy = rerps[0].regression_strategy
+    _check_penalty_path_strategy(penalty_path, regression_strategy)
+    # _fit_* functions fill in .betas field on rerps.
+    with timer.phase("fit"):
+        if regression_strategy == "by-epoch":
+            _fit_by_epoch(dataset, analysis_subspans, rerps, budget=budget,
+                          workers=workers, penalty=penalty,
+                          smoothness_penalty=smoothness_penalty,
+                          penalty_path=penalty_path)
+        elif regression_strategy == "by-latency":
+            _fit_by_latency(dataset, analysis_subspans, rerps, budget=budget,
+                            workers=workers)
+        elif regression_strategy == "continuous":
+            _fit_continuous(dataset, analysis_subspans, rerps, log_stream,
+                            workers=workers, budget=budget, penalty=penalty,
+                            smoothness_penalty=smoothness_penalty,
+                            penalty_path=penalty_path,
+                            checkpoint_path=checkpoint_path)
+        elif regression_strategy == "iterative":
+            _fit_iterative(dataset, analysis_subspans, rerps, log_stream,
+                           iterative_tolerance, iterative_max_iterations,
+                           budget=budget, penalty=penalty,
+                           smoothness_penalty=smoothness_penalty)
+        else: # pragma: no cover
+            assert False
+    _report_memory(rerps, budget, log_stream)
+    _report_timings(rerps, analysis_subspans, timer)
+
+    for rerp in rerps:
+        assert rerp._is_complete()
+    log_stream.write("Done.\n")
+    return rerps
+
+class rERPSolver(object):
+    """A set of rERP requests whose design has already been worked out and
+    factored, ready to be fit to any number of different data sets.
+
+    The expensive part of fitting an rERP (finding the epochs and artifacts,
+    and then building and factoring the X'X matrix) depends only on the
+    events and the requests, not on the actual EEG values. So if you want to
+    fit the same requests to several different versions of the same data
+    (e.g., after re-referencing with Dataset.transform, or for a different
+    montage of the same recordings), then you can make one of these with
+    Dataset.multi_rerp_solver, and call .fit(dataset) for each. Each .fit
+    gives the same results as calling multi_rerp with the same arguments,
+    but only needs one pass through the data plus a back-substitution.
+
+    The design is tied to the events it was computed from. If .fit is
+    called on a dataset whose events are different (either because they
+    were modified, or because it's a different dataset), then we recompute
+    the epochs and artifacts (which is cheap) and check that they give the
+    same design matrix; if not, you get a ValueError and need to make a new
+    solver.
+    """
+    def __init__(self, dataset, rerp_requests,
+                 artifact_query, artifact_type_field,
+                 overlap_correction,
+                 regression_strategy,
+                 verbose,
+                 workers=1,
+                 iterative_tolerance=1e-8,
+                 iterative_max_iterations=None,
+                 memory_limit=None,
+                 penalty=0,
+                 smoothness_penalty=0):
+        _check_fit_options(workers, iterative_tolerance, memory_limit,
+                           penalty, smoothness_penalty)
+        self._rerp_requests = list(rerp_requests)
+        self._prepare_args = (artifact_query, artifact_type_field,
+                              overlap_correction, regression_strategy)
+        self._verbose = verbose
+        self._workers = workers
+        self._iterative_tolerance = iterative_tolerance
+        self._iterative_max_iterations = iterative_max_iterations
+        self._memory_limit = memory_limit
+        self._penalty = penalty
+        self._smoothness_penalty = smoothness_penalty
+        # How much memory the factorization we keep around takes
+        self._memory = 0
+        self._events = dataset._events
+        self._events_version = dataset._events._version
+        self._rerps = []
+        self._analysis_subspans = []
+        self.regression_strategy = None
+        if not self._rerp_requests:
+            return
+        log_stream = _log_stream(verbose)
+        self._rerps, self._analysis_subspans = _prepare_rerps(
+            dataset, self._rerp_requests, *(self._prepare_args + (log_stream,)),
+            penalized=bool(penalty or smoothness_penalty))
+        self._fingerprint = _design_fingerprint(self._rerps,
+                                                self._analysis_subspans)
+        self.regression_strategy = self._rerps[0].regression_strategy
+        budget = _MemoryBudget(memory_limit)
+        if self.regression_strategy == "by-epoch":
+            self._epochs = _by_epoch_epochs(self._analysis_subspans,
+                                            self._rerps)
+            def pinv_for(rerp, epochs):
+                _check_by_epoch_size(rerp, epochs)
+                # If there isn't room to keep pinv around, then .fit will
+                # have to redo the whole (streaming) QR each time. And
+                # penalized fits don't use pinv at all; their
+                # decompositions are cheap to redo each time.
+                if (penalty or smoothness_penalty
+                    or not _by_epoch_pinv_fits(rerp, epochs, budget)):
+                    return None
+                pinv = _by_epoch_pinv(rerp, epochs, budget)
+                budget.set("pinv for %s" % (rerp.name,), pinv.nbytes)
+                return pinv
+            self._pinvs = _by_epoch_map(pinv_for,
+                                        zip(self._rerps, self._epochs),
+                                        workers, budget)
+        elif self.regression_strategy == "by-latency":
+            self._epochs, self._masks = zip(
+                *_by_latency_epochs(self._analysis_subspans, self._rerps))
+            self._factors = _by_epoch_map(_by_latency_factor,
+                                          [(rerp, epochs, mask, budget)
+                                           for (rerp, epochs, mask)
+                                           in zip(self._rerps, self._epochs,
+                                                  self._masks)],
+                                          workers, budget)
+        elif self.regression_strategy == "continuous":
+            design_offsets, full_design_width = (
+                _continuous_design_layout(self._rerps))
+            XtX, _, _, self._rows = _continuous_normal_equations(dataset,
+                                                  self._analysis_subspans,
+                                                  design_offsets,
+                                                  full_design_width,
+                                                  log_stream,
+                                                  workers=workers,
+                                                  compute_XtY=False,
+                                                  budget=budget)
+            XtX = _add_penalty(XtX,
+                               _continuous_penalty(self._rerps,
+                                                   design_offsets,
+                                                   full_design_width,
+                                                   penalty,
+                                                   smoothness_penalty))
+            self._solve = _factor_blocks(
+                XtX, _continuous_blocks(XtX, self._rerps, design_offsets),
+                budget=budget, workers=workers)
+            del XtX
+            budget.clear("XtX")
+            # Standard errors only depend on the design, so we can work
+            # them out once here.
+            self._inverse_diagonal = None
+            if not (penalty or smoothness_penalty):
+                self._inverse_diagonal = _continuous_inverse_diagonal(
+                    self._solve, full_design_width, budget,
+                    _latency_expansion(self._rerps, design_offsets,
+                                       full_design_width))
+        # The "iterative" strategy never factors anything, so there's nothing
+        # to do up front; each .fit just reruns the iteration.
+        self._memory = budget.used()
+        log_stream.write("  peak memory use: about %0.1f MiB\n"
+                         % (budget.peak / 2.0 ** 20,))
+        log_stream.write("Done.\n")
+
+    def _design_for(self, dataset, log_stream, timer):
+        # Returns rerps and analysis subspans describing the design on
+        # 'dataset', which might be the ones we computed at the beginning.
+        if (dataset._events is self._events
+            and dataset._events._version == self._events_version):
+            return self._rerps, self._analysis_subspans
+        rerps, analysis_subspans = _prepare_rerps(
+            dataset, self._rerp_requests, *(self._prepare_args + (log_stream,)),
+            timer=timer,
+            penalized=bool(self._penalty or self._smoothness_penalty))
+        if (_design_fingerprint(rerps, analysis_subspans)
+            != self._fingerprint):
+            raise ValueError("this dataset's events give a different design "
+                             "than the one this solver was created for; "
+                             "you'll need to make a new solver")
+        return rerps, analysis_subspans
+
+    def fit(self, dataset):
+        """Fits our rERP requests to the data in 'dataset'.
+
+        Returns a list of rERP objects, just like Dataset.multi_rerp.
+        """
+        if not self._rerp_requests:
+            return []
+        log_stream = _log_stream(self._verbose)
+        timer = _FitTimer(dataset)
+        rerps, analysis_subspans = self._design_for(dataset, log_stream,
+                                                    timer)
+        results = [rerp._unfitted_copy(dataset.data_format)
+                   for rerp in rerps]
+        with timer.phase("fit"):
+            self._fit(dataset, rerps, analysis_subspans, results, log_stream)
+        _report_timings(rerps, analysis_subspans, timer, results)
+        for result in results:
+            assert result._is_complete()
+        log_stream.write("Done.\n")
+        return results
+
+    def _fit(self, dataset, rerps, analysis_subspans, results, log_stream):
+        budget = _MemoryBudget(self._memory_limit)
+        budget.set("solver", self._memory)
+        if self.regression_strategy == "by-epoch":
+            if rerps is self._rerps:
+                all_epochs = self._epochs
+            else:
+                all_epochs = _by_epoch_epochs(analysis_subspans, rerps)
+            def betas_for(rerp, epochs, pinv):
+                if pinv is not None:
+                    betas, residuals = _by_epoch_betas(dataset, rerp, epochs,
+                                                       pinv, budget)
+                    return [betas], None, residuals
+                else:
+                    return _by_epoch_fit_one(dataset, rerp, epochs, budget,
+                                             self._penalty,
+                                             self._smoothness_penalty, None)
+            fits = _by_epoch_map(betas_for,
+                                 zip(rerps, all_epochs, self._pinvs),
+                                 self._workers, budget)
+            for result, epochs, (all_betas, scores, residuals) in zip(
+                    results, all_epochs, fits):
+                result._set_epochs(epochs)
+                _set_penalized_betas(result, all_betas, scores,
+                                     self._penalty, self._smoothness_penalty,
+                                     None, residuals=residuals)
+        elif self.regression_strategy == "by-latency":
+            if rerps is self._rerps:
+                all_epochs = self._epochs
+            else:
+                all_epochs = [epochs for (epochs, _)
+                              in _by_latency_epochs(analysis_subspans, rerps)]
+            fits = _by_epoch_map(_by_latency_betas,
+                                 [(dataset, rerp, epochs, mask, factors,
+                                   budget)
+                                  for (rerp, epochs, mask, factors)
+                                  in zip(rerps, all_epochs, self._masks,
+                                         self._factors)],
+                                 self._workers, budget)
+            for result, (betas, _, _), residuals in zip(
+                    results, fits,
+                    _by_latency_residuals(rerps, self._masks, fits)):
+                _set_penalized_betas(result, [betas], None, 0, 0, None,
+                                     residuals=residuals)
+        elif self.regression_strategy == "continuous":
+            design_offsets, full_design_width = (
+                _continuous_design_layout(rerps))
+            XtY, YtY = _continuous_XtY(dataset, analysis_subspans,
+                                       design_offsets, full_design_width,
+                                       log_stream, budget=budget)
+            all_betas = self._solve(XtY)
+            all_residuals = [None] * len(rerps)
+            if self._inverse_diagonal is not None:
+                rss = YtY - np.sum(all_betas * XtY, axis=0)
+                all_residuals = _continuous_residuals(
+                    rerps, rss, self._rows - full_design_width,
+                    self._inverse_diagonal)
+            for result, betas, residuals in zip(
+                    results,
+                    _continuous_betas(rerps, design_offsets, all_betas),
+                    all_residuals):
+                _set_penalized_betas(result, [betas], None, self._penalty,
+                                     self._smoothness_penalty, None,
+                                     residuals=residuals)
+        elif self.regression_strategy == "iterative":
+            all_betas, iterations, residual_norm, residuals = (
+                _iterative_betas(
+                    dataset, analysis_subspans, rerps, log_stream,
+                    self._iterative_tolerance, self._iterative_max_iterations,
+                    budget=budget, penalty=self._penalty,
+                    smoothness_penalty=self._smoothness_penalty))
+            for result, betas in zip(results, all_betas):
+                _set_penalized_betas(result, [betas], None, self._penalty,
+                                     self._smoothness_penalty, None,
+                                     residuals=residuals)
+                result._set_iterative_info(iterations, residual_norm)
+        else: # pragma: no cover
+            assert False
+        _report_memory(results, budget, log_stream)
+
+# How many recspans' contributions rERPUpdater subtracts from its normal
+# equations before it starts over from scratch.
+_UPDATER_MAX_REMOVALS = 50
+
+class rERPUpdater(object):
+    """A set of rERP requests whose fit can be cheaply brought up to date
+    as recspans and events are added to (or removed from) a dataset.
+
+    Each call to .fit() returns the same rERPs that calling
+    dataset.multi_rerp with the same arguments would right now, but only
+    reads the data that's changed since the last call. This works because
+    the "continuous" strategy's normal equations (XtX, XtY) are just sums
+    over recspans. So we remember which subspans of each recspan went into
+    the sums, and on each .fit() we redo the (cheap) work of finding the
+    epochs and artifacts, and compare. Recspans that are new, or whose
+    epochs, artifacts, or design rows have changed, get their old
+    contribution subtracted and their new one added; the rest are left
+    alone. Then we re-solve, which doesn't need to look at the data at all.
+    After each .fit(), .rescanned is a sorted list of the recspans whose
+    data had to be read. (Each subtraction leaves a little rounding error
+    behind in the sums, so once enough recspans have been subtracted, the
+    next .fit() that would subtract another re-adds everything from scratch
+    instead.)
+
+    This always uses the "continuous" regression strategy (which gives the
+    same betas as "by-epoch" whenever that would apply). If the design's
+    columns change (e.g., a new level of a categorical predictor shows
+    up), or the dataset is transformed, then the next .fit() starts over
+    from scratch.
+    """
+    def __init__(self, dataset, rerp_requests,
+                 artifact_query, artifact_type_field,
+                 overlap_correction,
+                 verbose,
+                 workers=1,
+                 memory_limit=None,
+                 penalty=0,
+                 smoothness_penalty=0,
+                 penalty_path=None):
+        # (There's no iterative_tolerance here, so just check the default.)
+        _check_fit_options(workers, 1e-8, memory_limit,
+                           penalty, smoothness_penalty, penalty_path)
+        self._dataset = dataset
+        self._rerp_requests = list(rerp_requests)
+        self._prepare_args = (artifact_query, artifact_type_field,
+                              overlap_correction, "continuous")
+        self._verbose = verbose
+        self._workers = workers
+        self._memory_limit = memory_limit
+        self._penalty_args = (penalty, smoothness_penalty, penalty_path)
+        self._reset()
+
+    def _reset(self):
+        self._layout = None
+        self._data_version = None
+        # recspan_id -> (fingerprint, analysis subspans, design offsets).
+        # The subspans' epochs refer to the rerps from whichever .fit() they
+        # were found in, so we need to keep those rerps' design offsets too.
+        self._recspans = {}
+        self._totals = None
+        # How many recspans have been subtracted from self._totals
+        self._removals = 0
+        self.rescanned = []
+
+    def _accumulate(self, subspans, design_offsets, full_design_width,
+                    log_stream, budget):
+        return _continuous_normal_equations(self._dataset, subspans,
+                                            design_offsets,
+                                            full_design_width, log_stream,
+                                            workers=self._workers,
+                                            budget=budget, check_rows=False)
+
+    def fit(self):
+        """Brings the fit up to date with the dataset.
+
+        Returns a list of rERP objects, just like Dataset.multi_rerp.
+        """
+        if not self._rerp_requests:
+            return []
+        log_stream = _log_stream(self._verbose)
+        dataset = self._dataset
+        timer = _FitTimer(dataset)
+        rerps, analysis_subspans = _prepare_rerps(
+            dataset, self._rerp_requests, *(self._prepare_args + (log_stream,)),
+            timer=timer)
+        with timer.phase("fit"):
+            self._fit(rerps, analysis_subspans, log_stream)
+        _report_timings(rerps, analysis_subspans, timer)
+        for rerp in rerps:
+            assert rerp._is_complete()
+        log_stream.write("Done.\n")
+        return rerps
+
+    def _fit(self, rerps, analysis_subspans, log_stream):
+        dataset = self._dataset
+        design_offsets, full_design_width = _continuous_design_layout(rerps)
+        layout = [(rerp.name, rerp.start_tick, rerp.stop_tick,
+                   list(rerp.design_info.column_names),
+                   _latency_width(rerp)) for rerp in rerps]
+        if (layout != self._layout
+            or dataset._data_version != self._data_version):
+            self._reset()
+        by_recspan = _subspans_by_recspan(analysis_subspans)
+        fingerprints = dict([(recspan_id, _design_fingerprint(rerps, subspans))
+                             for recspan_id, subspans in by_recspan.items()])
+        stale = [recspan_id for recspan_id in self._recspans
+                 if (self._recspans[recspan_id][0]
+                     != fingerprints.get(recspan_id))]
+        if self._removals + len(stale) > _UPDATER_MAX_REMOVALS:
+            # Subtracting recspans from the sums cancels out most of their
+            # bits, and the rounding error adds up, so every so often we
+            # re-add everything instead.
+            log_stream.write("  starting over after %s removals\n"
+                             % (self._removals,))
+            self._reset()
+            stale = []
+        fresh = [recspan_id for recspan_id in by_recspan
+                 if (recspan_id not in self._recspans
+                     or recspan_id in stale)]
+        log_stream.write("  rescanning %s of %s recspans\n"
+                         % (len(set(stale + fresh)), len(dataset)))
+        budget = _MemoryBudget(self._memory_limit)
+        if self._totals is not None:
+            budget.set("updater", _normal_equations_nbytes(self._totals))
+        if stale:
+            old_subspans = []
+            old_design_offsets = {}
+            for recspan_id in sorted(stale):
+                _, subspans, offsets = self._recspans.pop(recspan_id)
+                old_subspans += subspans
+                old_design_offsets.update(offsets)
+            self._removals += len(stale)
+            self._totals = _update_normal_equations(
+                self._totals,
+                self._accumulate(old_subspans, old_design_offsets,
+                                 full_design_width, log_stream, budget),
+                -1)
+        if fresh or self._totals is None:
+            new_subspans = []
+            for recspan_id in sorted(fresh):
+                new_subspans += by_recspan[recspan_id]
+                self._recspans[recspan_id] = (fingerprints[recspan_id],
+                                              by_recspan[recspan_id],
+                                              design_offsets)
+            delta = self._accumulate(new_subspans, design_offsets,
+                                     full_design_width, log_stream, budget)
+            if self._totals is None:
+                self._totals = delta
+            else:
+                self._totals = _update_normal_equations(self._totals, delta,
+                                                        1)
+        self._layout = layout
+        self._data_version = dataset._data_version
+        self.rescanned = sorted(set(stale + fresh))
+        XtX, XtY, YtY, rows = self._totals
+        _check_rows(rows, full_design_width)
+        budget.set("updater", _normal_equations_nbytes(self._totals))
+        _solve_continuous(rerps, design_offsets, full_design_width,
+                          XtX, XtY, YtY, rows, budget,
+                          *self._penalty_args, workers=self._workers)
+        _report_memory(rerps, budget, log_stream)
+
+class rERPGroup(object):
+    """The results of fitting one rERP request to several datasets (e.g.,
+    one per subject), as returned by multi_dataset_rerp.
+
+    .betas is an ndarray with shape
+      (num_datasets, num_predictors, num_latencies, num_channels)
+    i.e., each .betas[i] holds the values that would be in rERP.betas for
+    datasets[i]. .grand_average is their mean over datasets, as a Panel
+    laid out just like rERP.betas. Every dataset's fit uses the same design
+    columns (see multi_dataset_rerp), given by .design_info. .timings is a
+    list of each dataset's FitTimings (which cover all the requests, since
+    they're fit together).
+    """
+    def __init__(self, request, data_format, design_info, start_tick,
+                 stop_tick, betas, timings):
+        self.name = str(request.name)
+        self.event_query = str(request.event_query)
+        self.start_time = float(request.start_time)
+        self.stop_time = float(request.stop_time)
+        self.formula = str(request.formula)
+        self.data_format = data_format
+        self.design_info = design_info
+        self.start_tick = start_tick
+        self.stop_tick = stop_tick
+        self.ticks = stop_tick - start_tick
+        self.num_datasets = betas.shape[0]
+        self.betas = betas
+        self.timings = timings
+        tick_array = np.arange(start_tick, stop_tick)
+        self.grand_average = pandas.Panel(
+            betas.mean(axis=0),
+            items=design_info.column_names,
+            major_axis=data_format.ticks_to_ms(tick_array),
+            minor_axis=data_format.channel_names)
+
+    __repr__ = repr_pretty_delegate
+    def _repr_pretty_(self, p, cycle):
+        assert not cycle
+        return repr_pretty_impl(p, self, [],
+                                [("name", self.name),
+                                 ("num_datasets", self.num_datasets)])
+
+def multi_dataset_rerp(datasets, rerp_requests,
+                       artifact_query="has _ARTIFACT_TYPE",
+                       artifact_type_field="_ARTIFACT_TYPE",
+                       overlap_correction=True,
+                       regression_strategy="auto",
+                       verbose=True,
+                       workers=1,
+                       iterative_tolerance=1e-8,
+                       iterative_max_iterations=None,
+                       memory_limit=None,
+                       penalty=0,
+                       smoothness_penalty=0,
+                       penalty_path=None,
+                       checkpoint_path=None,
+                       timing_callback=None):
+    """Fits the same rERP requests to each of several datasets.
+
+    This gives the same betas as calling datasets[i].multi_rerp for each
+    dataset. The requests' formulas are only parsed once, but each
+    dataset's design is built from that dataset's own events, so stateful
+    transforms like center(x) work exactly as they would for a fit to that
+    dataset alone. Since the betas are stacked, every dataset's design must
+    end up with the same columns: a ValueError is raised (before any
+    fitting) if, e.g., some level of a categorical predictor is missing
+    from one of the datasets. (Use C(x, levels=[...]) to fix the levels.)
+
+    With workers > 1, that many datasets are fit at once in worker
+    processes (on Unix only). memory_limit, if given, is split between
+    them. checkpoint_path, if given, is used as a prefix: datasets[i]
+    checkpoints to checkpoint_path + ".%d" % (i,). The other arguments are
+    as for Dataset.multi_rerp, and apply to each dataset's fit separately
+    (so e.g. each dataset might end up using a different regression
+    strategy, or with penalty_path, a different penalty). In particular,
+    timing_callback is called for each phase of each dataset's fit, from
+    the worker processes if workers > 1.
+
+    Returns a list of rERPGroup objects, one per request.
+    """
+    _check_fit_options(workers, iterative_tolerance, memory_limit,
+                       penalty, smoothness_penalty, penalty_path)
+    datasets = list(datasets)
+    rerp_requests = list(rerp_requests)
+    if not datasets:
+        raise ValueError("need at least one dataset")
+    data_format = datasets[0].data_format
+    for dataset in datasets[1:]:
+        if dataset.data_format != data_format:
+            raise ValueError("all datasets must have the same data format")
     if not rerp_requests:
         return []
     _check_unique_names(rerp_requests)
+    log_stream = _log_stream(verbose)
+    log_stream.write("Compiling %s rERP designs\n" % (len(rerp_requests),))
+    all_builders = _compile_designs(datasets, rerp_requests)
+    fit_kwargs = dict(artifact_query=artifact_query,
+                      artifact_type_field=artifact_type_field,
+                      overlap_correction=overlap_correction,
+                      regression_strategy=regression_strategy,
+                      verbose=False,
+                      iterative_tolerance=iterative_tolerance,
+                      iterative_max_iterations=iterative_max_iterations,
+                      memory_limit=memory_limit,
+                      penalty=penalty,
+                      smoothness_penalty=smoothness_penalty,
+                      penalty_path=penalty_path,
+                      checkpoint_path=checkpoint_path,
+                      timing_callback=timing_callback)
+    log_stream.write("Fitting %s datasets\n" % (len(datasets),))
+    all_betas = None
+    all_timings = []
+    with ProgressBar(len(datasets), stream=log_stream) as progress_bar:
+        for i, (dataset_betas, timings) in enumerate(
+                _fit_datasets(datasets, rerp_requests, all_builders,
+                              fit_kwargs, workers)):
+            all_timings.append(timings)
+            if all_betas is None:
+                all_betas = [np.empty((len(datasets),) + betas.shape)
+                             for betas in dataset_betas]
+            for stacked, betas in zip(all_betas, dataset_betas):
+                stacked[i] = betas
+            progress_bar.increment()
+    groups = []
+    for request, builder, betas in zip(rerp_requests, all_builders[0],
+                                       all_betas):
+        start_tick, stop_tick = data_format.ms_span_to_ticks(
+            request.start_time, request.stop_time)
+        groups.append(rERPGroup(request, data_format, builder.design_info,
+                                start_tick, stop_tick, betas, all_timings))
+    log_stream.write("Done.\n")
+    return groups
 
-    if verbose:
-        log_stream = sys.stdout
-    else:
-        log_stream = open(os.devnull, "w")
+################################################################
+# Implementation
+################################################################
+
+def _compile_designs(datasets, rerp_requests):
+    # Returns a list with one entry for each dataset, giving a patsy
+    # DesignMatrixBuilder for each request's formula. Each formula is only
+    # parsed once, but each dataset's builders are fit to that dataset's own
+    # events, so stateful transforms like center(x) come out the same as in
+    # a fit to that dataset alone. Raises ValueError if the datasets'
+    # designs for a request don't have the same columns.
+    descs = []
+    for rerp_request in rerp_requests:
+        desc = ModelDesc.from_formula(rerp_request.formula,
+                                      rerp_request.eval_env)
+        if desc.lhs_termlist:
+            raise ValueError("Formula cannot have a left-hand side")
+        descs.append(desc)
+    all_builders = []
+    for dataset in datasets:
+        builders = []
+        for rerp_request, desc in zip(rerp_requests, descs):
+            events = dataset.events(rerp_request.event_query)
+            if not events:
+                raise ValueError("No events found for rERP %r"
+                                 % (rerp_request.name,))
+            env = _FormulaEnv(events)
+            builder, = design_matrix_builders([desc.rhs_termlist],
+                                              lambda: iter([env]))
+            builders.append(builder)
+        all_builders.append(builders)
+    for builders in all_builders[1:]:
+        for rerp_request, first, builder in zip(rerp_requests,
+                                                all_builders[0], builders):
+            first_columns = first.design_info.column_names
+            columns = builder.design_info.column_names
+            if columns != first_columns:
+                raise ValueError("rERP %r has predictors %r in one dataset, "
+                                 "but %r in another (maybe some dataset "
+                                 "is missing a level of a categorical "
+                                 "predictor? see C(..., levels=...))"
+                                 % (rerp_request.name, first_columns,
+                                    columns))
+    return all_builders
+
+# Like _FORKED_FIT_STATE, but for multi_dataset_rerp's worker processes.
+_FORKED_GROUP_STATE = None
+
+def _fit_dataset(i):
+    try:
+        state = _FORKED_GROUP_STATE
+        rerps = multi_rerp_impl(state["datasets"][i], state["rerp_requests"],
+                                **_dataset_fit_kwargs(state["fit_kwargs"],
+                                                      state["all_builders"],
+                                                      i))
+        return [rerp.betas.values for rerp in rerps], rerps[0].timings
+    except KeyboardInterrupt:
+        return None
+
+def _dataset_fit_kwargs(fit_kwargs, all_builders, i):
+    # Each dataset has its own designs (see _compile_designs), and needs its
+    # own checkpoint file
+    fit_kwargs = dict(fit_kwargs)
+    fit_kwargs["builders"] = all_builders[i]
+    if fit_kwargs["checkpoint_path"] is not None:
+        fit_kwargs["checkpoint_path"] = "%s.%d" % (
+            fit_kwargs["checkpoint_path"], i)
+    return fit_kwargs
+
+def _fit_datasets(datasets, rerp_requests, all_builders, fit_kwargs,
+                  workers):
+    # Yields the betas for each dataset, in order, as a list with one
+    # (predictors x latencies x channels) array per request, together with
+    # the FitTimings for that dataset's fit.
+    global _FORKED_GROUP_STATE
+    workers = min(workers, len(datasets))
+    if workers == 1 or os.name != "posix":
+        for i, dataset in enumerate(datasets):
+            rerps = multi_rerp_impl(dataset, rerp_requests,
+                                    **_dataset_fit_kwargs(fit_kwargs,
+                                                          all_builders, i))
+            yield [rerp.betas.values for rerp in rerps], rerps[0].timings
+        return
+    import multiprocessing
+    fit_kwargs = dict(fit_kwargs)
+    if fit_kwargs["memory_limit"] is not None:
+        fit_kwargs["memory_limit"] = max(1,
+                                         fit_kwargs["memory_limit"] // workers)
+    _FORKED_GROUP_STATE = {"datasets": datasets,
+                           "rerp_requests": rerp_requests,
+                           "all_builders": all_builders,
+                           "fit_kwargs": fit_kwargs,
+                           }
+    try:
+        pool = multiprocessing.Pool(workers)
+    finally:
+        _FORKED_GROUP_STATE = None
+    try:
+        for result in pool.imap(_fit_dataset, xrange(len(datasets))):
+            if result is None:
+                # See _accumulate_continuous_batch
+                raise KeyboardInterrupt
+            yield result
+    finally:
+        pool.terminate()
+
+# How many subspans _prepare_rerps generates between switching over to
+# counting them.
+_SUBSPAN_BATCH = 1000
+
+def _prepare_rerps(dataset, rerp_requests,
+                   artifact_query, artifact_type_field,
+                   overlap_correction, regression_strategy,
+                   log_stream, builders=None, timer=None, penalized=False):
+    # Does everything up to (but not including) the actual regression:
+    # allocates the rERP objects, and works out which data goes into the
+    # regression. Returns the rERPs and the list of analysis subspans.
+    # 'builders', if given, are the precompiled designs from
+    # _compile_designs. 'timer', if given, is a _FitTimer to record each
+    # step in. 'penalized' says whether the fit will have a penalty (which
+    # rules out the "by-latency" strategy).
+    _check_unique_names(rerp_requests)
+    if builders is None:
+        builders = [None] * len(rerp_requests)
+    if timer is None:
+        timer = _FitTimer(dataset)
 
     ## Find all the requested epochs and artifacts
     log_stream.write("Locating epochs and artifacts\n")
     spans = []
     # And allocate the rERP objects that we will eventually return.
     rerps = []
-    for i in xrange(len(rerp_requests)):
-        rerp, epoch_spans = _epoch_info_and_spans(dataset, rerp_requests, i)
-        rerps.append(rerp)
-        spans.extend(epoch_spans)
-    spans.extend(_artifact_spans(dataset, artifact_query, artifact_type_field))
-    # Small optimization: only check for all_or_nothing artifacts
-    if any(rerp_request.all_or_nothing for rerp_request in rerp_requests):
-        _propagate_all_or_nothing(spans, overlap_correction)
+    with timer.phase("epochs"):
+        for i in xrange(len(rerp_requests)):
+            rerp, epoch_spans = _epoch_info_and_spans(dataset, rerp_requests,
+                                                      i, builder=builders[i])
+            rerps.append(rerp)
+            spans.extend(epoch_spans)
+    with timer.phase("artifacts"):
+        spans.extend(_artifact_spans(dataset, artifact_query,
+                                     artifact_type_field))
+    with timer.phase("all_or_nothing"):
+        # Small optimization: only check for all_or_nothing artifacts
+        if any(rerp_request.all_or_nothing
+               for rerp_request in rerp_requests):
+            _propagate_all_or_nothing(spans, overlap_correction)
 
     ## Find the good data, gather artifact/overlap/good data statistics
+    # The subspans are generated and counted a batch at a time, so the ones
+    # with artifacts never all have to be in memory at once, while we can
+    # still time the two steps separately.
     accountant = _Accountant(rerps)
     analysis_subspans = []
-    for subspan in _epoch_subspans(spans, overlap_correction):
-        accountant.count(subspan.stop[1] - subspan.start[1],
-                         subspan.epochs, subspan.artifacts)
-        if not subspan.artifacts:
-            analysis_subspans.append(subspan)
-    accountant.save()
-
-    ## Do the regression
-    regression_strategy = _choose_strategy(regression_strategy,
-                                           rerps[0].global_stats)
+    with timer.interleaved_phases() as phase:
+        subspans = _epoch_subspans(spans, overlap_correction)
+        while True:
+            with phase("subspans"):
+                batch = list(itertools.islice(subspans, _SUBSPAN_BATCH))
+            if not batch:
+                break
+            with phase("accounting"):
+                for subspan in batch:
+                    accountant.count(subspan.stop[1] - subspan.start[1],
+                                     subspan.epochs, subspan.artifacts)
+                    if not subspan.artifacts:
+                        analysis_subspans.append(subspan)
+        with phase("accounting"):
+            accountant.save()
+
+    ## Pick the regression strategy
+    regression_strategy = _choose_strategy(
+        regression_strategy, rerps[0].global_stats,
+        latency_basis=any(rerp.latency_basis is not None for rerp in rerps),
+        penalized=penalized)
     for rerp in rerps:
         rerp._set_fit_info(regression_strategy, overlap_correction)
     if overlap_correction:
@@ -138,23 +963,29 @@ def multi_rerp_impl(dataset, rerp_requests,
                         total_predictors,
                         rerps[0].global_stats.ticks.accepted,
                         regression_strategy, overlap_msg))
-    # _fit_* functions fill in .betas field on rerps.
-    if regression_strategy == "by-epoch":
-        _fit_by_epoch(dataset, analysis_subspans, rerps)
-    elif regression_strategy == "continuous":
-        all_betas = _fit_continuous(dataset, analysis_subspans, rerps,
-                                    log_stream)
-    else: # pragma: no cover
-        assert False
+    return rerps, analysis_subspans
 
+def _design_fingerprint(rerps, analysis_subspans):
+    # A hash of everything that goes into the design matrix, so that we can
+    # check whether two designs are the same without keeping both around.
+    h = hashlib.sha1()
+    rerp_indices = dict([(rerp, i) for (i, rerp) in enumerate(rerps)])
     for rerp in rerps:
-        assert rerp._is_complete()
-    log_stream.write("Done.\n")
-    return rerps
-
-################################################################
-# Implementation
-################################################################
+        h.update(repr((rerp.name, rerp.start_tick, rerp.stop_tick,
+                       list(rerp.design_info.column_names),
+                       rerp.regression_strategy, rerp.overlap_correction)))
+        if rerp.latency_basis is not None:
+            h.update(rerp.latency_basis.tostring())
+    for subspan in analysis_subspans:
+        h.update(repr((subspan.start, subspan.stop)))
+        epoch_keys = []
+        for epoch in subspan.epochs:
+            design_row = np.asarray(epoch.design_row, dtype=float)
+            epoch_keys.append((rerp_indices[epoch.rerp],
+                               epoch.start_tick, epoch.stop_tick,
+                               design_row.tostring()))
+        h.update(repr(sorted(epoch_keys)))
+    return h.hexdigest()
 
 # Types
 
@@ -213,16 +1044,43 @@ def _artifact_spans(dataset, artifact_query, artifact_type_field):
         yield _DataSpan(neg_inf, zero, None, "_NO_RECORDING")
         yield _DataSpan(end, pos_inf, None, "_NO_RECORDING")
 
-    # Now lookup the actual artifacts recorded in the events structure.
-    for artifact_event in dataset.events_query(artifact_query):
-        artifact_type = artifact_event.get(artifact_type_field, "_UNKNOWN")
+    # Now lookup the actual artifacts recorded in the events structure. There
+    # may be tens of thousands of these (e.g. from automatic detectors), so we
+    # pull them all out with a single query instead of poking at each event.
+    query = dataset.events_query(artifact_query)
+    recspan_ids, start_ticks, stop_ticks, artifact_types = \
+      query._spans_and_values(artifact_type_field, "_UNKNOWN")
+    for artifact_type in artifact_types:
         if not isinstance(artifact_type, basestring):
             raise TypeError("artifact type must be a string, not %r"
                             % (artifact_type,))
-        yield _DataSpan((artifact_event.recspan_id, artifact_event.start_tick),
-                        (artifact_event.recspan_id, artifact_event.stop_tick),
-                        None,
-                        artifact_type)
+    # Overlapping (or abutting) artifacts of the same type are redundant, and
+    # just create extra subspans for everything downstream to chew through, so
+    # merge them.
+    order = sorted(xrange(len(artifact_types)),
+                   key=lambda i: (recspan_ids[i], artifact_types[i],
+                                  start_ticks[i]))
+    current = None
+    for i in order:
+        key = (recspan_ids[i], artifact_types[i])
+        if (current is not None
+            and current[0] == key
+            and start_ticks[i] <= current[2]):
+            current[2] = max(current[2], stop_ticks[i])
+        else:
+            if current is not None:
+                yield _merged_artifact_span(*current)
+            current = [key, start_ticks[i], stop_ticks[i]]
+    if current is not None:
+        yield _merged_artifact_span(*current)
+
+def _merged_artifact_span(key, start_tick, stop_tick):
+    recspan_id, artifact_type = key
+    recspan_id = int(recspan_id)
+    return _DataSpan((recspan_id, int(start_tick)),
+                     (recspan_id, int(stop_tick)),
+                     None,
+                     artifact_type)
 
 def test__artifact_spans():
     from rerpy.test_data import mock_dataset
@@ -256,6 +1114,32 @@ def test__artifact_spans():
     assert_raises(TypeError,
                   list, _artifact_spans(ds, "has _ARTIFACT_TYPE", "number"))
 
+    # Overlapping and abutting artifacts of the same type get merged;
+    # different types and different recspans are kept separate.
+    ds = mock_dataset(num_recspans=2, ticks_per_recspan=100)
+    for recspan_id, start, stop, artifact_type in [
+        (0, 5, 10, "a"),
+        (0, 8, 12, "a"),
+        (0, 6, 7, "a"),
+        (0, 12, 15, "a"),
+        (0, 16, 20, "a"),
+        (0, 9, 30, "b"),
+        (1, 0, 10, "a"),
+        ]:
+        ds.add_event(recspan_id, start, stop,
+                     {"_ARTIFACT_TYPE": artifact_type})
+    spans = list(_artifact_spans(ds, "has _ARTIFACT_TYPE", "_ARTIFACT_TYPE"))
+    assert sorted(spans) == sorted([
+            _DataSpan((0, -2**31), (0, 0), None, "_NO_RECORDING"),
+            _DataSpan((0, 100), (0, 2**31), None, "_NO_RECORDING"),
+            _DataSpan((1, -2**31), (1, 0), None, "_NO_RECORDING"),
+            _DataSpan((1, 100), (1, 2**31), None, "_NO_RECORDING"),
+            _DataSpan((0, 5), (0, 15), None, "a"),
+            _DataSpan((0, 16), (0, 20), None, "a"),
+            _DataSpan((0, 9), (0, 30), None, "b"),
+            _DataSpan((1, 0), (1, 10), None, "a"),
+            ])
+
 ################################################################
 
 # A patsy "factor" that just returns arange(n); we use this as the LHS of our
@@ -336,7 +1220,7 @@ def test__FormulaEnv():
                                   ["s1", "s1", "s2"])
     assert_raises(KeyError, env["_RECSPAN_INFO"].__getattr__, "subject_name")
 
-def _rerp_design(formula, events, eval_env):
+def _rerp_design(formula, events, eval_env, builder=None):
     # Tricky bit: the specifies a RHS-only formula, but really we have an
     # implicit LHS (determined by the event_query). This makes things
     # complicated when it comes to e.g. keeping track of which items survived
@@ -349,7 +1233,14 @@ def _rerp_design(formula, events, eval_env):
     if desc.lhs_termlist:
         raise ValueError("Formula cannot have a left-hand side")
     desc.lhs_termlist = [Term([_RangeFactor(len(events))])]
-    fake_lhs, design = dmatrices(desc, _FormulaEnv(events))
+    env = _FormulaEnv(events)
+    if builder is not None:
+        # The RHS was already worked out (see _compile_designs), so we only
+        # need a builder for our placeholder LHS.
+        lhs_builder, = design_matrix_builders([desc.lhs_termlist],
+                                              lambda: iter([env]))
+        desc = (lhs_builder, builder)
+    fake_lhs, design = dmatrices(desc, env)
     surviving_event_idxes = np.asarray(fake_lhs, dtype=int).ravel()
     design_row_idxes = np.empty(len(events), dtype=int)
     design_row_idxes.fill(-1)
@@ -384,7 +1275,21 @@ def test__rerp_design():
     from nose.tools import assert_raises
     assert_raises(ValueError, _rerp_design, "a ~ b", ds.events(), eval_env)
 
-def _epoch_info_and_spans(dataset, rerp_requests, i):
+    # A precompiled builder gives the same design, even on events that on
+    # their own would have given different columns
+    (builder,), = _compile_designs([ds], [rERPRequest("has a", 0, 10,
+                                                       "a + b + c",
+                                                       eval_env=eval_env)])
+    got, got_row_idxes = _rerp_design("a + b + c", ds.events(), eval_env,
+                                      builder=builder)
+    assert_array_equal(got, np.asarray(design)[:, :4])
+    assert_array_equal(got_row_idxes, design_row_idxes)
+    blue = ds.events({"c": "blue"})
+    got, _ = _rerp_design("a + b + c", blue, eval_env, builder=builder)
+    assert got.design_info.column_names == design.design_info.column_names[:4]
+    assert_array_equal(got, [[1, 1, 0, 20]])
+
+def _epoch_info_and_spans(dataset, rerp_requests, i, builder=None):
     rerp_request = rerp_requests[i]
     spans = []
     data_format = dataset.data_format
@@ -406,7 +1311,8 @@ def _epoch_info_and_spans(dataset, rerp_requests, i):
         raise ValueError("No events found for rERP %r" % (rerp_request.name,))
     design, design_row_idxes = _rerp_design(rerp_request.formula,
                                             events,
-                                            rerp_request.eval_env)
+                                            rerp_request.eval_env,
+                                            builder=builder)
     rerp = rERP(rerp_request, dataset.data_format, design.design_info,
                 start_tick, stop_tick, i, len(rerp_requests))
     if rerp_request.bad_event_query is None:
@@ -686,33 +1592,102 @@ def test__epoch_subspans():
 
 ################################################################
 
+# A minimal union-find (disjoint-set forest) over arbitrary hashable objects
+# (compared with ==, like dict keys), with path halving and union-by-size, so
+# any sequence of operations runs in near-linear time.
+class _DisjointSets(object):
+    def __init__(self):
+        self._parent = {}
+        self._size = {}
+
+    def add(self, obj):
+        if obj not in self._parent:
+            self._parent[obj] = obj
+            self._size[obj] = 1
+
+    def find(self, obj):
+        parent = self._parent
+        while parent[obj] != obj:
+            parent[obj] = parent[parent[obj]]
+            obj = parent[obj]
+        return obj
+
+    def union(self, a, b):
+        a = self.find(a)
+        b = self.find(b)
+        if a == b:
+            return
+        if self._size[a] < self._size[b]:
+            a, b = b, a
+        self._parent[b] = a
+        self._size[a] += self._size[b]
+
+    def __iter__(self):
+        return iter(self._parent)
+
+def test__DisjointSets():
+    objs = [object() for _ in xrange(6)]
+    ds = _DisjointSets()
+    for obj in objs:
+        ds.add(obj)
+    ds.add(objs[0])
+    ds.union(objs[0], objs[1])
+    ds.union(objs[2], objs[1])
+    ds.union(objs[3], objs[4])
+    ds.union(objs[4], objs[3])
+    assert ds.find(objs[0]) is ds.find(objs[1]) is ds.find(objs[2])
+    assert ds.find(objs[3]) is ds.find(objs[4])
+    assert ds.find(objs[0]) is not ds.find(objs[3])
+    assert ds.find(objs[5]) is objs[5]
+    assert set(ds) == set(objs)
+    # Items are compared by ==, like dict keys, not by identity
+    ds = _DisjointSets()
+    for i in xrange(4):
+        ds.add(("item", 1000 + i))
+    ds.union(("item", 1000), ("item", 1001))
+    ds.union(("item", 1001), ("item", 1002))
+    assert ds.find(("item", 1000)) == ds.find(("item", 1002))
+    assert ds.find(("item", 1003)) == ("item", 1003)
+    assert ds.find(("item", 1000)) != ds.find(("item", 1003))
+    assert len(list(ds)) == 4
+
 def _propagate_all_or_nothing(spans, overlap_correction):
     # We need to find all epochs that have some artifact on them and
     # all_or_nothing requested, and mark the entire epoch as having an
     # artifact. and then we  need to find any overlapping epochs that
     # themselves have all_or_nothing requested, and repeat...
-    # Both of these data structures will contain only epochs that have
-    # all_or_nothing requested.
-    overlap_graph = {}
-    epochs_needing_artifact = set()
+    #
+    # This spreading is transitive, so rather than building the full overlap
+    # graph (which is quadratic in the number of simultaneously overlapping
+    # epochs), we just compute its connected components with union-find:
+    # within each subspan it's enough to link each relevant epoch to its
+    # neighbour. Then every component that contains an epoch touching an
+    # artifact gets knocked out wholesale.
+    #
+    # Only epochs that have all_or_nothing requested, and that don't already
+    # have some intrinsic artifact, participate. (An epoch with an intrinsic
+    # artifact never gets an extra _ALL_OR_NOTHING artifact, so it never
+    # passes the infection along either -- though when overlap correction is
+    # enabled, its intrinsic artifacts show up as regular artifacts in every
+    # subspan it covers, so its neighbours get hit directly.)
+    components = _DisjointSets()
+    epochs_needing_artifact = []
     for subspan in _epoch_subspans(spans, overlap_correction):
         relevant_epochs = [epoch for epoch in subspan.epochs
-                           if epoch.rerp.all_or_nothing]
-        for epoch_a in relevant_epochs:
-            for epoch_b in relevant_epochs:
-                if epoch_a is not epoch_b:
-                    overlap_graph.setdefault(epoch_a, set()).add(epoch_b)
+                           if epoch.rerp.all_or_nothing
+                           and not epoch.intrinsic_artifacts]
+        for epoch in relevant_epochs:
+            components.add(epoch)
+        for epoch_a, epoch_b in zip(relevant_epochs, relevant_epochs[1:]):
+            components.union(epoch_a, epoch_b)
         if subspan.artifacts:
-            for epoch in relevant_epochs:
-                if not epoch.intrinsic_artifacts:
-                    epochs_needing_artifact.add(epoch)
-    while epochs_needing_artifact:
-        epoch = epochs_needing_artifact.pop()
-        assert not epoch.intrinsic_artifacts
-        epoch.intrinsic_artifacts.append("_ALL_OR_NOTHING")
-        for overlapped_epoch in overlap_graph.get(epoch, []):
-            if not overlapped_epoch.intrinsic_artifacts:
-                epochs_needing_artifact.add(overlapped_epoch)
+            epochs_needing_artifact.extend(relevant_epochs)
+    doomed_components = set([components.find(epoch)
+                             for epoch in epochs_needing_artifact])
+    for epoch in components:
+        if components.find(epoch) in doomed_components:
+            assert not epoch.intrinsic_artifacts
+            epoch.intrinsic_artifacts.append("_ALL_OR_NOTHING")
 
 def test__propagate_all_or_nothing():
     # convenience function for making mock epoch spans
@@ -784,6 +1759,16 @@ def test__propagate_all_or_nothing():
              e(250, 400, True, True),
              a(10, 11),
              ])
+    # Disconnected clusters of overlapping epochs are independent, and many
+    # simultaneously-overlapping epochs all go down together
+    t(True, [e(0, 100, True, False),
+             e(0, 100, True, False),
+             e(10, 90, True, False),
+             e(20, 150, True, False),
+             e(200, 300, True, True),
+             e(210, 300, True, True),
+             e(250, 400, True, True),
+             a(140, 141)])
 
 ################################################################
 
@@ -890,80 +1875,175 @@ class RejectionOverlapStats(object):
         assert not cycle
         p.text(indent(repr(self), p.indentation, indent_first=False))
 
+# Sums weights into integer bins. (np.bincount always accumulates in float64,
+# which is exact for any tick count we will ever see -- up to 2**53 -- so we
+# just round-trip back to integers at the end.)
+def _int_bincount(bins, weights, minlength):
+    if len(bins) == 0:
+        return np.zeros(minlength, dtype=np.int64)
+    sums = np.bincount(bins, weights=weights, minlength=minlength)
+    return np.round(sums).astype(np.int64)
+
+# The _Accountant is fed one subspan at a time, but doing the actual
+# bookkeeping one subspan at a time (lots of little dict updates per bucket
+# per artifact) turns out to cost more than reading the data for big
+# analyses. So count() just records a few integers per subspan into flat
+# arrays, and save() computes all the statistics in one vectorized pass:
+#
+#   - per subspan: its length in ticks, the number of epochs it covers, and a
+#     bitmask giving the set of artifacts that cover it
+#   - per (subspan, epoch) pair: which subspan and which epoch
+#   - per epoch: which rerp it belongs to
+#
+# The "buckets" that statistics get added to are numbered 0..len(rerps)-1 for
+# the per-rerp buckets, and len(rerps) for the global bucket.
 class _Accountant(object):
     def __init__(self, rerps):
         self._rerps = rerps
         self._global_bucket = RejectionOverlapStats()
         self._rerp_buckets = [RejectionOverlapStats() for _ in rerps]
 
-        self._epochs_with_artifacts = set()
-        self._epochs_with_data = set()
+        self._ticks = []
+        self._epoch_counts = []
+        self._artifact_masks = []
+        self._artifact_bits = {}
+        self._pair_subspans = []
+        self._pair_epochs = []
+        self._epoch_indices = {}
+        self._epoch_rerps = []
 
     def count(self, ticks, epochs, artifacts):
         if not epochs:
             return
-        if len(epochs) == 1:
-            no_overlap_ticks = ticks
-        else:
-            no_overlap_ticks = 0
-        bucket_events = {
-            self._global_bucket: len(epochs),
-            }
+        subspan_idx = len(self._ticks)
+        self._ticks.append(ticks)
+        self._epoch_counts.append(len(epochs))
+        # Special case: _ALL_OR_NOTHING artifacts should logically be seen
+        # as covering over all the parts of an epoch that aren't
+        # *otherwise* covered by a real artifact. So for accounting
+        # purposes, when an _ALL_OR_NOTHING artifact overlaps with a real
+        # artifact, we give the real artifact full credit.
+        if len(artifacts) >= 2 and "_ALL_OR_NOTHING" in artifacts:
+            artifacts = set(artifacts)
+            artifacts.remove("_ALL_OR_NOTHING")
+        mask = 0
+        for artifact in artifacts:
+            bit = self._artifact_bits.setdefault(artifact,
+                                                 len(self._artifact_bits))
+            mask |= 1 << bit
+        self._artifact_masks.append(mask)
         for epoch in epochs:
-            bucket = self._rerp_buckets[epoch.rerp.this_rerp_index]
-            bucket_events.setdefault(bucket, 0)
-            bucket_events[bucket] += 1
-
-        if artifacts:
-            self._epochs_with_artifacts.update(epochs)
-            # Special case: _ALL_OR_NOTHING artifacts should logically be seen
-            # as covering over all the parts of an epoch that aren't
-            # *otherwise* covered by a real artifact. So for accounting
-            # purposes, when an _ALL_OR_NOTHING artifact overlaps with a real
-            # artifact, we give the real artifact full credit.
-            if len(artifacts) >= 2 and "_ALL_OR_NOTHING" in artifacts:
-                artifacts = set(artifacts)
-                artifacts.remove("_ALL_OR_NOTHING")
-            is_unique = (len(artifacts) == 1)
-            def add_artifact(artifact, point_rej_info, points):
-                point_rej_info.artifacts.setdefault(artifact,
-                                                    {"affected": 0,
-                                                     "unique": 0})
-                point_rej_info.artifacts[artifact]["affected"] += points
-                if is_unique:
-                    point_rej_info.artifacts[artifact]["unique"] += points
-            for bucket, events in bucket_events.items():
-                bucket.ticks.rejected += ticks
-                bucket.event_ticks.rejected += ticks * events
-                bucket.no_overlap_ticks.rejected += no_overlap_ticks
-            for artifact in artifacts:
-                for bucket, events in bucket_events.items():
-                    add_artifact(artifact, bucket.ticks, ticks)
-                    add_artifact(artifact, bucket.event_ticks, ticks * events)
-                    if len(epochs) == 1:
-                        add_artifact(artifact, bucket.no_overlap_ticks, ticks)
-        else:
-            self._epochs_with_data.update(epochs)
-            for bucket, events in bucket_events.items():
-                bucket.ticks.accepted += ticks
-                bucket.event_ticks.accepted += ticks * events
-                bucket.no_overlap_ticks.accepted += no_overlap_ticks
-
-    def _set_epoch_stats(self, bucket, all_epochs, rerp):
-        for epoch in all_epochs:
-            if rerp is None or epoch.rerp is rerp:
-                if epoch not in self._epochs_with_artifacts:
-                    bucket.epochs.fully_accepted += 1
-                elif epoch not in self._epochs_with_data:
-                    bucket.epochs.fully_rejected += 1
-                else:
-                    bucket.epochs.partially_accepted += 1
+            epoch_idx = self._epoch_indices.get(epoch)
+            if epoch_idx is None:
+                epoch_idx = len(self._epoch_rerps)
+                self._epoch_indices[epoch] = epoch_idx
+                self._epoch_rerps.append(epoch.rerp.this_rerp_index)
+            self._pair_subspans.append(subspan_idx)
+            self._pair_epochs.append(epoch_idx)
+
+    def _add_point_stats(self, point_stats_name, bucket_idx, weights,
+                         rejected, artifact_rows):
+        num_buckets = len(self._rerps) + 1
+        accepted = _int_bincount(bucket_idx[~rejected], weights[~rejected],
+                                 num_buckets)
+        rejected = _int_bincount(bucket_idx[rejected], weights[rejected],
+                                 num_buckets)
+        for bucket_i, bucket in enumerate(self._all_buckets()):
+            point_stats = getattr(bucket, point_stats_name)
+            point_stats.accepted += int(accepted[bucket_i])
+            point_stats.rejected += int(rejected[bucket_i])
+        for artifact, (hit, unique) in artifact_rows:
+            present = np.bincount(bucket_idx[hit], minlength=num_buckets)
+            affected = _int_bincount(bucket_idx[hit], weights[hit],
+                                     num_buckets)
+            hit_uniquely = hit & unique
+            uniquely = _int_bincount(bucket_idx[hit_uniquely],
+                                     weights[hit_uniquely],
+                                     num_buckets)
+            for bucket_i, bucket in enumerate(self._all_buckets()):
+                if present[bucket_i]:
+                    point_stats = getattr(bucket, point_stats_name)
+                    counts = point_stats.artifacts.setdefault(
+                        artifact, {"affected": 0, "unique": 0})
+                    counts["affected"] += int(affected[bucket_i])
+                    counts["unique"] += int(uniquely[bucket_i])
+
+    def _all_buckets(self):
+        return self._rerp_buckets + [self._global_bucket]
 
     def save(self):
-        all_epochs = self._epochs_with_data.union(self._epochs_with_artifacts)
-        self._set_epoch_stats(self._global_bucket, all_epochs, None)
+        num_rerps = len(self._rerps)
+        num_subspans = len(self._ticks)
+        ticks = np.asarray(self._ticks, dtype=np.int64)
+        epoch_counts = np.asarray(self._epoch_counts, dtype=np.int64)
+        # Python ints let us use more than 63 artifact types; otherwise stick
+        # to machine integers for speed.
+        if len(self._artifact_bits) < 63:
+            mask_dtype = np.int64
+        else:
+            mask_dtype = object
+        masks = np.asarray(self._artifact_masks, dtype=mask_dtype)
+        pair_subspans = np.asarray(self._pair_subspans, dtype=np.int64)
+        pair_epochs = np.asarray(self._pair_epochs, dtype=np.int64)
+        epoch_rerps = np.asarray(self._epoch_rerps, dtype=np.int64)
+
+        # Collapse (subspan, epoch) pairs into (subspan, bucket) rows that
+        # record how many events from each bucket each subspan contains.
+        pair_keys = pair_subspans * num_rerps + epoch_rerps[pair_epochs]
+        row_keys, pair_rows = np.unique(pair_keys, return_inverse=True)
+        row_events = np.bincount(pair_rows, minlength=len(row_keys))
+        row_subspans = np.concatenate([row_keys // num_rerps,
+                                       np.arange(num_subspans)])
+        row_buckets = np.concatenate([row_keys % num_rerps,
+                                      np.repeat(num_rerps, num_subspans)])
+        row_events = np.concatenate([row_events, epoch_counts])
+
+        row_ticks = ticks[row_subspans]
+        row_masks = masks[row_subspans]
+        row_rejected = np.asarray(row_masks != 0, dtype=bool)
+        # A mask has exactly one bit set iff clearing its lowest bit zeroes it
+        row_single_bit = np.asarray((row_masks & (row_masks - 1)) == 0,
+                                    dtype=bool)
+        row_unique = row_rejected & row_single_bit
+        row_no_overlap = (epoch_counts[row_subspans] == 1)
+        artifact_hits = []
+        for artifact, bit in sorted(self._artifact_bits.items()):
+            hit = np.asarray((row_masks >> bit) & 1, dtype=bool)
+            artifact_hits.append((artifact, hit))
+
+        self._add_point_stats("ticks", row_buckets, row_ticks, row_rejected,
+                              [(artifact, (hit, row_unique))
+                               for (artifact, hit) in artifact_hits])
+        self._add_point_stats("event_ticks", row_buckets,
+                              row_ticks * row_events, row_rejected,
+                              [(artifact, (hit, row_unique))
+                               for (artifact, hit) in artifact_hits])
+        self._add_point_stats("no_overlap_ticks",
+                              row_buckets[row_no_overlap],
+                              row_ticks[row_no_overlap],
+                              row_rejected[row_no_overlap],
+                              [(artifact, (hit[row_no_overlap],
+                                           row_unique[row_no_overlap]))
+                               for (artifact, hit) in artifact_hits])
+
+        # Epoch stats
+        num_epochs = len(epoch_rerps)
+        pair_rejected = np.asarray(masks[pair_subspans] != 0, dtype=bool)
+        epoch_has_artifact = np.zeros(num_epochs, dtype=bool)
+        epoch_has_artifact[pair_epochs[pair_rejected]] = True
+        epoch_has_data = np.zeros(num_epochs, dtype=bool)
+        epoch_has_data[pair_epochs[~pair_rejected]] = True
+        for attr, which in [
+            ("fully_accepted", ~epoch_has_artifact),
+            ("fully_rejected", epoch_has_artifact & ~epoch_has_data),
+            ("partially_accepted", epoch_has_artifact & epoch_has_data),
+            ]:
+            by_rerp = np.bincount(epoch_rerps[which], minlength=num_rerps)
+            for rerp_bucket, count in zip(self._rerp_buckets, by_rerp):
+                setattr(rerp_bucket.epochs, attr, int(count))
+            setattr(self._global_bucket.epochs, attr, int(np.sum(which)))
+
         for rerp, rerp_bucket in zip(self._rerps, self._rerp_buckets):
-            self._set_epoch_stats(rerp_bucket, all_epochs, rerp)
             rerp._set_accounting(self._global_bucket, rerp_bucket)
 
 def test__Accountant():
@@ -1166,9 +2246,25 @@ def test__Accountant():
     repr(r0)
     repr(r1)
 
+    # lots of artifact types (more than fit in a machine-integer bitmask)
+    rerps = make_rerps(1)
+    g, (r0,) = make_infos(
+        [(i + 1, [0], ["a%s" % (i,), "b%s" % (i // 2,)])
+         for i in xrange(100)]
+        + [(1000, [0], ["a0"])],
+        rerps)
+    assert g.ticks.rejected == sum(xrange(1, 101)) + 1000
+    assert g.ticks.artifacts["a0"] == {"affected": 1 + 1000, "unique": 1000}
+    assert g.ticks.artifacts["a99"] == {"affected": 100, "unique": 0}
+    assert g.ticks.artifacts["b49"] == {"affected": 99 + 100, "unique": 0}
+    assert r0.no_overlap_ticks.artifacts == g.ticks.artifacts
+
 ################################################################
 
-def _choose_strategy(requested_strategy, global_stats):
+def _choose_strategy(requested_strategy, global_stats, latency_basis=False,
+                     penalized=False):
+    # 'latency_basis' is whether any of the rERPs has one; 'penalized' is
+    # whether the fit has any penalty.
     gs = global_stats
     # If there is any overlap, then by_epoch is impossible. (Recall that at
     # this phase in the code, if overlap_correction=False then all overlapping
@@ -1179,12 +2275,20 @@ def _choose_strategy(requested_strategy, global_stats):
     # If there are any partially accepted, partially not-accepted epochs, then
     # by_epoch is impossible.
     have_partial_epochs = (gs.epochs.partially_accepted > 0)
-    by_epoch_possible = not (have_overlap or have_partial_epochs)
-    if requested_strategy == "continuous":
+    # And a latency basis ties the different latencies together, so they
+    # can't be fit separately.
+    by_epoch_possible = not (have_overlap or have_partial_epochs
+                             or latency_basis)
+    # Partially rejected epochs are fine for by-latency, but a penalty (in
+    # particular the smoothness penalty) ties the latencies together too.
+    by_latency_possible = not (have_overlap or latency_basis or penalized)
+    if requested_strategy in ("continuous", "iterative"):
         return requested_strategy
     elif requested_strategy == "auto":
         if by_epoch_possible:
             return "by-epoch"
+        elif by_latency_possible:
+            return "by-latency"
         else:
             return "continuous"
     elif requested_strategy == "by-epoch":
@@ -1197,15 +2301,34 @@ def _choose_strategy(requested_strategy, global_stats):
             if have_overlap:
                 reasons.append("there is overlap and overlap correction was "
                                "requested")
+            if latency_basis:
+                reasons.append("a latency_basis was requested")
             raise ValueError("\"by-epoch\" regression strategy is not "
                              "possible because: %s. "
                              "Use \"continuous\" strategy instead."
                              % ("; also, ".join(reasons),))
         else:
             return requested_strategy
+    elif requested_strategy == "by-latency":
+        if not by_latency_possible:
+            reasons = []
+            if have_overlap:
+                reasons.append("there is overlap and overlap correction was "
+                               "requested")
+            if latency_basis:
+                reasons.append("a latency_basis was requested")
+            if penalized:
+                reasons.append("a penalty was requested")
+            raise ValueError("\"by-latency\" regression strategy is not "
+                             "possible because: %s. "
+                             "Use \"continuous\" strategy instead."
+                             % ("; also, ".join(reasons),))
+        else:
+            return requested_strategy
     else:
         raise ValueError("Unknown regression strategy %r requested; must be "
-                         "\"by-epoch\", \"continuous\", or \"auto\""
+                         "\"by-epoch\", \"by-latency\", \"continuous\", "
+                         "\"iterative\", or \"auto\""
                          % (requested_strategy,))
 
 def test__choose_strategy():
@@ -1226,92 +2349,1709 @@ def test__choose_strategy():
 
     for stats in [overlapped, partial_rej, both, clean]:
         assert _choose_strategy("continuous", stats) == "continuous"
+        assert _choose_strategy("iterative", stats) == "iterative"
         assert_raises(ValueError, _choose_strategy, "asdf", stats)
     assert  _choose_strategy("auto", overlapped) == "continuous"
-    assert  _choose_strategy("auto", partial_rej) == "continuous"
+    assert  _choose_strategy("auto", partial_rej) == "by-latency"
+    assert  _choose_strategy("auto", partial_rej,
+                             latency_basis=True) == "continuous"
+    assert  _choose_strategy("auto", partial_rej,
+                             penalized=True) == "continuous"
     assert  _choose_strategy("auto", both) == "continuous"
     assert  _choose_strategy("auto", clean) == "by-epoch"
+    assert  _choose_strategy("auto", clean, penalized=True) == "by-epoch"
     assert_raises(ValueError, _choose_strategy, "by-epoch", overlapped)
     assert_raises(ValueError, _choose_strategy, "by-epoch", partial_rej)
     assert_raises(ValueError, _choose_strategy, "by-epoch", both)
     assert  _choose_strategy("by-epoch", clean) == "by-epoch"
+    assert_raises(ValueError, _choose_strategy, "by-latency", overlapped)
+    assert_raises(ValueError, _choose_strategy, "by-latency", both)
+    assert_raises(ValueError, _choose_strategy, "by-latency", partial_rej,
+                  penalized=True)
+    assert  _choose_strategy("by-latency", partial_rej) == "by-latency"
+    assert  _choose_strategy("by-latency", clean) == "by-latency"
 
 ################################################################
 
-# We used to do an incremental fit in here, but it was ridiculously
-# slower. Like for a simple 80 epochs/32 channels/2 predictors problem, the
-# naive incremental fit took 120 s, batching everything up took 6 s, just
-# calling np.linalg.lstsq took 200 ms, and doing the lstsq by hand takes
-# something under 10 ms (!!). The code could always be resurrected from git if
-# needed for scalability though.
-def _fit_by_epoch(dataset, analysis_subspans, rerps):
+def _by_epoch_epochs(analysis_subspans, rerps):
     # Throw out all that nice subspan information and just get a list of
-    # epochs. We're guaranteed that every epoch which appears in
-    # analysis_spans is fully included in the regression.
+    # epochs for each rerp. We're guaranteed that every epoch which appears
+    # in analysis_spans is fully included in the regression.
     epochs = set()
     for subspan in analysis_subspans:
         assert len(subspan.epochs) == 1
         epochs.update(subspan.epochs)
     # Process recspans in order, to improve data locality
     epochs = sorted(epochs, key=lambda e: (e.recspan_id, e.start_tick))
+    epochs_by_rerp = dict([(rerp, []) for rerp in rerps])
+    for epoch in epochs:
+        epochs_by_rerp[epoch.rerp].append(epoch)
+    return [epochs_by_rerp[rerp] for rerp in rerps]
+
+def _check_by_epoch_size(rerp, epochs):
+    if len(epochs) < len(rerp.design_info.column_names):
+        raise ValueError("rerp %r has more predictors than data points. "
+                         "I'm afraid this isn't going to work out."
+                         % (rerp.name,))
+
+def _by_epoch_pinv(rerp, epochs, budget=None):
+    # Returns pinv(X) for this rerp's design matrix X, so that its betas are
+    # just np.dot(pinv, Y).
+    _check_by_epoch_size(rerp, epochs)
+    if budget is not None:
+        budget.set("pinv for %s" % (rerp.name,),
+                   3 * len(epochs) * len(rerp.design_info.column_names) * 8)
+    X = _by_epoch_X(rerp, epochs)
+    # implementing lstsq ourselves is dramatically faster than using lstsq
+    # (like, factor of 20?). This is because lstsq spends the majority of
+    # its time calculating residuals, which we don't need. Some
+    # discussion:
+    #   http://mail.scipy.org/pipermail/scipy-user/2013-October/035016.html
+    # How this works:
+    #   svd produces the factorization: X = USV'
+    # where U and V are unitary, S is diagonal. Therefore, starting from
+    # the normal equations:
+    #  B = (X'X)^-1 X'Y
+    #    = (V S' U' U S V')^-1 V S' U' Y
+    #    = V S^-1 S'^-1 V^-1 V S' U' Y
+    #    = V S^-1 U' Y
+    # And V S^-1 U' is in fact pinv(X), modulo some fiddling with
+    # near-zero singular values; in fact this is exactly how
+    # np.linalg.pinv is implemented. So basically this is equivalent to
+    # doing
+    #   betas = np.dot(np.linalg.pinv(X), Y)
+    # except that we get a chance to peek at the singular values and check
+    # for collinearity.
+    #
+    # Remember, np.linalg.svd gives V' instead of V, and gives S as a
+    # vector rather than a matrix.
+    U, s, Vt = np.linalg.svd(X, full_matrices=False)
+    # R's lm() has a default tolerance of 1e-7, so I'll arbitrarily steal
+    # that. s[0] / s[-1] is the condition number (but s[-1] can be zero).
+    if s[-1] <= s[0] / 1e7:
+        raise ValueError("Your predictors appear to be perfectly "
+                         "collinear. I could make up an answer, but I'd "
+                         "rather not.")
+    # If this were a real generic least-norm solver we'd want to go in by
+    # hand and zero out any singular values that were "too small", but the
+    # above code guarantees that this will never happen, so we can just
+    # use the naive formula directly. (Unlike the lstsq case, it's worth
+    # multiplying out pinv here, because it lets us reuse it for refitting
+    # different data, see rERPSolver.)
+    return np.dot(Vt.T * 1/s, U.T)
+
+def _by_epoch_X(rerp, epochs):
+    X = np.empty((len(epochs), len(rerp.design_info.column_names)))
+    for i, epoch in enumerate(epochs):
+        X[i, :] = epoch.design_row
+    return X
+
+def _by_epoch_Y(dataset, rerp, epochs):
+    # Each epoch's data gets copied straight into its row of Y. The epochs
+    # are sorted by recspan and tick (see _by_epoch_epochs), so this reads
+    # through the data in order.
+    Y = np.empty((len(epochs), rerp.ticks * dataset.data_format.num_channels))
+    for i, epoch in enumerate(epochs):
+        Y[i, :] = dataset.raw_slice(epoch.recspan_id,
+                                    epoch.start_tick,
+                                    epoch.stop_tick).ravel()
+    return Y
+
+def _by_epoch_blocks(epochs, row_bytes, budget, name):
+    # Splits 'epochs' into blocks that fit in the budget, if each epoch
+    # takes 'row_bytes' bytes.
+    available = budget.available(name)
+    if available >= len(epochs) * row_bytes:
+        block = max(1, len(epochs))
+    else:
+        block = int(available // row_bytes)
+        if block < 1:
+            # let the budget complain
+            budget.set(name, row_bytes)
+    for i in xrange(0, len(epochs), block):
+        budget.set(name, min(block, len(epochs) - i) * row_bytes)
+        yield epochs[i:i + block]
+    budget.clear(name)
+
+def _by_epoch_pinv_fits(rerp, epochs, budget):
+    # _by_epoch_pinv needs room for X, U, and pinv, which are all
+    # (epochs x predictors).
+    num_predictors = len(rerp.design_info.column_names)
+    return budget.fits("pinv for %s" % (rerp.name,),
+                       3 * len(epochs) * num_predictors * 8)
+
+# The residual sum of squares (for each channel, or each latency and
+# channel), the residual degrees of freedom, and the diagonal of XtX^-1 (or
+# None), from which rERP._set_residuals works out standard errors. These all
+# come out of the same pass through the data that gives the betas, using
+#   RSS = YtY - b.XtY
+# For continuous fits, the diagonal of XtX^-1 takes some extra linear
+# algebra with the factorization (see _continuous_inverse_diagonal).
+_Residuals = namedtuple("_Residuals", ["rss", "df", "inverse_diagonal"])
+
+def _residuals(rss, df, inverse_diagonal):
+    # Rounding error can make RSS = YtY - b.XtY come out slightly negative
+    return _Residuals(np.maximum(rss, 0), df, inverse_diagonal)
+
+def _by_epoch_betas(dataset, rerp, epochs, pinv, budget=None):
+    # We stream through the data in blocks of epochs, so that we never need
+    # more than one block of it in memory. Returns the betas and their
+    # _Residuals.
+    if budget is None:
+        budget = _MemoryBudget()
+    channels = dataset.data_format.num_channels
+    row_bytes = rerp.ticks * channels * 8
+    budget.set("betas for %s" % (rerp.name,), pinv.shape[0] * row_bytes)
+    num_predictors = pinv.shape[0]
+    betas = np.zeros((num_predictors, rerp.ticks * channels))
+    XtX = np.zeros((num_predictors, num_predictors))
+    YtY = np.zeros(rerp.ticks * channels)
+    i = 0
+    for block in _by_epoch_blocks(epochs, row_bytes, budget,
+                                  "data for %s" % (rerp.name,)):
+        Y = _by_epoch_Y(dataset, rerp, block)
+        X = _by_epoch_X(rerp, block)
+        betas += np.dot(pinv[:, i:i + len(block)], Y)
+        XtX += np.dot(X.T, X)
+        YtY += np.sum(Y ** 2, axis=0)
+        i += len(block)
+    # XtY = XtX b, and pinv pinv' = XtX^-1
+    rss = YtY - np.sum(betas * np.dot(XtX, betas), axis=0)
+    residuals = _residuals(rss.reshape((rerp.ticks, channels)),
+                           len(epochs) - num_predictors,
+                           np.sum(pinv ** 2, axis=1))
+    return betas.reshape((-1, rerp.ticks, channels), order="C"), residuals
+
+def _by_epoch_qr_betas(dataset, rerp, epochs, budget=None):
+    # When we only need the betas (and not pinv, see rERPSolver), a QR
+    # decomposition gets them for about half the work of an SVD. And we can
+    # do it incrementally, one block of epochs at a time, for when there are
+    # so many epochs that we can't even fit X in memory. If we've seen the
+    # blocks X_1, ..., X_k so far, then we have R and QtY such that
+    #   [X_1; ...; X_k] = Q R
+    #   QtY = Q' [Y_1; ...; Y_k]
+    # for some Q (which we don't keep) with orthonormal columns. To add the
+    # next block, we take the QR decomposition [R; X_k+1] = Q2 R2; then
+    #   [X_1; ...; X_k+1] = [Q 0; 0 I] Q2 R2
+    # so the new R is R2, and the new QtY is Q2' [QtY; Y_k+1]. At the end,
+    # the betas are the solution to the triangular system
+    #   R betas = QtY
+    # which is exactly what the least squares solution via a full QR
+    # decomposition would give us. This is basically TSQR, done serially.
+    # Also returns the betas' _Residuals: since Q has orthonormal columns,
+    # b.XtY = ||QtY||^2, and XtX^-1 = R^-1 R^-T.
+    if budget is None:
+        budget = _MemoryBudget()
+    num_predictors = len(rerp.design_info.column_names)
     channels = dataset.data_format.num_channels
-    Xs_Ys_by_rerp = dict([(rerp, ([], [])) for rerp in rerps])
+    row_bytes = rerp.ticks * channels * 8
+    # R and QtY, plus room for the new ones
+    budget.set("betas for %s" % (rerp.name,),
+               2 * num_predictors * (num_predictors * 8 + row_bytes))
+    R = np.zeros((0, num_predictors))
+    QtY = np.zeros((0, rerp.ticks * channels))
+    YtY = np.zeros(rerp.ticks * channels)
+    # Each block of data is held as Y_k, stacked with QtY, and multiplied;
+    # X_k is stacked and gives Q.
+    for block in _by_epoch_blocks(epochs,
+                                  3 * row_bytes + 2 * num_predictors * 8,
+                                  budget, "data for %s" % (rerp.name,)):
+        X_block = _by_epoch_X(rerp, block)
+        Y_block = _by_epoch_Y(dataset, rerp, block)
+        YtY += np.sum(Y_block ** 2, axis=0)
+        if R.shape[0] > 0:
+            X_block = np.row_stack([R, X_block])
+            Y_block = np.row_stack([QtY, Y_block])
+        Q, R = np.linalg.qr(X_block)
+        QtY = np.dot(Q.T, Y_block)
+    # R has the same singular values as X. (And if R is singular, then
+    # s[-1] is zero, so we don't divide by it.)
+    s = np.linalg.svd(R, compute_uv=False)
+    if s[-1] <= s[0] / 1e7:
+        raise ValueError(_COLLINEAR_MSG)
+    betas = scipy.linalg.solve_triangular(R, QtY)
+    R_inv = scipy.linalg.solve_triangular(R, np.eye(num_predictors))
+    residuals = _residuals(
+        (YtY - np.sum(QtY ** 2, axis=0)).reshape((rerp.ticks, channels)),
+        len(epochs) - num_predictors,
+        np.sum(R_inv ** 2, axis=1))
+    return betas.reshape((-1, rerp.ticks, channels), order="C"), residuals
+
+def _by_epoch_penalized_betas(dataset, rerp, epochs, penalties,
+                              smoothness_penalty, budget=None):
+    # The by-epoch version of _penalty_path (see there for the details):
+    # returns a list of betas for each of 'penalties', and their GCV
+    # scores. Each latency shares the same (epochs x predictors) design X,
+    # so the full X'X is (I kron XtX), and the smoothness penalty is
+    # (D'D kron I). Both are diagonalized by the eigenvectors U of XtX and
+    # W of D'D, so if B is the (predictors x latencies) betas for some
+    # channel, then in those coordinates, C = U' B W,
+    #   C_ij = Z_ij / (s_i + smoothness_penalty * d_j + penalty)
+    # where Z = U' XtY W. We stream the data through in blocks to get XtY,
+    # and after that it's all small matrices.
+    if budget is None:
+        budget = _MemoryBudget()
+    X = _by_epoch_X(rerp, epochs)
+    num_predictors = X.shape[1]
+    channels = dataset.data_format.num_channels
+    row_bytes = rerp.ticks * channels * 8
+    budget.set("betas for %s" % (rerp.name,),
+               (2 + len(penalties)) * num_predictors * row_bytes)
+    XtY = np.zeros((num_predictors, rerp.ticks * channels))
+    YtY = np.zeros(channels)
+    i = 0
+    for block in _by_epoch_blocks(epochs, row_bytes, budget,
+                                  "data for %s" % (rerp.name,)):
+        Y = _by_epoch_Y(dataset, rerp, block)
+        XtY += np.dot(X[i:i + len(block)].T, Y)
+        YtY += np.sum((Y ** 2).reshape((-1, channels)), axis=0)
+        i += len(block)
+    XtY = XtY.reshape((num_predictors, rerp.ticks, channels))
+    s, U = np.linalg.eigh(np.dot(X.T, X))
+    Z = np.tensordot(U.T, XtY, axes=1)
+    if smoothness_penalty:
+        d, W = np.linalg.eigh(
+            _difference_penalty(rerp.ticks, [0]).toarray())
+        d *= smoothness_penalty
+        Z = np.einsum("ibc,bj->ijc", Z, W)
+    else:
+        d = np.zeros(rerp.ticks)
+    all_betas = []
+    scores = []
+    for penalty in penalties:
+        # These are the eigenvalues of the full penalized XtX
+        shifted = s[:, np.newaxis] + d[np.newaxis, :] + penalty
+        if not _well_conditioned(shifted):
+            all_betas.append(None)
+            scores.append(np.inf)
+            continue
+        C = Z / shifted[:, :, np.newaxis]
+        rss = (YtY - 2 * np.sum(C * Z, axis=(0, 1))
+               + np.sum(s[:, np.newaxis, np.newaxis] * C ** 2, axis=(0, 1)))
+        df = np.sum(s[:, np.newaxis] / shifted)
+        betas = np.tensordot(U, C, axes=1)
+        if smoothness_penalty:
+            betas = np.einsum("ijc,bj->ibc", betas, W)
+        all_betas.append(betas)
+        scores.append(_gcv(len(epochs) * rerp.ticks, rss, df))
+    if all([betas is None for betas in all_betas]):
+        raise ValueError(_COLLINEAR_MSG)
+    return all_betas, np.asarray(scores)
+
+# We used to do an incremental fit in here, but it was ridiculously
+# slower. Like for a simple 80 epochs/32 channels/2 predictors problem, the
+# naive incremental fit took 120 s, batching everything up took 6 s, just
+# calling np.linalg.lstsq took 200 ms, and doing the lstsq by hand takes
+# something under 10 ms (!!). The code could always be resurrected from git if
+# needed for scalability though. (Except when there are too many epochs to
+# fit X in memory at all -- see _by_epoch_qr_betas.)
+def _fit_by_epoch(dataset, analysis_subspans, rerps, budget=None, workers=1,
+                  penalty=0, smoothness_penalty=0, penalty_path=None):
+    if budget is None:
+        budget = _MemoryBudget()
+    all_epochs = _by_epoch_epochs(analysis_subspans, rerps)
+    for rerp, epochs in zip(rerps, all_epochs):
+        _check_by_epoch_size(rerp, epochs)
+    def fit_one(rerp, epochs):
+        return _by_epoch_fit_one(dataset, rerp, epochs, budget, penalty,
+                                 smoothness_penalty, penalty_path)
+    results = _by_epoch_map(fit_one, zip(rerps, all_epochs), workers,
+                            budget)
+    for rerp, epochs, (all_betas, scores, residuals) in zip(rerps, all_epochs,
+                                                            results):
+        rerp._set_epochs(epochs)
+        _set_penalized_betas(rerp, all_betas, scores, penalty,
+                             smoothness_penalty, penalty_path,
+                             residuals=residuals)
+
+def _by_epoch_fit_one(dataset, rerp, epochs, budget, penalty,
+                      smoothness_penalty, penalty_path):
+    # Returns a list of betas and their GCV scores, like
+    # _by_epoch_penalized_betas, plus the _Residuals (or a list of just one
+    # betas, None, and the _Residuals, if there's no penalty).
+    if penalty or smoothness_penalty or penalty_path is not None:
+        if penalty_path is None:
+            penalty_path = [penalty]
+        all_betas, scores = _by_epoch_penalized_betas(dataset, rerp, epochs,
+                                                      penalty_path,
+                                                      smoothness_penalty,
+                                                      budget)
+        return all_betas, scores, None
+    betas, residuals = _by_epoch_qr_betas(dataset, rerp, epochs, budget)
+    return [betas], None, residuals
+
+def _set_penalized_betas(rerp, all_betas, scores, penalty, smoothness_penalty,
+                         penalty_path, residuals=None):
+    # 'all_betas' has one entry for each penalty in penalty_path, or just one
+    # if penalty_path is None. 'residuals' are only available for
+    # unpenalized fits.
+    if penalty_path is None:
+        rerp._set_penalty(penalty, smoothness_penalty)
+        rerp._set_betas(all_betas[0])
+    else:
+        rerp._set_penalty_path(smoothness_penalty, penalty_path, scores,
+                               all_betas)
+    if residuals is not None:
+        rerp._set_residuals(residuals)
+
+# A timeout that never runs out (about 68 years), for _by_epoch_map
+_FOREVER = 2 ** 31
+
+def _by_epoch_map(function, args, workers, budget):
+    # Calls function(*arg) for each arg in args, and returns the results.
+    # The by-epoch work is almost all inside LAPACK and BLAS, which release
+    # the GIL, so if workers > 1 we use that many threads. But not if they'd
+    # have to share a memory limit -- then they'd just be fighting over it.
+    if workers > 1 and len(args) > 1 and budget.limit is None:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(min(workers, len(args)))
+        try:
+            # On Python 2, waiting for the results without a timeout can't
+            # be interrupted by control-C, so we use a very long one.
+            return pool.map_async(lambda arg: function(*arg),
+                                  args).get(_FOREVER)
+        finally:
+            pool.terminate()
+            pool.join()
+    return [function(*arg) for arg in args]
+
+def test__by_epoch_map():
+    import time
+    import thread
+    import threading
+    from nose.tools import assert_raises
+    def slow_square(x, delay=0.01):
+        time.sleep(delay)
+        return x ** 2
+    args = [(i,) for i in xrange(4)]
+    for workers in [1, 2, 4]:
+        assert _by_epoch_map(slow_square, args, workers,
+                             _MemoryBudget()) == [0, 1, 4, 9]
+    # Threads are only used without a memory limit
+    assert _by_epoch_map(lambda: threading.current_thread().name,
+                         [()] * 3, 3, _MemoryBudget(10 ** 6)) == (
+        [threading.current_thread().name] * 3)
+    # Control-C interrupts the wait, and the rest of the work is dropped.
+    # (The threads still finish whatever they were in the middle of.) Done
+    # in full, this would take 4 seconds.
+    interrupter = threading.Timer(0.05, thread.interrupt_main)
+    start = time.time()
+    interrupter.start()
+    try:
+        assert_raises(KeyboardInterrupt, _by_epoch_map, slow_square,
+                      [(i, 0.25) for i in xrange(32)], 2, _MemoryBudget())
+    finally:
+        interrupter.cancel()
+    assert time.time() - start < 2
+
+def test__fit_by_epoch_budget():
+    # The streaming code paths give the same answers as the in-memory one
+    from rerpy.test_data import mock_dataset
+    from nose.tools import assert_raises
+    ds = mock_dataset(num_channels=2, num_recspans=2, ticks_per_recspan=500,
+                      hz=1000)
+    r = np.random.RandomState(0)
+    for recspan_id in xrange(2):
+        for tick in xrange(5, 490, 11):
+            ds.add_event(recspan_id, tick, tick + 1, {"x": r.normal()})
+    req = rERPRequest("has x", 0, 9, "x")
+    def fit(memory_limit):
+        rerp, = ds.multi_rerp([req], regression_strategy="by-epoch",
+                              memory_limit=memory_limit, verbose=False)
+        return rerp
+    def solver_fit(memory_limit):
+        solver = ds.multi_rerp_solver([req], regression_strategy="by-epoch",
+                                      memory_limit=memory_limit,
+                                      verbose=False)
+        return solver.fit(ds)[0]
+    expected = fit(None)
+    # 88 epochs, with 10 ticks * 2 channels each, and 2 predictors.
+    row_bytes = 10 * 2 * 8
+    betas_bytes = 2 * row_bytes
+    pinv_bytes = 3 * 88 * 2 * 8
+    qr_bytes = 2 * 2 * (2 * 8 + row_bytes)
+    qr_row_bytes = 3 * row_bytes + 2 * 2 * 8
+    # The QR path, 10 epochs at a time and then 1 at a time:
+    qr_limits = [qr_bytes + 10 * qr_row_bytes, qr_bytes + qr_row_bytes]
+    for limit in qr_limits:
+        got = fit(limit)
+        assert np.allclose(got.betas, expected.betas)
+        assert got.peak_memory <= limit
+        # and rERPSolver falls back on it too
+        assert np.allclose(solver_fit(limit).betas, expected.betas)
+    # (These limits really are too small for the in-memory path)
+    assert expected.peak_memory > max(qr_limits)
+    assert_raises(ValueError, fit, 100)
+    # rERPSolver with enough room for pinv, but not all the data:
+    limit = betas_bytes + pinv_bytes + 10 * row_bytes
+    got = solver_fit(limit)
+    assert np.allclose(got.betas, expected.betas)
+    assert got.peak_memory <= limit
+
+################################################################
+# The "by-latency" strategy
+#
+# Without overlap, the continuous model falls apart into one small
+# regression per latency of each rerp: the betas at latency l are fit using
+# just the epochs whose tick at latency l was accepted. When no epoch is
+# partially rejected, every latency uses the same epochs, which is the
+# "by-epoch" strategy. When some epochs are partially rejected, different
+# latencies see different subsets of the epochs -- but usually only a few
+# different subsets, since the subset only changes at the latencies where
+# some epoch's rejected stretch starts or stops. So we group the latencies
+# by their pattern of accepted epochs, and work out a single pinv for each
+# pattern.
+
+def _by_latency_epochs(analysis_subspans, rerps):
+    # Like _by_epoch_epochs, except that epochs don't have to be fully
+    # accepted. Returns a list with one (epochs, mask) pair for each rerp,
+    # where mask is a boolean (epochs x latencies) array saying which
+    # latencies of each epoch went into the regression.
+    accepted = {}
+    for subspan in analysis_subspans:
+        assert len(subspan.epochs) == 1
+        epoch, = subspan.epochs
+        accepted.setdefault(epoch, []).append(
+            (subspan.start[1] - epoch.start_tick,
+             subspan.stop[1] - epoch.start_tick))
+    epochs = sorted(accepted, key=lambda e: (e.recspan_id, e.start_tick))
+    epochs_by_rerp = dict([(rerp, []) for rerp in rerps])
     for epoch in epochs:
-        this_X = epoch.design_row
-        y_data = dataset.raw_slice(epoch.recspan_id,
-                                   epoch.start_tick, epoch.stop_tick)
-        this_Y = y_data.reshape((1, -1))
-        Xs, Ys = Xs_Ys_by_rerp[epoch.rerp]
-        Xs.append(this_X)
-        Ys.append(this_Y)
-    for rerp, (Xs, Ys) in Xs_Ys_by_rerp.items():
-        X = np.row_stack(Xs)
-        Y = np.row_stack(Ys)
-        if X.shape[0] < X.shape[1]:
-            raise ValueError("rerp %r has more predictors than data points. "
-                             "I'm afraid this isn't going to work out."
-                             % (rerp.name,))
-        # implementing lstsq ourselves is dramatically faster than using lstsq
-        # (like, factor of 20?). This is because lstsq spends the majority of
-        # its time calculating residuals, which we don't need. Some
-        # discussion:
-        #   http://mail.scipy.org/pipermail/scipy-user/2013-October/035016.html
-        # How this works:
-        #   svd produces the factorization: X = USV'
-        # where U and V are unitary, S is diagonal. Therefore, starting from
-        # the normal equations:
-        #  B = (X'X)^-1 X'Y
-        #    = (V S' U' U S V')^-1 V S' U' Y
-        #    = V S^-1 S'^-1 V^-1 V S' U' Y
-        #    = V S^-1 U' Y
-        # And V S^-1 U' is in fact pinv(X), modulo some fiddling with
-        # near-zero singular values; in fact this is exactly how
-        # np.linalg.pinv is implemented. So basically this is equivalent to
-        # doing
-        #   betas = np.dot(np.linalg.pinv(X), Y)
-        # except that we get a chance to peek at the singular values and check
-        # for collinearity.
-        #
-        # Remember, np.linalg.svd gives V' instead of V, and gives S as a
-        # vector rather than a matrix.
-        U, s, Vt = np.linalg.svd(X, full_matrices=False)
-        # R's lm() has a default tolerance of 1e-7, so I'll arbitrarily steal
-        # that. s[0] / s[-1] is the condition number.
-        if s[0] / s[-1] > 1e7:
-            raise ValueError("Your predictors appear to be perfectly "
-                             "collinear. I could make up an answer, but I'd "
-                             "rather not.")
-        # If this were a real generic least-norm solver we'd want to go in by
-        # hand and zero out any singular values that were "too small", but the
-        # above code guarantees that this will never happen, so we can just
-        # use the naive formula directly:
-        betas = np.dot(Vt.T * 1/s, np.dot(U.T, Y))
-        betas = betas.reshape((-1, rerp.ticks, channels), order="C")
-        rerp._set_betas(betas)
+        epochs_by_rerp[epoch.rerp].append(epoch)
+    result = []
+    for rerp in rerps:
+        rerp_epochs = epochs_by_rerp[rerp]
+        mask = np.zeros((len(rerp_epochs), rerp.ticks), dtype=bool)
+        for i, epoch in enumerate(rerp_epochs):
+            for start, stop in accepted[epoch]:
+                mask[i, start:stop] = True
+        result.append((rerp_epochs, mask))
+    return result
+
+def _by_latency_patterns(mask):
+    # Groups the latencies (columns of 'mask') by which epochs were accepted
+    # there. Returns a list of (latencies, rows) pairs, where 'rows' is the
+    # boolean mask of accepted epochs shared by all of 'latencies'.
+    groups = {}
+    keys = []
+    for latency in xrange(mask.shape[1]):
+        key = np.packbits(mask[:, latency]).tostring()
+        if key not in groups:
+            groups[key] = []
+            keys.append(key)
+        groups[key].append(latency)
+    return [(np.asarray(groups[key]), mask[:, groups[key][0]])
+            for key in keys]
+
+def test__by_latency_patterns():
+    mask = np.array([[1, 1, 1, 1, 1],
+                     [0, 0, 1, 1, 0],
+                     [1, 1, 1, 1, 1]], dtype=bool)
+    patterns = _by_latency_patterns(mask)
+    assert len(patterns) == 2
+    assert np.array_equal(patterns[0][0], [0, 1, 4])
+    assert np.array_equal(patterns[0][1], [True, False, True])
+    assert np.array_equal(patterns[1][0], [2, 3])
+    assert np.array_equal(patterns[1][1], [True, True, True])
+
+def _by_latency_factor(rerp, epochs, mask, budget=None):
+    # Returns a list of (latencies, pinv, XtX) triples, one for each pattern
+    # of accepted epochs. Each pinv is (predictors x epochs), with zeros in
+    # the columns of the epochs that were rejected at those latencies, so
+    # that it can be applied directly to data in which the rejected ticks
+    # have been zeroed out.
+    patterns = _by_latency_patterns(mask)
+    num_predictors = len(rerp.design_info.column_names)
+    if budget is not None:
+        budget.set("pinv for %s" % (rerp.name,),
+                   len(patterns) * len(epochs) * num_predictors * 8)
+    X = _by_epoch_X(rerp, epochs)
+    factors = []
+    for latencies, rows in patterns:
+        accepted_epochs = [epoch for (epoch, row) in zip(epochs, rows)
+                           if row]
+        pinv = np.zeros((num_predictors, len(epochs)))
+        pinv[:, rows] = _by_epoch_pinv(rerp, accepted_epochs)
+        X_rows = X[rows, :]
+        factors.append((latencies, pinv, np.dot(X_rows.T, X_rows)))
+    return factors
+
+def _by_latency_Y(dataset, rerp, epochs, mask):
+    # Like _by_epoch_Y, but only reads the accepted ticks of each epoch; the
+    # rest are left as zero. Returns an (epochs x latencies x channels)
+    # array.
+    Y = np.zeros((len(epochs), rerp.ticks, dataset.data_format.num_channels))
+    for i, epoch in enumerate(epochs):
+        edges = np.flatnonzero(np.diff(np.concatenate(([0], mask[i], [0]))))
+        for start, stop in zip(edges[::2], edges[1::2]):
+            Y[i, start:stop, :] = dataset.raw_slice(epoch.recspan_id,
+                                                    epoch.start_tick + start,
+                                                    epoch.start_tick + stop)
+    return Y
+
+def _by_latency_betas(dataset, rerp, epochs, mask, factors, budget=None):
+    # Streams through the data in blocks of epochs, like _by_epoch_betas.
+    # Returns the betas, the residual sum of squares at each latency and
+    # channel, and the diagonal of XtX^-1 at each predictor and latency.
+    if budget is None:
+        budget = _MemoryBudget()
+    channels = dataset.data_format.num_channels
+    num_predictors = len(rerp.design_info.column_names)
+    row_bytes = rerp.ticks * channels * 8
+    budget.set("betas for %s" % (rerp.name,), num_predictors * row_bytes)
+    betas = np.zeros((num_predictors, rerp.ticks, channels))
+    YtY = np.zeros((rerp.ticks, channels))
+    i = 0
+    for block in _by_epoch_blocks(epochs, row_bytes, budget,
+                                  "data for %s" % (rerp.name,)):
+        Y = _by_latency_Y(dataset, rerp, block, mask[i:i + len(block)])
+        for latencies, pinv, _ in factors:
+            Y_pattern = Y[:, latencies, :].reshape((len(block), -1))
+            betas[:, latencies, :] += np.dot(
+                pinv[:, i:i + len(block)],
+                Y_pattern).reshape((num_predictors, len(latencies), channels))
+        YtY += np.sum(Y ** 2, axis=0)
+        i += len(block)
+    rss = YtY
+    inverse_diagonal = np.empty((num_predictors, rerp.ticks))
+    for latencies, pinv, XtX in factors:
+        b = betas[:, latencies, :]
+        rss[latencies, :] -= np.einsum("plc,pq,qlc->lc", b, XtX, b)
+        # pinv pinv' = XtX^-1
+        inverse_diagonal[:, latencies] = np.sum(pinv ** 2,
+                                                axis=1)[:, np.newaxis]
+    return betas, rss, inverse_diagonal
+
+def _by_latency_residuals(rerps, masks, fits):
+    # Pools the residuals from each rerp's _by_latency_betas into a single
+    # error variance for each channel, just like the continuous fit of the
+    # same model has. Yields each rerp's _Residuals.
+    rss = sum([np.sum(fit_rss, axis=0) for (_, fit_rss, _) in fits])
+    df = (sum([np.sum(mask) for mask in masks])
+          - sum([len(rerp.design_info.column_names) * rerp.ticks
+                 for rerp in rerps]))
+    for _, _, inverse_diagonal in fits:
+        yield _residuals(rss, df, inverse_diagonal)
+
+def _fit_by_latency(dataset, analysis_subspans, rerps, budget=None,
+                    workers=1):
+    if budget is None:
+        budget = _MemoryBudget()
+    all_epochs, masks = zip(*_by_latency_epochs(analysis_subspans, rerps))
+    def fit_one(rerp, epochs, mask):
+        factors = _by_latency_factor(rerp, epochs, mask, budget)
+        return _by_latency_betas(dataset, rerp, epochs, mask, factors, budget)
+    fits = _by_epoch_map(fit_one, zip(rerps, all_epochs, masks), workers,
+                         budget)
+    for rerp, (betas, _, _), residuals in zip(
+            rerps, fits, _by_latency_residuals(rerps, masks, fits)):
+        _set_penalized_betas(rerp, [betas], None, 0, 0, None,
+                             residuals=residuals)
+
+################################################################
+
+class _MemoryBudget(object):
+    """Keeps track of the memory used by the big arrays in a fit.
+
+    Each kind of buffer (the XtX matrix, the current chunk of data, ...) is
+    registered by name with its size in bytes; .peak is the largest total
+    we've seen so far. If 'limit' is given (in bytes), then registering
+    something that would take the total over it raises a ValueError, and
+    .available() tells code that can work in smaller pieces how much room it
+    has.
+
+    These are estimates -- we only count the arrays whose size scales with
+    the problem, not Python overhead or transient copies made by numpy.
+    """
+    def __init__(self, limit=None):
+        if limit is not None and limit <= 0:
+            raise ValueError("memory_limit= must be positive")
+        self.limit = limit
+        self._sizes = {}
+        self._total = 0
+        self.peak = 0
+        # by-epoch fits may update us from several threads at once
+        self._lock = threading.Lock()
+
+    def available(self, name=None):
+        # How many bytes buffer 'name' can grow to. Unlimited budgets return
+        # infinity.
+        if self.limit is None:
+            return np.inf
+        return self.limit - self._total + self._sizes.get(name, 0)
+
+    def fits(self, name, nbytes):
+        return nbytes <= self.available(name)
+
+    def set(self, name, nbytes):
+        nbytes = int(nbytes)
+        if not self.fits(name, nbytes):
+            raise ValueError("this analysis needs more memory than the %s "
+                             "bytes allowed by memory_limit= (%s bytes "
+                             "for %s); try raising memory_limit=, or "
+                             "regression_strategy=\"iterative\""
+                             % (self.limit, nbytes, name))
+        with self._lock:
+            self._total += nbytes - self._sizes.get(name, 0)
+            self._sizes[name] = nbytes
+            self.peak = max(self.peak, self._total)
+
+    def clear(self, name):
+        with self._lock:
+            self._total -= self._sizes.pop(name, 0)
+
+    def used(self):
+        return self._total
+
+def test__MemoryBudget():
+    from nose.tools import assert_raises
+    unlimited = _MemoryBudget()
+    assert unlimited.available() == np.inf
+    unlimited.set("a", 10 ** 12)
+    assert unlimited.peak == 10 ** 12
 
+    b = _MemoryBudget(1000)
+    b.set("a", 600)
+    assert b.available() == 400
+    assert b.available("a") == 1000
+    assert b.fits("b", 400)
+    assert not b.fits("b", 401)
+    assert_raises(ValueError, b.set, "b", 401)
+    b.set("b", 300)
+    b.set("a", 100)
+    assert b.peak == 900
+    b.clear("b")
+    b.clear("no such buffer")
+    assert b.available() == 900
+    assert b.peak == 900
+    assert_raises(ValueError, _MemoryBudget, 0)
+
+################################################################
+
+# The normal equations matrix X'X for continuous regression is sparse:
+# column (predictor p, latency l) of one rerp only interacts with columns
+# whose epochs can overlap with it at latency l. So we accumulate it sparsely
+# -- but if it turns out to be filled in past this density, then dense storage
+# and dense LAPACK factorization are faster, and we switch over.
+_SPARSE_MAX_DENSITY = 0.05
+# And for small problems, dense is always faster.
+_SPARSE_MIN_WIDTH = 500
+
+_COLLINEAR_MSG = ("Your predictors appear to be perfectly "
+                  "collinear. I could make up an answer, but I'd "
+                  "rather not.")
+# R's lm() has a default tolerance of 1e-7, so I'll arbitrarily steal that.
+_MAX_CONDITION_NUMBER = 1e7
+
+def _well_conditioned(eigenvalues):
+    # Whether a symmetric matrix with these eigenvalues is far enough from
+    # singular to solve: positive definite, with a condition number of at
+    # most _MAX_CONDITION_NUMBER. Both penalty path solvers use this test, so
+    # which penalties get accepted doesn't depend on regression_strategy.
+    low = np.min(eigenvalues)
+    return low > 0 and np.max(eigenvalues) <= low * _MAX_CONDITION_NUMBER
+
+def test__well_conditioned():
+    assert _well_conditioned(np.array([1, 2, 1e7]))
+    assert not _well_conditioned(np.array([1, 2, 1.1e7]))
+    assert not _well_conditioned(np.array([0, 1]))
+    assert not _well_conditioned(np.array([-1, 1]))
+    assert _well_conditioned(np.array([[3, 4], [5, 6]]))
+
+class FitTimings(object):
+    """Where the time went in an rERP fit, and how big the problem was.
+
+    .phases is a DataFrame with one row for each phase of the fit, in the
+    order they happened, giving the "wall" (clock) and "cpu" seconds spent
+    in each. The phases are:
+      epochs: finding the requested epochs and computing their design rows
+      artifacts: finding the artifacts
+      all_or_nothing: propagating all_or_nothing rejections
+      subspans: cutting the data into pieces with the same epochs/artifacts
+      accounting: adding up the rejection statistics
+      fit: everything else, i.e., the regression itself
+      reads: the part of the other phases spent reading data (in
+        Dataset.raw_slice)
+    rERPSolver.fit usually skips the first five phases, because the solver
+    already did them. CPU times only count the fitting process itself, but
+    "reads" is added up over all threads and worker processes, so with
+    workers > 1 it can be larger than "fit".
+
+    .counters is a dict with:
+      subspans: the number of pieces of data that went into the regression
+      design_width: the number of columns in the design matrix (for
+        "by-epoch" fits, the total over all the rERPs)
+      nonzeros: the number of nonzero entries in the design matrix
+      read_calls: the number of Dataset.raw_slice calls
+      read_bytes: the number of bytes those calls returned
+      in_memory_reads: how many of those calls were served from recspans
+        held in memory, rather than by a lazy loader
+
+    All the rERPs fit together share the same FitTimings.
+    """
+    def __init__(self, phases, counters):
+        # 'phases' is a list of (name, wall, cpu) and 'counters' a list of
+        # (name, value), each in the order they should be shown.
+        self.phases = pandas.DataFrame([[wall, cpu]
+                                        for (_, wall, cpu) in phases],
+                                       index=[name for (name, _, _) in phases],
+                                       columns=["wall", "cpu"])
+        self.counters = dict(counters)
+        self._counter_names = [name for (name, _) in counters]
+
+    def __repr__(self):
+        counters = ["%s: %s" % (name, self.counters[name])
+                    for name in self._counter_names]
+        return ("Timings (seconds):\n%s\nCounters:\n%s"
+                % (indent(repr(self.phases), 2),
+                   indent("\n".join(counters), 2)))
+    def _repr_pretty_(self, p, cycle): # pragma: no cover
+        assert not cycle
+        p.text(indent(repr(self), p.indentation, indent_first=False))
+
+class _FitTimer(object):
+    # Builds up a FitTimings over the course of a fit. 'callback', if given,
+    # is called as callback(phase, wall, cpu) as each phase finishes, for
+    # live reporting. The dataset keeps count of its own reads, so we just
+    # take the difference between the start of the fit and the end.
+    def __init__(self, dataset, callback=None):
+        self._read_counts = dataset._read_counts
+        self._start_reads = self._read_counts.snapshot()
+        self._callback = callback
+        # Lists of [name, wall, cpu] and [name, value], in order
+        self._phases = []
+        self._counters = []
+
+    @contextmanager
+    def phase(self, name):
+        start_wall = time.time()
+        start_cpu = process_time()
+        yield
+        self._record(name, time.time() - start_wall,
+                     process_time() - start_cpu)
+
+    @contextmanager
+    def interleaved_phases(self):
+        # For a loop that switches back and forth between phases: yields a
+        # function that works like .phase, except that each phase is only
+        # recorded (and reported to the callback) once, with its total, when
+        # the loop is done.
+        totals = []
+        @contextmanager
+        def phase(name):
+            start_wall = time.time()
+            start_cpu = process_time()
+            yield
+            _add_to(totals, name, time.time() - start_wall,
+                    process_time() - start_cpu)
+        yield phase
+        for name, wall, cpu in totals:
+            self._record(name, wall, cpu)
+
+    def _record(self, name, wall, cpu):
+        # A phase that happens more than once gets the total
+        _add_to(self._phases, name, wall, cpu)
+        if self._callback is not None:
+            self._callback(name, wall, cpu)
+
+    def count(self, name, value):
+        for entry in self._counters:
+            if entry[0] == name:
+                entry[1] = value
+                return
+        self._counters.append([name, value])
+
+    def finish(self):
+        reads = self._read_counts.since(self._start_reads)
+        self._record("reads", reads["wall"], reads["cpu"])
+        self.count("read_calls", reads["calls"])
+        self.count("read_bytes", reads["bytes"])
+        self.count("in_memory_reads", reads["in_memory"])
+        return FitTimings([tuple(entry) for entry in self._phases],
+                          [tuple(entry) for entry in self._counters])
+
+def _add_to(phases, name, wall, cpu):
+    # Adds wall and cpu time to the [name, wall, cpu] entry for 'name' in
+    # 'phases', or appends one.
+    for entry in phases:
+        if entry[0] == name:
+            entry[1] += wall
+            entry[2] += cpu
+            return
+    phases.append([name, wall, cpu])
+
+def test__FitTimer():
+    from rerpy.test_data import mock_dataset
+    ds = mock_dataset(num_channels=2, ticks_per_recspan=10, lazy="none")
+    seen = []
+    timer = _FitTimer(ds, lambda *args: seen.append(args))
+    with timer.phase("a"):
+        ds.raw_slice(0, 0, 5)
+    with timer.phase("b"):
+        pass
+    with timer.phase("a"):
+        ds.raw_slice(0, 2, 4)
+    timer.count("widgets", 3)
+    timings = timer.finish()
+    assert [phase for (phase, _, _) in seen] == ["a", "b", "a", "reads"]
+    assert list(timings.phases.index) == ["a", "b", "reads"]
+    assert list(timings.phases.columns) == ["wall", "cpu"]
+    assert np.all(timings.phases.values >= 0)
+    assert np.allclose(timings.phases.loc["a", "wall"],
+                       seen[0][1] + seen[2][1])
+    assert timings.counters == {"widgets": 3,
+                                "read_calls": 2,
+                                "read_bytes": 7 * 2 * 8,
+                                "in_memory_reads": 2}
+    assert "widgets: 3" in repr(timings)
+    # Interleaved phases are reported once each, when they're done
+    seen = []
+    timer = _FitTimer(ds, lambda *args: seen.append(args))
+    with timer.interleaved_phases() as phase:
+        for i in xrange(3):
+            with phase("c"):
+                pass
+            with phase("d"):
+                pass
+    assert [phase for (phase, _, _) in seen] == ["c", "d"]
+    assert list(timer.finish().phases.index) == ["c", "d", "reads"]
+    # Only reads since the timer started count
+    assert _FitTimer(ds).finish().counters["read_calls"] == 0
+
+def _design_size(rerps, analysis_subspans):
+    # Returns the width and number of nonzero entries of the design matrix
+    # that rerps[0].regression_strategy uses.
+    if rerps[0].regression_strategy in ("by-epoch", "by-latency"):
+        width = sum([len(rerp.design_info.column_names) for rerp in rerps])
+        epochs = list(itertools.chain.from_iterable(
+            _by_epoch_epochs(analysis_subspans, rerps)))
+        nonzeros = _design_row_nonzeros(epochs).sum()
+    else:
+        _, width = _continuous_design_layout(rerps)
+        # Each epoch in a subspan puts its design row into every tick
+        epochs, epoch_subspans = _subspan_epochs(analysis_subspans)
+        nonzeros = np.dot(_subspan_ticks(analysis_subspans)[epoch_subspans],
+                          _design_row_nonzeros(epochs))
+    return width, int(nonzeros)
+
+def _subspan_epochs(subspans):
+    # Returns all the epochs in 'subspans', one after another, and an array
+    # giving the index of the subspan each came from. Here and below we pull
+    # per-epoch values out with map(), so that none of it runs as a Python
+    # loop.
+    epoch_lists = map(attrgetter("epochs"), subspans)
+    counts = np.fromiter(map(len, epoch_lists), dtype=np.int64,
+                         count=len(subspans))
+    epochs = list(itertools.chain.from_iterable(epoch_lists))
+    return epochs, np.repeat(np.arange(len(subspans)), counts)
+
+def _subspan_ticks(subspans):
+    return np.asarray([subspan.stop[1] - subspan.start[1]
+                       for subspan in subspans], dtype=np.int64)
+
+def _design_row_nonzeros(epochs):
+    return np.fromiter(map(np.count_nonzero,
+                           map(attrgetter("design_row"), epochs)),
+                       dtype=np.int64, count=len(epochs))
+
+def test__subspan_epochs():
+    a, b, c = object(), object(), object()
+    subspans = [_DataSubSpan((0, 0), (0, 3), [a, b], []),
+                _DataSubSpan((0, 3), (0, 4), [], []),
+                _DataSubSpan((1, 0), (1, 10), [c, a], [])]
+    epochs, epoch_subspans = _subspan_epochs(subspans)
+    assert epochs == [a, b, c, a]
+    assert np.array_equal(epoch_subspans, [0, 0, 2, 2])
+    assert np.array_equal(_subspan_ticks(subspans), [3, 1, 10])
+    assert _subspan_epochs([])[0] == []
+    assert len(_subspan_epochs([])[1]) == 0
+
+def _prefer_dense(width, nnz):
+    return (width < _SPARSE_MIN_WIDTH
+            or nnz > _SPARSE_MAX_DENSITY * width * width)
+
+class _GramAccumulator(object):
+    """Accumulates a sum of (width x width) sparse matrices.
+
+    Pending sparse pieces are kept as a list and only summed once they would
+    roughly double the size of the running total, so accumulating n pieces
+    costs O(total nnz log n) rather than O(n * total nnz). If the running
+    total ever gets dense enough that dense storage would be better, we
+    switch to a dense array -- unless 'budget' (a _MemoryBudget) says that
+    there isn't room for one.
+    """
+    def __init__(self, width, dense=None, budget=None):
+        self.width = width
+        if budget is None:
+            budget = _MemoryBudget()
+        self._budget = budget
+        if dense is None:
+            dense = self._want_dense(0)
+        if dense:
+            self._budget.set("XtX", width * width * 8)
+            self._dense = np.zeros((width, width))
+        else:
+            self._dense = None
+        self._total = sp.csc_matrix((width, width))
+        self._pending = []
+        self._pending_nnz = 0
+
+    @property
+    def is_dense(self):
+        return self._dense is not None
+
+    def _want_dense(self, nnz):
+        return (_prefer_dense(self.width, nnz)
+                and self._budget.fits("XtX", self.width * self.width * 8))
+
+    def add(self, matrix):
+        if self._dense is not None:
+            if sp.issparse(matrix):
+                # This is an elaborate way of doing:
+                #   dense += sparse
+                # because as of scipy 0.13, dense += sparse is expanded into:
+                #   dense = dense + sparse.todense()
+                # which is just ridiculously inefficient.
+                coo = matrix.tocoo()
+                coo.sum_duplicates()
+                self._dense[coo.row, coo.col] += coo.data
+            else:
+                self._dense += matrix
+            return
+        if not sp.issparse(matrix):
+            matrix = sp.csc_matrix(matrix)
+        self._pending.append(matrix)
+        self._pending_nnz += matrix.nnz
+        if self._pending_nnz > max(self._total.nnz, self.width):
+            self._consolidate()
+
+    def _consolidate(self):
+        if self._pending:
+            total = self._total
+            for matrix in self._pending:
+                total = total + matrix
+            self._total = total.tocsc()
+            self._pending = []
+            self._pending_nnz = 0
+            # 8 bytes of data + 4 bytes of index per entry
+            self._budget.set("XtX", 12 * self._total.nnz)
+        if self._want_dense(self._total.nnz):
+            self._budget.set("XtX", self.width * self.width * 8)
+            self._dense = self._total.toarray()
+            self._total = None
+
+    def result(self):
+        """Returns the sum so far, as either a dense ndarray or a CSC matrix.
+        """
+        if self._dense is None:
+            self._consolidate()
+        if self._dense is not None:
+            return self._dense
+        else:
+            return self._total
+
+def test__GramAccumulator():
+    r = np.random.RandomState(0)
+    width = 2 * _SPARSE_MIN_WIDTH
+    expected = np.zeros((width, width))
+    acc = _GramAccumulator(width)
+    assert not acc.is_dense
+    for i in xrange(50):
+        # small, sparse pieces
+        start = r.randint(width - 3)
+        piece = np.zeros((width, width))
+        piece[start:start + 3, start:start + 3] = r.normal(size=(3, 3))
+        expected += piece
+        acc.add(sp.csc_matrix(piece))
+        assert not acc.is_dense
+    got = acc.result()
+    assert sp.issparse(got)
+    assert np.allclose(got.toarray(), expected)
+    # keep going until it fills in past the density threshold
+    while not acc.is_dense:
+        piece = sp.rand(width, width, density=0.01, random_state=r)
+        expected += piece.toarray()
+        acc.add(piece)
+    # dense mode accepts both sparse and dense pieces
+    acc.add(sp.eye(width).tocsc())
+    acc.add(np.eye(width))
+    expected += 2 * np.eye(width)
+    got = acc.result()
+    assert isinstance(got, np.ndarray)
+    assert np.allclose(got, expected)
+
+    # small problems start out dense
+    small = _GramAccumulator(10)
+    assert small.is_dense
+    small.add(sp.eye(10).tocsc())
+    small.add(sp.eye(10).tocsc())
+    assert np.allclose(small.result(), 2 * np.eye(10))
+    # but this can be overridden
+    assert not _GramAccumulator(10, dense=False).is_dense
+    # or prevented by a memory budget
+    budget = _MemoryBudget(10 * 10 * 8 - 1)
+    tight = _GramAccumulator(10, budget=budget)
+    assert not tight.is_dense
+    tight.add(sp.eye(10).tocsc())
+    assert sp.issparse(tight.result())
+    assert budget.peak == 12 * 10
+
+def _check_collinearity(cond_estimate):
+    if not np.isfinite(cond_estimate) or cond_estimate > _MAX_CONDITION_NUMBER:
+        raise ValueError(_COLLINEAR_MSG)
+
+def _sparse_factor_solver(XtX):
+    # Returns a function that solves XtX * x = b, and the number of non-zeros
+    # in the factorization (or None if unknown). Raises ValueError if XtX is
+    # singular.
+    if _cholmod_cholesky is not None:
+        try:
+            factor = _cholmod_cholesky(XtX)
+        except _CholmodError:
+            raise ValueError(_COLLINEAR_MSG)
+        return factor, None
+    # No CHOLMOD, so fall back on SuperLU. We ask it to treat the matrix as
+    # symmetric -- pick a fill-reducing ordering based on the structure of
+    # A + A' and don't do partial pivoting -- which makes it essentially a
+    # sparse LDL' factorization, and just as accurate as Cholesky for a
+    # positive definite matrix.
+    try:
+        lu = spla.splu(XtX,
+                       permc_spec="MMD_AT_PLUS_A",
+                       diag_pivot_thresh=0,
+                       options={"SymmetricMode": True})
+    except RuntimeError:
+        # "Factor is exactly singular"
+        raise ValueError(_COLLINEAR_MSG)
+    return lu.solve, lu.nnz
+
+def _dense_factor_solver(XtX):
+    # XtX is symmetric positive semi-definite, so we can use a Cholesky
+    # factorization, which costs half as much as an LU and much less than the
+    # SVD that np.linalg.cond needs. If it fails, then XtX is singular to
+    # machine precision, which is way past _MAX_CONDITION_NUMBER.
+    potrf, pocon = scipy.linalg.lapack.get_lapack_funcs(("potrf", "pocon"),
+                                                        (XtX,))
+    factor, info = potrf(XtX, lower=False, clean=True)
+    if info != 0:
+        raise ValueError(_COLLINEAR_MSG)
+    # LAPACK can then estimate the 1-norm condition number from the factor
+    # for only O(n^2) more work. But the collinearity check has always been
+    # on the 2-norm condition number, and the two can differ by a factor of
+    # n either way. So if the estimate is clearly on one side of the
+    # threshold we go with that, and otherwise we fall back on an
+    # eigendecomposition to get the exact answer -- which is also a more
+    # reliable way to solve a nearly singular system.
+    width = XtX.shape[0]
+    norm1 = np.abs(XtX).sum(axis=0).max()
+    rcond, info = pocon(factor, norm1)
+    assert info == 0
+    with np.errstate(divide="ignore"):
+        cond1 = 1.0 / rcond
+    if cond1 * width <= _MAX_CONDITION_NUMBER:
+        def solve(XtY):
+            return scipy.linalg.cho_solve((factor, False), XtY)
+        def inverse_diagonal(budget):
+            # potri turns the Cholesky factor into XtX^-1 in a third of the
+            # flops it takes to solve for the identity, but it needs its own
+            # copy of the factor to work in.
+            if not budget.fits("inverse diagonal", width * width * 8):
+                return _solved_inverse_diagonal(solve, width, budget)
+            budget.set("inverse diagonal", width * width * 8)
+            potri, = scipy.linalg.lapack.get_lapack_funcs(("potri",),
+                                                          (factor,))
+            inverse, info = potri(factor, lower=False)
+            assert info == 0
+            diagonal = np.diag(inverse).copy()
+            del inverse
+            budget.clear("inverse diagonal")
+            return diagonal
+        solve.inverse_diagonal = inverse_diagonal
+        return solve
+    _check_collinearity(cond1 / width)
+    eigenvalues, eigenvectors = np.linalg.eigh(XtX)
+    _check_collinearity(np.max(np.abs(eigenvalues))
+                        / np.min(np.abs(eigenvalues)))
+    def solve(XtY):
+        projected = np.dot(eigenvectors.T, XtY)
+        projected = (projected.T / eigenvalues).T
+        return np.dot(eigenvectors, projected)
+    def inverse_diagonal(budget):
+        return np.einsum("ij,ij,j->i", eigenvectors, eigenvectors,
+                         1.0 / eigenvalues)
+    solve.inverse_diagonal = inverse_diagonal
+    return solve
+
+def _factor_normal_equations(XtX, method="auto", budget=None,
+                             name="XtX factor"):
+    """Factors XtX, and returns a function solve(XtY) giving the betas.
+
+    XtX may be dense or a scipy.sparse matrix; method can be "auto",
+    "sparse", or "dense". "auto" uses a sparse factorization if XtX is sparse
+    enough for that to pay off (or if a _MemoryBudget says there isn't room
+    for a dense one), and a dense one otherwise. Once we have the
+    factorization, solving for any number of different XtY's is just a
+    back-substitution. The factorization is registered with the budget as
+    'name'.
+
+    Raises a ValueError if XtX looks too close to singular.
+    """
+    width = XtX.shape[0]
+    if budget is None:
+        budget = _MemoryBudget()
+    if method == "auto":
+        if sp.issparse(XtX) and (not _prefer_dense(width, XtX.nnz)
+                                 or not budget.fits(name,
+                                                    2 * width * width * 8)):
+            method = "sparse"
+        else:
+            method = "dense"
+    if method == "sparse":
+        XtX = sp.csc_matrix(XtX)
+        sparse_solve, factor_nnz = _sparse_factor_solver(XtX)
+        if factor_nnz is not None:
+            budget.set(name, 12 * factor_nnz)
+        # Rather than computing the exact (2-norm) condition number, which
+        # needs an SVD, use the factorization we already have to get a cheap
+        # estimate of the 1-norm condition number
+        #   ||XtX||_1 * ||XtX^-1||_1
+        # using Higham's block 1-norm estimator (the same algorithm LAPACK
+        # uses in its *con routines). XtX is symmetric, so its inverse is too.
+        inverse = spla.LinearOperator((width, width),
+                                      matvec=sparse_solve,
+                                      rmatvec=sparse_solve,
+                                      dtype=float)
+        norm1 = abs(XtX).sum(axis=0).max()
+        with np.errstate(all="ignore"):
+            cond1 = norm1 * spla.onenormest(inverse)
+        # Like _dense_factor_solver, we only trust the estimate when it's
+        # clearly on one side of the threshold, and otherwise work out the
+        # 2-norm condition number from the extreme eigenvalues: the largest
+        # of XtX, and the largest of XtX^-1 (which, again, only needs the
+        # factorization).
+        if not (np.isfinite(cond1)
+                and cond1 * width <= _MAX_CONDITION_NUMBER):
+            _check_collinearity(cond1 / width)
+            largest = spla.eigsh(XtX, k=1, which="LA",
+                                 return_eigenvectors=False)[0]
+            inverse_largest = spla.eigsh(inverse, k=1, which="LA",
+                                         return_eigenvectors=False)[0]
+            _check_collinearity(largest * inverse_largest)
+        def solve(XtY):
+            betas = sparse_solve(np.asarray(XtY, dtype=float))
+            return np.asarray(betas).reshape(XtY.shape)
+        return solve
+    elif method == "dense":
+        # The factorization is a copy, on top of XtX itself (and if XtX is
+        # sparse, then we need a dense copy of that too).
+        copies = 2 if sp.issparse(XtX) else 1
+        budget.set(name, copies * width * width * 8)
+        if sp.issparse(XtX):
+            XtX = XtX.toarray()
+        return _dense_factor_solver(XtX)
+    else:
+        raise ValueError("unknown method %r" % (method,))
+
+def _solve_normal_equations(XtX, XtY, method="auto", budget=None):
+    """Solves XtX * betas = XtY for betas.
+
+    See _factor_normal_equations for details.
+    """
+    return _factor_normal_equations(XtX, method=method, budget=budget)(XtY)
+
+def test__solve_normal_equations():
+    from nose.tools import assert_raises
+    r = np.random.RandomState(0)
+    # A sparse, banded-ish design
+    X = sp.rand(3000, 600, density=0.01, random_state=r) + sp.eye(3000, 600)
+    X = X.tocsc()
+    XtX = (X.T * X).tocsc()
+    XtY = np.asarray(X.T * r.normal(size=(3000, 3)))
+    expected = np.linalg.solve(XtX.toarray(), XtY)
+    for method in ["auto", "sparse", "dense"]:
+        for matrix in [XtX, XtX.toarray()]:
+            if method == "sparse" or not sp.issparse(matrix):
+                got = _solve_normal_equations(matrix, XtY, method=method)
+                assert np.allclose(got, expected)
+    # 1-d right-hand sides work too
+    assert np.allclose(_solve_normal_equations(XtX, XtY[:, 0],
+                                               method="sparse"),
+                       expected[:, 0])
+    # Collinear designs are rejected by both paths
+    X_collinear = sp.hstack([X, X[:, :1]]).tocsc()
+    XtX_collinear = (X_collinear.T * X_collinear).tocsc()
+    XtY_collinear = np.ones((X_collinear.shape[1], 3))
+    for method in ["sparse", "dense"]:
+        assert_raises(ValueError, _solve_normal_equations,
+                      XtX_collinear, XtY_collinear, method=method)
+    assert_raises(ValueError, _solve_normal_equations, XtX, XtY,
+                  method="asdf")
+    # Factorizations can be reused for new right-hand sides
+    for method in ["sparse", "dense"]:
+        solve = _factor_normal_equations(XtX, method=method)
+        assert np.allclose(solve(XtY), expected)
+        assert np.allclose(solve(2 * XtY[:, :2]), 2 * expected[:, :2])
+
+def test__dense_factor_solver():
+    from nose.tools import assert_raises
+    r = np.random.RandomState(0)
+    width = 20
+    Q, _ = np.linalg.qr(r.normal(size=(width, width)))
+    XtY = r.normal(size=(width, 3))
+    # Condition numbers well below, near, and well above the threshold; the
+    # ones near it have to be settled by the exact (eigenvalue) check.
+    for cond in [10, 1e6, 5e6, 2e7, 1e9, 1e20]:
+        XtX = np.dot(Q * np.logspace(0, np.log10(cond), width), Q.T)
+        XtX = (XtX + XtX.T) / 2
+        if np.linalg.cond(XtX) > _MAX_CONDITION_NUMBER:
+            assert_raises(ValueError, _dense_factor_solver, XtX)
+        else:
+            solve = _dense_factor_solver(XtX)
+            assert np.allclose(solve(XtY), np.linalg.solve(XtX, XtY))
+            assert np.allclose(solve(XtY[:, 0]),
+                               np.linalg.solve(XtX, XtY[:, 0]))
+    # Exactly singular
+    assert_raises(ValueError, _dense_factor_solver, np.ones((3, 3)))
+    assert_raises(ValueError, _dense_factor_solver, np.zeros((3, 3)))
+
+def test__factor_normal_equations_condition():
+    # The sparse and dense factorizations agree on which matrices are too
+    # close to singular, even near the threshold where the 1-norm estimates
+    # they start from can't settle it.
+    from nose.tools import assert_raises
+    r = np.random.RandomState(1)
+    width = 200
+    Q, _ = np.linalg.qr(r.normal(size=(width, width)))
+    for cond in [10, 2e6, 5e6, 2e7, 1e9]:
+        XtX = np.dot(Q * np.logspace(0, np.log10(cond), width), Q.T)
+        XtX = (XtX + XtX.T) / 2
+        for method, matrix in [("dense", XtX),
+                               ("sparse", sp.csc_matrix(XtX))]:
+            if cond > _MAX_CONDITION_NUMBER:
+                assert_raises(ValueError, _factor_normal_equations, matrix,
+                              method=method)
+            else:
+                _factor_normal_equations(matrix, method=method)
+
+# Separate rERP requests whose epochs never share a subspan have no XtX
+# entries linking their columns, and neither do the latencies of an rERP
+# whose epochs never overlap each other. So XtX is often block diagonal, and
+# since the cost of factoring grows like the cube of the width, it's much
+# cheaper to factor each block on its own. But lots of tiny blocks would be
+# all overhead, so neighboring blocks are merged until they're at least this
+# wide.
+_MIN_BLOCK_WIDTH = 64
+
+def _continuous_blocks(XtX, rerps, design_offsets):
+    # Splits the columns of XtX into independent blocks -- sets of columns
+    # with no XtX entries linking them to any column outside the set. Returns
+    # a list of sorted arrays of column indices.
+    width = XtX.shape[0]
+    if sp.issparse(XtX):
+        _, labels = connected_components(XtX, directed=False)
+    else:
+        # Finding the connected columns of a dense XtX would need a sparse
+        # copy of it, so we only look for blocks made of whole rerps.
+        ranges = []
+        for rerp in rerps:
+            start = design_offsets[rerp]
+            ranges.append((start, start + len(rerp.design_info.column_names)
+                                          * _latency_width(rerp)))
+        links = np.zeros((len(rerps), len(rerps)), dtype=bool)
+        for i, (start_i, stop_i) in enumerate(ranges):
+            for j, (start_j, stop_j) in enumerate(ranges[:i + 1]):
+                links[i, j] = links[j, i] = np.any(XtX[start_i:stop_i,
+                                                       start_j:stop_j])
+        _, rerp_labels = connected_components(sp.csr_matrix(links),
+                                              directed=False)
+        labels = np.empty(width, dtype=int)
+        for (start, stop), label in zip(ranges, rerp_labels):
+            labels[start:stop] = label
+    # connected_components numbers the components in order of their first
+    # column.
+    order = np.argsort(labels, kind="mergesort")
+    components = np.split(order, np.flatnonzero(np.diff(labels[order])) + 1)
+    blocks = []
+    for component in components:
+        if blocks and len(blocks[-1]) < _MIN_BLOCK_WIDTH:
+            blocks[-1] = np.sort(np.concatenate([blocks[-1], component]))
+        else:
+            blocks.append(component)
+    return blocks
+
+def test__continuous_blocks():
+    global _MIN_BLOCK_WIDTH
+    class MockDesignInfo(object):
+        def __init__(self, num_predictors):
+            self.column_names = ["x"] * num_predictors
+    class MockRerp(object):
+        def __init__(self, num_predictors, ticks):
+            self.design_info = MockDesignInfo(num_predictors)
+            self.ticks = ticks
+            self.latency_basis = None
+    rerps = [MockRerp(1, 3), MockRerp(2, 2), MockRerp(1, 2)]
+    design_offsets = {rerps[0]: 0, rerps[1]: 3, rerps[2]: 7}
+    XtX = np.eye(9)
+    # Columns 0-1 interact, and so do 2 and 6 (linking the first two rerps),
+    # and 3 and 4
+    for i, j in [(0, 1), (2, 6), (3, 4)]:
+        XtX[i, j] = XtX[j, i] = 1
+    def blocks(XtX):
+        return [list(block)
+                for block in _continuous_blocks(XtX, rerps, design_offsets)]
+    old_min_block_width = _MIN_BLOCK_WIDTH
+    try:
+        _MIN_BLOCK_WIDTH = 1
+        assert blocks(sp.csc_matrix(XtX)) == [[0, 1], [2, 6], [3, 4], [5],
+                                              [7], [8]]
+        # Dense matrices are only split between rerps
+        assert blocks(XtX) == [range(7), [7, 8]]
+        _MIN_BLOCK_WIDTH = 3
+        assert blocks(sp.csc_matrix(XtX)) == [[0, 1, 2, 6], [3, 4, 5],
+                                              [7, 8]]
+    finally:
+        _MIN_BLOCK_WIDTH = old_min_block_width
+    assert blocks(sp.csc_matrix(XtX)) == [range(9)]
+
+def _factor_blocks(XtX, blocks, budget=None, workers=1):
+    """Like _factor_normal_equations, but factors each of 'blocks' (see
+    _continuous_blocks) on its own -- in up to 'workers' threads -- and
+    returns a function solve(XtY) that puts the pieces back together.
+
+    Since the blocks don't interact, this gives the same betas as factoring
+    all of XtX at once. Each block is checked for collinearity on its own.
+    """
+    if len(blocks) == 1:
+        return _factor_normal_equations(XtX, budget=budget)
+    if budget is None:
+        budget = _MemoryBudget()
+    if sp.issparse(XtX):
+        XtX = sp.csc_matrix(XtX)
+    def factor_one(i, block):
+        if sp.issparse(XtX):
+            block_XtX = XtX[block, :][:, block]
+        else:
+            block_XtX = XtX[np.ix_(block, block)]
+        return _factor_normal_equations(block_XtX, budget=budget,
+                                        name="XtX factor %s" % (i,))
+    solvers = _by_epoch_map(factor_one, list(enumerate(blocks)), workers,
+                            budget)
+    def solve(XtY):
+        XtY = np.asarray(XtY, dtype=float)
+        betas = np.empty(XtY.shape)
+        for block, block_solve in zip(blocks, solvers):
+            betas[block] = block_solve(XtY[block])
+        return betas
+    def inverse_diagonal(budget):
+        # XtX^-1 is block diagonal too
+        diagonal = np.empty(XtX.shape[0])
+        for block, block_solve in zip(blocks, solvers):
+            diagonal[block] = _inverse_diagonal(block_solve, len(block),
+                                                budget)
+        return diagonal
+    solve.inverse_diagonal = inverse_diagonal
+    return solve
+
+def test__factor_blocks():
+    from nose.tools import assert_raises
+    r = np.random.RandomState(0)
+    X = np.zeros((40, 7))
+    X[:20, :4] = r.normal(size=(20, 4))
+    X[20:, 4:] = r.normal(size=(20, 3))
+    XtX = np.dot(X.T, X)
+    XtY = r.normal(size=(7, 2))
+    expected = np.linalg.solve(XtX, XtY)
+    blocks = [np.arange(4), np.arange(4, 7)]
+    for matrix in [XtX, sp.csc_matrix(XtX)]:
+        for workers in [1, 2]:
+            budget = _MemoryBudget()
+            solve = _factor_blocks(matrix, blocks, budget, workers)
+            assert np.allclose(solve(XtY), expected)
+            assert np.allclose(solve(XtY[:, 0]), expected[:, 0])
+            # Each block's factor is accounted for separately (and small
+            # sparse blocks get factored densely, which needs a dense copy)
+            copies = 2 if sp.issparse(matrix) else 1
+            assert budget.used() == copies * (4 * 4 + 3 * 3) * 8
+    # A collinear block is still caught
+    XtX[4:, 4:] = 1
+    assert_raises(ValueError, _factor_blocks, XtX, blocks)
+
+################################################################
+# Penalized (ridge) regression
 ################################################################
 
-def _fit_continuous(dataset, analysis_subspans, rerps, log_stream):
+# With penalty= and smoothness_penalty=, instead of plain least squares we
+# minimize
+#   ||Y - X B||^2 + penalty * ||B||^2 + smoothness_penalty * ||D B||^2
+# where D takes the differences between each predictor's betas at
+# neighboring latencies. This just means solving
+#   (XtX + P) B = XtY
+# with P = penalty * I + smoothness_penalty * D'D, which is at least as well
+# conditioned as XtX, and sparse, so all the usual machinery works.
+#
+# With penalty_path=, we fit a whole list of penalty values, and score each
+# by generalized cross-validation:
+#   GCV = n * RSS / (n - df)^2
+# where df = tr((XtX + P)^-1 XtX) is the effective number of parameters.
+# The trick is to eigendecompose XtX + smoothness_penalty * D'D = V S V'
+# once; then each penalty just shifts the eigenvalues, and
+#   B = V (V' XtY) / (S + penalty)
+# is cheap.
+
+def _check_penalty_options(penalty, smoothness_penalty, penalty_path):
+    if penalty < 0 or smoothness_penalty < 0:
+        raise ValueError("penalties can't be negative")
+    if penalty_path is not None:
+        if penalty != 0:
+            raise ValueError("give penalty= or penalty_path=, not both")
+        if len(penalty_path) == 0 or min(penalty_path) < 0:
+            raise ValueError("penalty_path= must be a non-empty list of "
+                             "non-negative penalties")
+
+def _difference_penalty(width, block_starts):
+    # D'D, where D takes the differences between neighboring columns, except
+    # across the boundaries between blocks (which start at 'block_starts').
+    block_starts = np.asarray(block_starts, dtype=int)
+    first = np.zeros(width, dtype=bool)
+    first[block_starts] = True
+    last = np.zeros(width, dtype=bool)
+    last[np.concatenate((block_starts[1:], [width])) - 1] = True
+    main = 2.0 - first - last
+    off = -1.0 * ~first[1:]
+    return sp.diags([off, main, off], [-1, 0, 1], shape=(width, width),
+                    format="csc")
+
+def test__difference_penalty():
+    got = _difference_penalty(5, [0, 3]).toarray()
+    assert np.array_equal(got, [[1, -1, 0, 0, 0],
+                                [-1, 2, -1, 0, 0],
+                                [0, -1, 1, 0, 0],
+                                [0, 0, 0, 1, -1],
+                                [0, 0, 0, -1, 1]])
+    # It really is D'D
+    B = np.random.RandomState(0).normal(size=5)
+    D_B = np.concatenate((np.diff(B[:3]), np.diff(B[3:])))
+    assert np.allclose(np.dot(B, np.dot(got, B)), np.sum(D_B ** 2))
+    # Blocks of length 1 have nothing to be smooth with
+    assert np.array_equal(_difference_penalty(2, [0, 1]).toarray(),
+                          np.zeros((2, 2)))
+
+def _continuous_penalty(rerps, design_offsets, full_design_width, penalty,
+                        smoothness_penalty):
+    # Returns the penalty matrix P for the full continuous design, or None
+    # if there's no penalty.
+    if penalty == 0 and smoothness_penalty == 0:
+        return None
+    # (With a latency basis, the penalties apply to the basis coefficients;
+    # for B-splines, the smoothness penalty is then a "P-spline" penalty.)
+    block_starts = []
+    for rerp in rerps:
+        for i in xrange(len(rerp.design_info.column_names)):
+            block_starts.append(design_offsets[rerp]
+                                + i * _latency_width(rerp))
+    return (penalty * sp.eye(full_design_width, format="csc")
+            + smoothness_penalty * _difference_penalty(full_design_width,
+                                                       block_starts))
+
+def _add_penalty(XtX, penalty_matrix):
+    if penalty_matrix is None:
+        return XtX
+    if sp.issparse(XtX):
+        return (XtX + penalty_matrix).tocsc()
+    return XtX + penalty_matrix.toarray()
+
+def _gcv(rows, rss, df):
+    if rows <= df:
+        return np.inf
+    return rows * np.sum(rss) / (rows - df) ** 2
+
+def _penalty_path(XtX, XtY, YtY, rows, smoothing, penalties, budget=None):
+    """Solves the penalized normal equations for each of 'penalties'.
+
+    XtX may be dense or sparse; 'smoothing' is smoothness_penalty * D'D, or
+    None. YtY is the sum of squares of each column of Y, and 'rows' is the
+    number of rows in X; they're needed for the GCV scores.
+
+    Returns a list of betas, one for each penalty, and an array of GCV
+    scores. Penalties that leave the equations too close to singular get
+    None for their betas and an infinite score; if they all do, then we
+    raise a ValueError.
+    """
+    if budget is None:
+        budget = _MemoryBudget()
+    width = XtX.shape[0]
+    # XtX, plus the eigenvectors, plus V' XtX V (or a temporary). This is
+    # dense even when XtX is sparse, so check before we try to allocate it.
+    dense_bytes = 3 * width * width * 8
+    if not budget.fits("XtX factor", dense_bytes):
+        raise ValueError("penalty_path= needs a dense eigendecomposition of "
+                         "the %s x %s XtX matrix (%s bytes), which is more "
+                         "than memory_limit= (%s bytes) allows; try raising "
+                         "memory_limit=, or fitting the penalties one at a "
+                         "time with penalty="
+                         % (width, width, dense_bytes, budget.limit))
+    budget.set("XtX factor", dense_bytes)
+    if sp.issparse(XtX):
+        XtX = XtX.toarray()
+    A = _add_penalty(XtX, smoothing)
+    eigenvalues, V = np.linalg.eigh(A)
+    Z = np.dot(V.T, XtY)
+    if smoothing is None:
+        # V' XtX V is just the eigenvalues
+        G = None
+        G_diagonal = eigenvalues
+    else:
+        G = np.dot(V.T, np.dot(XtX, V))
+        G_diagonal = np.diag(G)
+    all_betas = []
+    scores = []
+    for penalty in penalties:
+        shifted = eigenvalues + penalty
+        if not _well_conditioned(shifted):
+            all_betas.append(None)
+            scores.append(np.inf)
+            continue
+        C = Z / shifted[:, np.newaxis]
+        if G is None:
+            BtXtXB = np.sum(eigenvalues[:, np.newaxis] * C ** 2, axis=0)
+        else:
+            BtXtXB = np.sum(C * np.dot(G, C), axis=0)
+        rss = YtY - 2 * np.sum(C * Z, axis=0) + BtXtXB
+        all_betas.append(np.dot(V, C))
+        scores.append(_gcv(rows, rss, np.sum(G_diagonal / shifted)))
+    if all([betas is None for betas in all_betas]):
+        raise ValueError(_COLLINEAR_MSG)
+    return all_betas, np.asarray(scores)
+
+def test__penalty_path():
+    from nose.tools import assert_raises
+    r = np.random.RandomState(0)
+    X = r.normal(size=(50, 6))
+    Y = r.normal(size=(50, 2))
+    XtX = np.dot(X.T, X)
+    XtY = np.dot(X.T, Y)
+    YtY = np.sum(Y ** 2, axis=0)
+    smoothing = 2 * _difference_penalty(6, [0, 3])
+    for s in [None, smoothing]:
+        penalties = [0, 1, 10]
+        all_betas, scores = _penalty_path(sp.csc_matrix(XtX), XtY, YtY, 50,
+                                          s, penalties)
+        for penalty, betas, score in zip(penalties, all_betas, scores):
+            A = XtX + penalty * np.eye(6)
+            if s is not None:
+                A += s.toarray()
+            expected = np.linalg.solve(A, XtY)
+            assert np.allclose(betas, expected)
+            rss = np.sum((Y - np.dot(X, expected)) ** 2)
+            df = np.trace(np.dot(np.linalg.inv(A), XtX))
+            assert np.allclose(score, 50 * rss / (50 - df) ** 2)
+    # Collinear designs only work with a big enough penalty
+    X2 = np.column_stack((X, X[:, 0]))
+    all_betas, scores = _penalty_path(np.dot(X2.T, X2), np.dot(X2.T, Y),
+                                      YtY, 50, None, [0, 1])
+    assert all_betas[0] is None
+    assert scores[0] == np.inf
+    assert all_betas[1] is not None
+    assert_raises(ValueError, _penalty_path, np.dot(X2.T, X2),
+                  np.dot(X2.T, Y), YtY, 50, None, [0])
+    # The dense eigendecomposition has to fit in the memory budget, even if
+    # XtX came in sparse
+    assert_raises(ValueError, _penalty_path, sp.csc_matrix(XtX), XtY, YtY,
+                  50, None, [1], budget=_MemoryBudget(3 * 6 * 6 * 8 - 1))
+    _penalty_path(sp.csc_matrix(XtX), XtY, YtY, 50, None, [1],
+                  budget=_MemoryBudget(3 * 6 * 6 * 8))
+
+def _block_pcg(XtX_times, XtY, diagonal, tolerance, max_iterations):
+    """Solves XtX * betas = XtY by preconditioned conjugate gradients.
+
+    XtX is only available implicitly, through XtX_times(P), which should
+    return XtX * P for a matrix P whose columns are search directions. Each
+    column of XtY gets its own independent CG iteration, but they all step
+    together, so each iteration needs only one product (i.e., one pass over
+    the design matrix) for all the channels at once. 'diagonal' is the
+    diagonal of XtX, used as a Jacobi preconditioner.
+
+    Iteration stops once every column's normal-equations residual
+      ||XtY - XtX * betas||
+    is at most 'tolerance' times ||XtY||. Returns (betas, iterations,
+    residuals), where residuals is XtY - XtX * betas. Raises a ValueError if
+    it doesn't converge within max_iterations iterations.
+    """
+    width, num_columns = XtY.shape
+    if np.any(diagonal <= 0):
+        # A design column that's all zeros.
+        raise ValueError(_COLLINEAR_MSG)
+    inverse_diagonal = 1.0 / diagonal[:, np.newaxis]
+    betas = np.zeros((width, num_columns))
+    residuals = np.array(XtY, dtype=float)
+    directions = inverse_diagonal * residuals
+    rz = np.sum(residuals * directions, axis=0)
+    thresholds = tolerance * np.sqrt(np.sum(residuals ** 2, axis=0))
+    active = np.sqrt(np.sum(residuals ** 2, axis=0)) > thresholds
+    iterations = 0
+    while active.any():
+        if iterations >= max_iterations:
+            raise ValueError("iterative solver failed to converge in %s "
+                             "iterations; try increasing "
+                             "iterative_max_iterations or "
+                             "iterative_tolerance" % (iterations,))
+        iterations += 1
+        cols = np.flatnonzero(active)
+        P = directions[:, cols]
+        XtX_P = XtX_times(P)
+        pAp = np.sum(P * XtX_P, axis=0)
+        if np.any(pAp <= 0):
+            # Can only happen if XtX is singular (or nearly so)
+            raise ValueError(_COLLINEAR_MSG)
+        alpha = rz[cols] / pAp
+        betas[:, cols] += alpha * P
+        residuals[:, cols] -= alpha * XtX_P
+        z = inverse_diagonal * residuals[:, cols]
+        new_rz = np.sum(residuals[:, cols] * z, axis=0)
+        directions[:, cols] = z + (new_rz / rz[cols]) * P
+        rz[cols] = new_rz
+        residual_norms = np.sqrt(np.sum(residuals[:, cols] ** 2, axis=0))
+        active[cols] = residual_norms > thresholds[cols]
+    return betas, iterations, residuals
+
+def test__block_pcg():
+    from nose.tools import assert_raises
+    r = np.random.RandomState(0)
+    X = sp.rand(2000, 200, density=0.02, random_state=r) + sp.eye(2000, 200)
+    X = X.tocsc()
+    XtX = (X.T * X).tocsc()
+    # Give the columns very different scales, so the preconditioner has
+    # something to do
+    XtY = np.asarray(X.T * r.normal(size=(2000, 4))) * [1, 10, 1e3, 1e-3]
+    expected = np.linalg.solve(XtX.toarray(), XtY)
+    calls = []
+    def XtX_times(P):
+        calls.append(P.shape[1])
+        return np.asarray(XtX * P)
+    diagonal = XtX.diagonal()
+    betas, iterations, residuals = _block_pcg(XtX_times, XtY, diagonal,
+                                              1e-12, 1000)
+    assert np.allclose(betas, expected)
+    assert np.allclose(residuals, XtY - XtX * betas)
+    assert 0 < iterations < 200
+    assert len(calls) == iterations
+    # All columns are handled together
+    assert calls[0] == 4
+    # Looser tolerances take fewer iterations
+    _, loose_iterations, _ = _block_pcg(XtX_times, XtY, diagonal, 1e-3, 1000)
+    assert loose_iterations < iterations
+    assert_raises(ValueError, _block_pcg, XtX_times, XtY, diagonal, 1e-12, 2)
+    # An empty design column can't be solved for
+    diagonal[3] = 0
+    assert_raises(ValueError, _block_pcg, XtX_times, XtY, diagonal, 1e-12,
+                  1000)
+    # All-zero right-hand sides are trivial
+    betas, iterations, _ = _block_pcg(XtX_times, np.zeros((200, 2)),
+                                      XtX.diagonal(), 1e-12, 1000)
+    assert iterations == 0
+    assert np.all(betas == 0)
+
+def _continuous_design_layout(rerps):
     # Work out the size of the full design matrices, and the offset of each
     # rerp's individual design matrix within this overall design matrix.
     full_design_width = 0
@@ -1322,75 +4062,1196 @@ def _fit_continuous(dataset, analysis_subspans, rerps, log_stream):
         design_offsets[rerp] = full_design_width
         # Now figure out how many columns it takes up
         this_design_width = len(rerp.design_info.column_names)
-        full_design_width += this_design_width * rerp.ticks
-    # This was originally parallelized, but the parallel version always went
-    # slower than the serial version, and both seem to be pretty fast,
-    # so... eh. Low-hanging fruit for speeding it up would be to use CHOLMOD.
-    XtX = np.zeros((full_design_width, full_design_width))
-    XtY = np.zeros((full_design_width, dataset.data_format.num_channels))
+        full_design_width += this_design_width * _latency_width(rerp)
+    return design_offsets, full_design_width
+
+def _latency_width(rerp):
+    # How many columns each of 'rerp's predictors takes up in the continuous
+    # design: one per tick, or one per latency basis function.
+    if rerp.latency_basis is None:
+        return rerp.ticks
+    return rerp.latency_basis.shape[1]
+
+def _latency_basis(request, ticks):
+    # Returns the (ticks x n) latency basis matrix for 'request', or None.
+    spec = request.latency_basis
+    if spec is None:
+        return None
+    if isinstance(spec, (int, long)):
+        degree = request.latency_basis_degree
+        if not degree + 1 <= spec <= ticks:
+            raise ValueError("latency_basis=%s for rERP %r is not between "
+                             "latency_basis_degree + 1 (%s) and the number "
+                             "of ticks in the epoch (%s)"
+                             % (spec, request.name, degree + 1, ticks))
+        return _bspline_basis(ticks, spec, degree)
+    basis = np.asarray(spec, dtype=float)
+    if basis.ndim != 2 or basis.shape[0] != ticks:
+        raise ValueError("latency_basis for rERP %r should have one row for "
+                         "each of the epoch's %s ticks, but has shape %s"
+                         % (request.name, ticks, basis.shape))
+    return basis
+
+def _bspline_basis(ticks, num_functions, degree):
+    # The B-spline basis with 'num_functions' functions of the given degree,
+    # with evenly spaced knots over latencies 0 ... ticks - 1, evaluated at
+    # each latency.
+    from scipy.interpolate import splev
+    interior = np.linspace(0, ticks - 1, num_functions - degree + 1)[1:-1]
+    knots = np.concatenate(([0.0] * (degree + 1), interior,
+                            [ticks - 1.0] * (degree + 1)))
+    latencies = np.arange(ticks, dtype=float)
+    basis = np.empty((ticks, num_functions))
+    for i in xrange(num_functions):
+        coefs = np.zeros(len(knots))
+        coefs[i] = 1
+        basis[:, i] = splev(latencies, (knots, coefs, degree))
+    return basis
+
+def test__bspline_basis():
+    for ticks, num_functions, degree in [(100, 10, 3), (50, 7, 2),
+                                         (20, 4, 3), (30, 2, 1)]:
+        basis = _bspline_basis(ticks, num_functions, degree)
+        assert basis.shape == (ticks, num_functions)
+        assert np.all(basis >= -1e-12)
+        # B-splines add up to one everywhere, so they can make a constant
+        assert np.allclose(basis.sum(axis=1), 1)
+        # And each is nonzero over at most degree + 1 knot intervals
+        assert np.all(np.sum(basis > 1e-12, axis=1) <= degree + 1)
+    # Tent functions with a knot at every tick are the same as no basis
+    assert np.allclose(_bspline_basis(10, 10, 1), np.eye(10))
+    # Tent functions at every 3rd tick interpolate linearly
+    assert np.allclose(_bspline_basis(7, 3, 1),
+                       [[1, 0, 0], [2. / 3, 1. / 3, 0], [1. / 3, 2. / 3, 0],
+                        [0, 1, 0], [0, 2. / 3, 1. / 3], [0, 1. / 3, 2. / 3],
+                        [0, 0, 1]])
+
+def test__latency_basis():
+    from nose.tools import assert_raises
+    assert _latency_basis(rERPRequest("a", 0, 10, "1"), 11) is None
+    basis = _latency_basis(rERPRequest("a", 0, 10, "1", latency_basis=4),
+                           11)
+    assert np.allclose(basis, _bspline_basis(11, 4, 3))
+    basis = _latency_basis(rERPRequest("a", 0, 10, "1", latency_basis=4,
+                                       latency_basis_degree=1), 11)
+    assert np.allclose(basis, _bspline_basis(11, 4, 1))
+    custom = np.ones((11, 1))
+    assert np.array_equal(
+        _latency_basis(rERPRequest("a", 0, 10, "1", latency_basis=custom),
+                       11),
+        custom)
+    for bad in [3, 12]:
+        assert_raises(ValueError, _latency_basis,
+                      rERPRequest("a", 0, 10, "1", latency_basis=bad), 11)
+    assert_raises(ValueError, _latency_basis,
+                  rERPRequest("a", 0, 10, "1", latency_basis=custom), 12)
+    assert_raises(ValueError, _latency_basis,
+                  rERPRequest("a", 0, 10, "1", latency_basis=np.ones(11)), 11)
+
+# The continuous design matrix is built and multiplied out in strips covering
+# runs of consecutive subspans, up to about this many data points at a
+# time. Many subspans are only a few ticks long, so doing them one at a time
+# means paying all the per-strip overhead (building the sparse matrix,
+# computing X'X, ...) over and over for very little data.
+_STRIP_MAX_ROWS = 10000
+
+def _strip_batches(subspans, max_rows=_STRIP_MAX_ROWS):
+    # Yields (start, stop) index pairs splitting 'subspans' into runs of
+    # consecutive subspans covering at most 'max_rows' data points (except
+    # that a single subspan bigger than that gets a batch to itself).
+    batch_start = 0
+    batch_rows = 0
+    for i, subspan in enumerate(subspans):
+        ticks = subspan.stop[1] - subspan.start[1]
+        if batch_rows > 0 and batch_rows + ticks > max_rows:
+            yield (batch_start, i)
+            batch_start = i
+            batch_rows = 0
+        batch_rows += ticks
+    if batch_start < len(subspans):
+        yield (batch_start, len(subspans))
+
+def test__strip_batches():
+    def ss(start, stop):
+        return _DataSubSpan((0, start), (0, stop), None, None)
+    subspans = [ss(0, 3), ss(3, 5), ss(5, 20), ss(20, 21), ss(21, 24)]
+    assert list(_strip_batches(subspans, 5)) == [(0, 2), (2, 3), (3, 5)]
+    assert list(_strip_batches(subspans, 100)) == [(0, 5)]
+    assert list(_strip_batches(subspans, 1)) == [(0, 1), (1, 2), (2, 3),
+                                                 (3, 4), (4, 5)]
+    assert list(_strip_batches([], 10)) == []
+
+def _continuous_strip_data(dataset, subspans):
+    # Loads the data for 'subspans', stacked one after another. Subspans
+    # which abut each other are read with a single raw_slice call.
+    pieces = []
+    run_start = None
+    for subspan in subspans:
+        if run_start is not None and run_stop == subspan.start:
+            run_stop = subspan.stop
+            continue
+        if run_start is not None:
+            pieces.append(dataset.raw_slice(run_start[0],
+                                            run_start[1], run_stop[1]))
+        run_start, run_stop = subspan.start, subspan.stop
+    if run_start is not None:
+        pieces.append(dataset.raw_slice(run_start[0],
+                                        run_start[1], run_stop[1]))
+    if len(pieces) == 1:
+        return pieces[0]
+    return np.concatenate(pieces, axis=0)
+
+def _continuous_strip(subspans, design_offsets, full_design_width):
+    # Builds the rows of the full design matrix corresponding to 'subspans'
+    # (stacked one after another), as a csc_matrix.
+    #
+    # Within a subspan every epoch covers every tick, so each (subspan,
+    # epoch, predictor) triple contributes a diagonal "run" of entries: the
+    # k-th tick of the subspan has the predictor's value in column
+    #   col0 + k
+    # where col0 is the column for that predictor at the latency where the
+    # subspan starts. So we describe each run by (row0, col0, length, value),
+    # and then expand all the runs at once using index arithmetic, like
+    # sparse_design_slice in scripts/overlap-rerp-for-sccn.py does.
+    #
+    # If any rerp has a latency basis, then its entries then get spread out
+    # over the basis functions (see _latency_basis_entries).
+    #
+    # A "pair" is one epoch in one subspan; _subspan_epochs lists them.
+    pair_epochs, pair_subspans = _subspan_epochs(subspans)
+    subspan_ticks = _subspan_ticks(subspans)
+    subspan_row0 = np.cumsum(subspan_ticks) - subspan_ticks
+    num_rows = int(subspan_ticks.sum())
+    if not pair_epochs:
+        return sp.csc_matrix((num_rows, full_design_width))
+    num_pairs = len(pair_epochs)
+    pair_rerps = map(attrgetter("rerp"), pair_epochs)
+    subspan_start = np.asarray([subspan.start[1] for subspan in subspans],
+                               dtype=np.int64)
+    pair_start = np.fromiter(map(attrgetter("start_tick"), pair_epochs),
+                             dtype=np.int64, count=num_pairs)
+    pair_stop = np.fromiter(map(attrgetter("stop_tick"), pair_epochs),
+                            dtype=np.int64, count=num_pairs)
+    # Where each pair's subspan starts, relative to the start of its epoch
+    pair_latency0 = subspan_start[pair_subspans] - pair_start
+    pair_col0 = (np.fromiter(map(design_offsets.__getitem__, pair_rerps),
+                             dtype=np.int64, count=num_pairs)
+                 + pair_latency0)
+    pair_stride = pair_stop - pair_start
+    design_rows = map(attrgetter("design_row"), pair_epochs)
+    pair_predictors = np.fromiter(map(len, design_rows), dtype=np.int64,
+                                  count=num_pairs)
+    run_values = np.concatenate(design_rows).astype(float)
+    # One run per (pair, predictor)
+    num_runs = run_values.shape[0]
+    run_pairs = np.repeat(np.arange(num_pairs), pair_predictors)
+    run_predictor = (np.arange(num_runs)
+                     - np.repeat(np.cumsum(pair_predictors) - pair_predictors,
+                                 pair_predictors))
+    run_col0 = pair_col0[run_pairs] + run_predictor * pair_stride[run_pairs]
+    run_row0 = subspan_row0[pair_subspans[run_pairs]]
+    run_lengths = subspan_ticks[pair_subspans[run_pairs]]
+    # One entry per (run, tick)
+    nnz = int(run_lengths.sum())
+    entry_runs = np.repeat(np.arange(num_runs), run_lengths)
+    entry_k = (np.arange(nnz)
+               - np.repeat(np.cumsum(run_lengths) - run_lengths, run_lengths))
+    rows = run_row0[entry_runs] + entry_k
+    values = run_values[entry_runs]
+    if any([rerp._latency_basis_csr is not None
+            for rerp in set(pair_rerps)]):
+        rows, cols, values = _latency_basis_entries(
+            pair_rerps, pair_latency0, pair_stride, design_offsets,
+            run_pairs[entry_runs], run_predictor[entry_runs], entry_k, rows,
+            values)
+    else:
+        cols = run_col0[entry_runs] + entry_k
+    # Put the entries in column-major order, and write out the CSC arrays
+    # directly. If two events of the same type occur at exactly the same time
+    # then we can get two entries at the same (row, col) coordinate; this is
+    # fine, because scipy.sparse treats duplicate entries as being added
+    # together, which is exactly what we want.
+    order = np.lexsort((rows, cols))
+    indptr = np.zeros(full_design_width + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(np.bincount(cols, minlength=full_design_width))
+    return sp.csc_matrix((values[order], rows[order], indptr),
+                         shape=(num_rows, full_design_width))
+
+def _latency_basis_entries(pair_rerps, pair_latency0, pair_ticks,
+                           design_offsets, entry_pairs, entry_predictors,
+                           entry_k, rows, values):
+    # Each design matrix entry is some epoch's value for some predictor at
+    # some latency. With a latency basis, it turns into one entry for each
+    # basis function that's nonzero at that latency, scaled by the
+    # function's value there. Rerps without a basis get the identity matrix
+    # as their "basis", and then we stack all the bases up, so that we can
+    # expand every entry at once by looking up rows of the stack. Returns
+    # the new rows, columns, and values.
+    #
+    # The pair_* arguments describe each (subspan, epoch) pair: the epoch's
+    # rerp, the latency within the epoch where the subspan starts, and the
+    # epoch's length in ticks.
+    stack = []
+    stack_row0 = {}
+    widths = {}
+    stack_height = 0
+    # Every epoch of a rerp is the same length
+    rerp_ticks = dict(zip(pair_rerps, pair_ticks.tolist()))
+    for rerp, ticks in rerp_ticks.items():
+        basis = rerp._latency_basis_csr
+        if basis is None:
+            basis = sp.identity(ticks, format="csr")
+        stack.append(basis)
+        stack_row0[rerp] = stack_height
+        widths[rerp] = basis.shape[1]
+        stack_height += basis.shape[0]
+    # (vstack needs them all to be the same width)
+    max_width = max(widths.values())
+    stack = sp.vstack([sp.csr_matrix((basis.data, basis.indices,
+                                      basis.indptr),
+                                     shape=(basis.shape[0], max_width))
+                       for basis in stack], format="csr")
+    num_pairs = len(pair_rerps)
+    pair_row0 = (np.fromiter(map(stack_row0.__getitem__, pair_rerps),
+                             dtype=np.int64, count=num_pairs)
+                 + pair_latency0)
+    pair_col0 = np.fromiter(map(design_offsets.__getitem__, pair_rerps),
+                            dtype=np.int64, count=num_pairs)
+    pair_width = np.fromiter(map(widths.__getitem__, pair_rerps),
+                             dtype=np.int64, count=num_pairs)
+    stack_rows = pair_row0[entry_pairs] + entry_k
+    counts = np.diff(stack.indptr)[stack_rows]
+    total = int(counts.sum())
+    positions = (np.repeat(stack.indptr[stack_rows]
+                           - (np.cumsum(counts) - counts), counts)
+                 + np.arange(total))
+    cols = (np.repeat(pair_col0[entry_pairs]
+                      + entry_predictors * pair_width[entry_pairs], counts)
+            + stack.indices[positions])
+    return (np.repeat(rows, counts), cols,
+            np.repeat(values, counts) * stack.data[positions])
+
+def test__continuous_strip():
+    class MockRerp(object):
+        _latency_basis_csr = None
+    a = MockRerp()
+    b = MockRerp()
+    design_offsets = {a: 0, b: 6}
+    full_design_width = 9
+    # 'a' has 2 predictors and 3 ticks, 'b' has 1 predictor and 3 ticks
+    e1 = _Epoch(0, 10, 13, np.array([1.0, 2.0]), a, None)
+    e2 = _Epoch(0, 11, 14, np.array([3.0]), b, None)
+    e3 = _Epoch(0, 11, 14, np.array([4.0, 5.0]), a, None)
+    subspans = [_DataSubSpan((0, 10), (0, 11), [e1], None),
+                _DataSubSpan((0, 11), (0, 13), [e1, e2, e3], None),
+                _DataSubSpan((0, 13), (0, 14), [e2, e3], None),
+                _DataSubSpan((0, 20), (0, 22), [], None),
+                ]
+    expected = np.zeros((6, full_design_width))
+    # e1 covers rows 0-2 (ticks 10-12)
+    for k in xrange(3):
+        expected[k, 0 + k] += 1.0
+        expected[k, 3 + k] += 2.0
+    # e2 and e3 cover rows 1-3 (ticks 11-13)
+    for k in xrange(3):
+        expected[1 + k, 6 + k] += 3.0
+        expected[1 + k, 0 + k] += 4.0
+        expected[1 + k, 3 + k] += 5.0
+    strip = _continuous_strip(subspans, design_offsets, full_design_width)
+    assert isinstance(strip, sp.csc_matrix)
+    assert np.allclose(strip.toarray(), expected)
+    # Simultaneous events of the same type get added together
+    e4 = _Epoch(0, 11, 14, np.array([4.0, 5.0]), a, None)
+    strip = _continuous_strip([_DataSubSpan((0, 11), (0, 12), [e3, e4], None)],
+                              design_offsets, full_design_width)
+    assert np.allclose(strip.toarray()[0, [0, 3]], [8.0, 10.0])
+    empty = _continuous_strip(subspans[3:], design_offsets, full_design_width)
+    assert empty.shape == (2, full_design_width)
+    assert empty.nnz == 0
+    # With a latency basis, the strip is the plain one times the (block
+    # diagonal) basis
+    basis = np.asarray([[1.0, 0.0], [0.5, 0.5], [0.0, 1.0]])
+    a._latency_basis_csr = sp.csr_matrix(basis)
+    strip = _continuous_strip(subspans, {a: 0, b: 4}, 7)
+    expansion = scipy.linalg.block_diag(basis, basis, np.eye(3))
+    assert np.allclose(strip.toarray(), np.dot(expected, expansion))
+
+# Very roughly, how many bytes of temporary arrays _continuous_strip needs
+# per non-zero entry in the design matrix.
+_STRIP_BYTES_PER_NNZ = 96
+
+# How big to make the strips of the design matrix: at most 'max_rows' data
+# points each, where each data point takes about 'bytes_per_row' bytes.
+_StripPlan = namedtuple("_StripPlan", ["max_rows", "bytes_per_row"])
+
+def _plan_strips(subspans, num_channels, budget, share=1, itemsize=8):
+    # Works out how big strips can be while staying within the budget, and
+    # splits up any subspans that are too long to fit into a single strip
+    # (which is always possible, since every epoch in a subspan covers all
+    # of it). Strips get at most half of the available memory, since XtX
+    # might still grow as we go. 'share' is the number of strips that will
+    # be in memory at once (e.g., one per worker process), and 'itemsize' is
+    # the size of each data value. Returns the new list of subspans, and a
+    # _StripPlan.
+    # (With a latency basis, each predictor can have an entry for each
+    # basis function that's nonzero at a given latency.)
+    basis_nnz = {}
+    def nnz_per_value(rerp):
+        if rerp not in basis_nnz:
+            basis = rerp._latency_basis_csr
+            basis_nnz[rerp] = 1
+            if basis is not None:
+                basis_nnz[rerp] = int(np.diff(basis.indptr).max())
+        return basis_nnz[rerp]
+    nnz_per_row = 0
+    for subspan in subspans:
+        nnz = sum([epoch.design_row.shape[0] * nnz_per_value(epoch.rerp)
+                   for epoch in subspan.epochs])
+        nnz_per_row = max(nnz_per_row, nnz)
+    # The data (and a copy of it, e.g. from _continuous_strip_data's
+    # np.concatenate), plus the design matrix.
+    bytes_per_row = (2 * itemsize * num_channels
+                     + _STRIP_BYTES_PER_NNZ * nnz_per_row)
+    available = budget.available("strip")
+    if available == np.inf:
+        return subspans, _StripPlan(_STRIP_MAX_ROWS, bytes_per_row)
+    max_rows = int(available // (2 * share * bytes_per_row))
+    if max_rows < 1:
+        # Not even room for a single row; let the budget complain.
+        budget.set("strip", 2 * share * bytes_per_row)
+    max_rows = min(max_rows, _STRIP_MAX_ROWS)
+    split = []
+    for subspan in subspans:
+        recspan_id, start = subspan.start
+        stop = subspan.stop[1]
+        while stop - start > max_rows:
+            split.append(subspan._replace(start=(recspan_id, start),
+                                          stop=(recspan_id,
+                                                start + max_rows)))
+            start += max_rows
+        split.append(subspan._replace(start=(recspan_id, start)))
+    return split, _StripPlan(max_rows, bytes_per_row)
+
+def test__plan_strips():
+    from nose.tools import assert_raises
+    class MockRerp(object):
+        _latency_basis_csr = None
+    e = _Epoch(0, 0, 100, np.array([1.0, 2.0]), MockRerp(), None)
+    subspans = [_DataSubSpan((0, 0), (0, 10), [e], []),
+                _DataSubSpan((0, 10), (0, 100), [e, e], [])]
+    # 2 channels, and 4 non-zeros per row
+    bytes_per_row = 2 * 8 * 2 + _STRIP_BYTES_PER_NNZ * 4
+    got, plan = _plan_strips(subspans, 2, _MemoryBudget())
+    assert got == subspans
+    assert plan == (_STRIP_MAX_ROWS, bytes_per_row)
+    budget = _MemoryBudget(2 * 40 * bytes_per_row + 100)
+    got, plan = _plan_strips(subspans, 2, budget)
+    assert plan == (40, bytes_per_row)
+    assert [(s.start, s.stop) for s in got] == [((0, 0), (0, 10)),
+                                                ((0, 10), (0, 50)),
+                                                ((0, 50), (0, 90)),
+                                                ((0, 90), (0, 100))]
+    assert [s.epochs for s in got] == [[e], [e, e], [e, e], [e, e]]
+    # Sharing the memory between two workers makes for smaller strips
+    _, plan = _plan_strips(subspans, 2, budget, share=2)
+    assert plan.max_rows == 20
+    # float32 data takes less room
+    _, plan = _plan_strips(subspans, 2, _MemoryBudget(), itemsize=4)
+    assert plan.bytes_per_row == 8 * 2 + _STRIP_BYTES_PER_NNZ * 4
+    budget.set("XtY", budget.limit - 10)
+    assert_raises(ValueError, _plan_strips, subspans, 2, budget)
+
+def _add_XtY(XtY, x_strip, data, budget):
+    # Does XtY += x_strip.T * data, but only touching the rows of XtY that
+    # this strip actually has non-zeros in, and working through the
+    # channels in blocks that fit in the memory budget.
+    cols = np.flatnonzero(np.diff(x_strip.indptr))
+    if not cols.shape[0]:
+        return
+    x_used = x_strip[:, cols]
+    num_channels = data.shape[1]
+    # The product, plus a copy for the indexed +=
+    bytes_per_channel = 2 * 8 * cols.shape[0]
+    block = num_channels
+    available = budget.available("XtY block")
+    if available < block * bytes_per_channel:
+        block = max(1, int(available // bytes_per_channel))
+    budget.set("XtY block", block * bytes_per_channel)
+    for i in xrange(0, num_channels, block):
+        channels = slice(i, i + block)
+        XtY[cols, channels] += np.asarray(x_used.T * data[:, channels])
+    budget.clear("XtY block")
+
+def test__add_XtY():
+    from nose.tools import assert_raises
+    r = np.random.RandomState(0)
+    x_strip = sp.csc_matrix(np.asarray([[1, 0, 0, 2, 0],
+                                        [0, 0, 0, 3, 0],
+                                        [4, 0, 0, 0, 0]], dtype=float))
+    data = r.normal(size=(3, 7))
+    expected = np.ones((5, 7)) + np.asarray(x_strip.T * data)
+    for limit in [None, 2 * 8 * 2 * 7, 2 * 8 * 2 * 3, 2 * 8 * 2]:
+        XtY = np.ones((5, 7))
+        budget = _MemoryBudget(limit)
+        _add_XtY(XtY, x_strip, data, budget)
+        assert np.allclose(XtY, expected)
+        if limit is not None:
+            assert budget.peak <= limit
+    XtY = np.ones((5, 7))
+    _add_XtY(XtY, sp.csc_matrix((3, 5)), data, _MemoryBudget())
+    assert np.all(XtY == 1)
+    assert_raises(ValueError, _add_XtY, XtY, x_strip, data,
+                  _MemoryBudget(2 * 8 * 2 - 1))
+
+def _accumulate_continuous(dataset, subspans, design_offsets,
+                           full_design_width, progress_bar=None,
+                           compute_XtY=True, budget=None,
+                           plan=_StripPlan(_STRIP_MAX_ROWS, 0)):
+    # Returns XtX (dense or sparse), XtY, YtY (the sum of squares of each
+    # channel), and the number of rows in X. If compute_XtY is False, then we
+    # never look at the data at all, and XtY and YtY are None.
+    if budget is None:
+        budget = _MemoryBudget()
+    XtX_accumulator = _GramAccumulator(full_design_width, budget=budget)
+    XtY = YtY = None
+    if compute_XtY:
+        num_channels = dataset.data_format.num_channels
+        budget.set("XtY", full_design_width * num_channels * 8)
+        XtY = np.zeros((full_design_width, num_channels))
+        YtY = np.zeros(num_channels)
     rows = 0
-    with ProgressBar(len(analysis_subspans), stream=log_stream) as progress_bar:
-        for subspan in analysis_subspans:
-            data = dataset.raw_slice(subspan.start[0],
-                                     subspan.start[1], subspan.stop[1])
-            rows += data.shape[0]
-            nnz = 0
-            for epoch in subspan.epochs:
-                nnz += epoch.design_row.shape[0] * data.shape[0]
-            design_data = np.empty(nnz, dtype=float)
-            design_i = np.empty(nnz, dtype=int)
-            design_j = np.empty(nnz, dtype=int)
-            write_ptr = 0
-            # This code would be more complicated if it couldn't rely on the
-            # following facts:
-            # - Every epoch in 'epochs' is guaranteed to span the entire chunk
-            #   of data, so we don't need to fiddle about finding start and
-            #   end positions, and every epoch generates the same number of
-            #   non-zero values.
-            # - In a coo_matrix, if you have two different entries at the same
-            #   (i, j) coordinate, then they get added together. This is the
-            #   correct thing to do in our case (though it should be very rare
-            #   -- in practice I guess it only happens if you have two events
-            #   of the same type that occur at exactly the same time).
-            for epoch in subspan.epochs:
-                for i, x_value in enumerate(epoch.design_row):
-                    write_slice = slice(write_ptr, write_ptr + data.shape[0])
-                    write_ptr += data.shape[0]
-                    design_data[write_slice] = x_value
-                    design_i[write_slice] = np.arange(data.shape[0])
-                    col_start = design_offsets[epoch.rerp]
-                    col_start += i * (epoch.stop_tick - epoch.start_tick)
-                    col_start += subspan.start[1] - epoch.start_tick
-                    design_j[write_slice] = np.arange(col_start,
-                                                      col_start + data.shape[0])
-            x_strip = sp.coo_matrix((design_data, (design_i, design_j)),
-                                    shape=(data.shape[0], full_design_width))
-            x_strip = x_strip.tocsc()
-            XtX_strip = x_strip.T * x_strip
-            # This is an elaborate way of doing:
-            #   XtX += XtX_strip
-            # because as of scipy 0.13, dense += sparse is expanded into:
-            #   dense = dense + sparse.todense()
-            # which is just ridiculously inefficient.
-            XtX_strip_coo = XtX_strip.tocoo()
-            XtX[XtX_strip_coo.row, XtX_strip_coo.col] += XtX_strip_coo.data
-            XtY += np.asarray(x_strip.T * data)
-            progress_bar.increment()
+    for start, stop in _strip_batches(subspans, plan.max_rows):
+        batch = subspans[start:stop]
+        batch_rows = sum([s.stop[1] - s.start[1] for s in batch])
+        budget.set("strip", batch_rows * plan.bytes_per_row)
+        x_strip = _continuous_strip(batch, design_offsets, full_design_width)
+        rows += x_strip.shape[0]
+        XtX_accumulator.add(x_strip.T * x_strip)
+        if compute_XtY:
+            data = _continuous_strip_data(dataset, batch)
+            _add_XtY(XtY, x_strip, data, budget)
+            YtY += np.sum(np.square(data, dtype=np.float64), axis=0)
+        if progress_bar is not None:
+            for _ in xrange(stop - start):
+                progress_bar.increment()
+    budget.clear("strip")
+    return XtX_accumulator.result(), XtY, YtY, rows
+
+# How many batches to hand out per worker process. More than one helps
+# balance the load when some batches turn out to be slower than others.
+_BATCHES_PER_WORKER = 4
+
+def _continuous_batches(subspans, num_batches):
+    # Splits 'subspans' into about 'num_batches' runs of consecutive subspans
+    # covering roughly equal numbers of data points, returned as (start,
+    # stop) index pairs. Batches are cut early at recspan boundaries (so long
+    # as they're at least 3/4 full), so that where possible each worker
+    # streams through whole recspans.
+    if num_batches <= 1 or not subspans:
+        return [(0, len(subspans))] if subspans else []
+    total_rows = sum([s.stop[1] - s.start[1] for s in subspans])
+    target_rows = max(1, total_rows // num_batches)
+    batches = []
+    batch_start = 0
+    batch_rows = 0
+    for i, subspan in enumerate(subspans):
+        if batch_rows > 0:
+            new_recspan = (subspan.start[0] != subspans[i - 1].start[0])
+            if ((new_recspan and 4 * batch_rows >= 3 * target_rows)
+                or batch_rows >= target_rows):
+                batches.append((batch_start, i))
+                batch_start = i
+                batch_rows = 0
+        batch_rows += subspan.stop[1] - subspan.start[1]
+    if batch_start < len(subspans):
+        batches.append((batch_start, len(subspans)))
+    return batches
+
+def test__continuous_batches():
+    def ss(recspan_id, start, stop):
+        return _DataSubSpan((recspan_id, start), (recspan_id, stop), None, None)
+    # 4 recspans with 10 ticks each, in 2-tick pieces
+    subspans = [ss(r, t, t + 2) for r in xrange(4) for t in xrange(0, 10, 2)]
+    assert _continuous_batches(subspans, 1) == [(0, 20)]
+    assert _continuous_batches(subspans, 2) == [(0, 10), (10, 20)]
+    assert _continuous_batches(subspans, 4) == [(0, 5), (5, 10),
+                                                (10, 15), (15, 20)]
+    # More batches than recspans: big recspans get split up too
+    assert _continuous_batches(subspans, 8) == [(0, 3), (3, 5), (5, 8),
+                                                (8, 10), (10, 13), (13, 15),
+                                                (15, 18), (18, 20)]
+    assert _continuous_batches([], 4) == []
+    for n in [1, 3, 7, 100]:
+        batches = _continuous_batches(subspans, n)
+        assert batches[0][0] == 0 and batches[-1][1] == len(subspans)
+        for (_, stop), (start, _) in zip(batches, batches[1:]):
+            assert stop == start
+
+# Worker processes are forked with this set, so they inherit the dataset and
+# subspans (which can be huge, and contain things like open files) without
+# anything having to be pickled. This is only possible on Unix, so elsewhere
+# we always fit serially.
+_FORKED_FIT_STATE = None
+
+def _accumulate_continuous_batch(batch):
+    try:
+        start, stop = batch
+        state = _FORKED_FIT_STATE
+        budget = _MemoryBudget(state["worker_memory_limit"])
+        reads = state["dataset"]._read_counts.snapshot()
+        XtX, XtY, YtY, rows = _accumulate_continuous(
+            state["dataset"],
+            state["subspans"][start:stop],
+            state["design_offsets"],
+            state["full_design_width"],
+            compute_XtY=state["compute_XtY"],
+            budget=budget,
+            plan=state["plan"])
+        # Our reads happen in our own copy of the dataset, so they have to
+        # be sent back to be counted.
+        return (XtX, XtY, YtY, rows, budget.peak,
+                state["dataset"]._read_counts.since(reads))
+    except KeyboardInterrupt:
+        # Avoid annoying console spew when someone hits Control-C
+        return None
+
+def _accumulate_continuous_parallel(dataset, subspans, design_offsets,
+                                    full_design_width, workers, log_stream,
+                                    compute_XtY=True, budget=None,
+                                    plan=_StripPlan(_STRIP_MAX_ROWS, 0)):
+    import multiprocessing
+    global _FORKED_FIT_STATE
+    if budget is None:
+        budget = _MemoryBudget()
+    batches = _continuous_batches(subspans, workers * _BATCHES_PER_WORKER)
+    XtX_accumulator = _GramAccumulator(full_design_width, budget=budget)
+    XtY = YtY = None
+    if compute_XtY:
+        num_channels = dataset.data_format.num_channels
+        budget.set("XtY", full_design_width * num_channels * 8)
+        XtY = np.zeros((full_design_width, num_channels))
+        YtY = np.zeros(num_channels)
+    rows = 0
+    # Each worker has its own XtX and XtY to fill in, so we split up the
+    # remaining memory between them (keeping a share for ourselves, since
+    # the XtX we're accumulating here might still grow).
+    worker_memory_limit = None
+    if budget.limit is not None:
+        worker_memory_limit = max(1, int(budget.available("workers")
+                                         // (workers + 1)))
+    _FORKED_FIT_STATE = {"dataset": dataset,
+                         "subspans": subspans,
+                         "design_offsets": design_offsets,
+                         "full_design_width": full_design_width,
+                         "compute_XtY": compute_XtY,
+                         "worker_memory_limit": worker_memory_limit,
+                         "plan": plan,
+                         }
+    try:
+        pool = multiprocessing.Pool(workers)
+    finally:
+        _FORKED_FIT_STATE = None
+    worker_peak = 0
+    try:
+        with ProgressBar(len(batches), stream=log_stream) as progress_bar:
+            for result in pool.imap(_accumulate_continuous_batch, batches):
+                if result is None:
+                    # A worker got interrupted; it kept quiet about it, so
+                    # that we can pass it on
+                    raise KeyboardInterrupt
+                (batch_XtX, batch_XtY, batch_YtY, batch_rows,
+                 batch_peak, batch_reads) = result
+                worker_peak = max(worker_peak, batch_peak)
+                dataset._read_counts.add(batch_reads)
+                budget.set("workers", workers * worker_peak)
+                XtX_accumulator.add(batch_XtX)
+                if compute_XtY:
+                    XtY += batch_XtY
+                    YtY += batch_YtY
+                rows += batch_rows
+                progress_bar.increment()
+    finally:
+        pool.terminate()
+    budget.clear("workers")
+    return XtX_accumulator.result(), XtY, YtY, rows
+
+def _continuous_normal_equations(dataset, analysis_subspans,
+                                 design_offsets, full_design_width,
+                                 log_stream, workers=1, compute_XtY=True,
+                                 budget=None, check_rows=True):
+    if budget is None:
+        budget = _MemoryBudget()
+    # Originally this was parallelized by farming out each subspan as a
+    # separate job, and the parallel version always went slower than the
+    # serial version. But that's because the jobs were tiny; what works is
+    # handing each worker a few big batches of whole recspans, and then just
+    # summing up the partial XtX and XtY's that they send back.
+    parallel = (workers > 1 and os.name == "posix")
+    share = workers if parallel else 1
+    analysis_subspans, plan = _plan_strips(
+        analysis_subspans, dataset.data_format.num_channels, budget,
+        share=share, itemsize=dataset.data_format.dtype.itemsize)
+    if parallel:
+        XtX, XtY, YtY, rows = _accumulate_continuous_parallel(
+            dataset, analysis_subspans, design_offsets, full_design_width,
+            workers, log_stream, compute_XtY=compute_XtY, budget=budget,
+            plan=plan)
+    else:
+        with ProgressBar(len(analysis_subspans),
+                         stream=log_stream) as progress_bar:
+            XtX, XtY, YtY, rows = _accumulate_continuous(
+                dataset, analysis_subspans, design_offsets,
+                full_design_width, progress_bar, compute_XtY=compute_XtY,
+                budget=budget, plan=plan)
+    if check_rows:
+        _check_rows(rows, full_design_width)
+    return XtX, XtY, YtY, rows
+
+def _normal_equations_nbytes(normal_equations):
+    XtX, XtY, YtY, _ = normal_equations
+    if sp.issparse(XtX):
+        XtX_nbytes = XtX.data.nbytes + XtX.indices.nbytes + XtX.indptr.nbytes
+    else:
+        XtX_nbytes = XtX.nbytes
+    return XtX_nbytes + XtY.nbytes + YtY.nbytes
+
+# With checkpoint_path=, continuous fits accumulate the normal equations a
+# chunk of about this many data points at a time, and after each chunk, if
+# it's been at least _CHECKPOINT_INTERVAL seconds since the last checkpoint
+# was written, write a new one. There's always a checkpoint written once all
+# the data has been read, so a crash during the solve doesn't lose
+# anything.
+_CHECKPOINT_CHUNK_ROWS = 2 ** 20
+_CHECKPOINT_INTERVAL = 300
+
+def _checkpoint_fingerprint(dataset, rerps, analysis_subspans):
+    # Everything that goes into the normal equations, except the data
+    # itself (which would take as long to hash as to fit), for which we
+    # make do with checking the format and the recspan lengths.
+    h = hashlib.sha1()
+    h.update(_design_fingerprint(rerps, analysis_subspans))
+    data_format = dataset.data_format
+    h.update(repr((data_format.exact_sample_rate_hz, data_format.units,
+                   list(data_format.channel_names), data_format.dtype.str,
+                   [recspan_info.ticks
+                    for recspan_info in dataset.recspan_infos])))
+    return h.hexdigest()
+
+def _save_checkpoint(path, fingerprint, position, normal_equations):
+    XtX, XtY, YtY, rows = normal_equations
+    arrays = {"fingerprint": np.asarray(fingerprint),
+              "position": np.asarray(position),
+              "XtY": XtY,
+              "YtY": YtY,
+              "rows": np.asarray(rows),
+              }
+    if sp.issparse(XtX):
+        XtX = XtX.tocoo()
+        arrays.update({"XtX_data": XtX.data,
+                       "XtX_row": XtX.row,
+                       "XtX_col": XtX.col,
+                       "XtX_shape": np.asarray(XtX.shape)})
+    else:
+        arrays["XtX"] = XtX
+    # Write to a temporary file and then rename it into place, so a crash
+    # while writing leaves the old checkpoint intact.
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(f, **arrays)
+    if os.name != "posix" and os.path.exists(path):
+        # Only POSIX rename atomically replaces an existing file
+        os.remove(path)
+    os.rename(tmp_path, path)
+
+def _load_checkpoint(path, fingerprint):
+    # Returns the number of analysis subspans already done, and the normal
+    # equations accumulated from them (or None).
+    if not os.path.exists(path):
+        return 0, None
+    with np.load(path) as f:
+        if str(f["fingerprint"]) != fingerprint:
+            raise ValueError("checkpoint %r was made for a different dataset "
+                             "or set of requests; delete it to start over"
+                             % (path,))
+        if "XtX" in f:
+            XtX = f["XtX"]
+        else:
+            XtX = sp.coo_matrix((f["XtX_data"], (f["XtX_row"], f["XtX_col"])),
+                                shape=tuple(f["XtX_shape"])).tocsc()
+        return int(f["position"]), (XtX, f["XtY"], f["YtY"], int(f["rows"]))
+
+def test__save_load_checkpoint():
+    import tempfile
+    import shutil
+    from nose.tools import assert_raises
+    r = np.random.RandomState(0)
+    XtX = r.normal(size=(5, 5))
+    XtY = r.normal(size=(5, 2))
+    YtY = r.normal(size=2)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, "checkpoint")
+        assert _load_checkpoint(path, "abc") == (0, None)
+        for matrix in [XtX, sp.csc_matrix(XtX)]:
+            _save_checkpoint(path, "abc", 7, (matrix, XtY, YtY, 10))
+            # And again, to check that replacing an old one works
+            _save_checkpoint(path, "abc", 8, (matrix, XtY, YtY, 11))
+            assert os.listdir(tmpdir) == ["checkpoint"]
+            position, (got_XtX, got_XtY, got_YtY, rows) = (
+                _load_checkpoint(path, "abc"))
+            assert position == 8
+            assert rows == 11
+            assert sp.issparse(got_XtX) == sp.issparse(matrix)
+            if sp.issparse(got_XtX):
+                got_XtX = got_XtX.toarray()
+            assert np.array_equal(got_XtX, XtX)
+            assert np.array_equal(got_XtY, XtY)
+            assert np.array_equal(got_YtY, YtY)
+            assert_raises(ValueError, _load_checkpoint, path, "def")
+    finally:
+        shutil.rmtree(tmpdir)
+
+def _checkpointed_normal_equations(dataset, analysis_subspans, rerps,
+                                   design_offsets, full_design_width,
+                                   log_stream, checkpoint_path, workers=1,
+                                   budget=None):
+    # Like _continuous_normal_equations, but resumes from checkpoint_path if
+    # it exists, and saves progress there as it goes.
+    if budget is None:
+        budget = _MemoryBudget()
+    fingerprint = _checkpoint_fingerprint(dataset, rerps, analysis_subspans)
+    position, totals = _load_checkpoint(checkpoint_path, fingerprint)
+    if position:
+        log_stream.write("  resuming from checkpoint (%s of %s subspans "
+                         "done)\n" % (position, len(analysis_subspans)))
+    remaining = analysis_subspans[position:]
+    remaining_rows = sum([s.stop[1] - s.start[1] for s in remaining])
+    chunks = _continuous_batches(remaining,
+                                 max(1, remaining_rows
+                                        // _CHECKPOINT_CHUNK_ROWS))
+    last_saved = time.time()
+    for start, stop in chunks:
+        delta = _continuous_normal_equations(dataset, remaining[start:stop],
+                                             design_offsets,
+                                             full_design_width, log_stream,
+                                             workers=workers, budget=budget,
+                                             check_rows=False)
+        if totals is None:
+            totals = delta
+        else:
+            totals = _update_normal_equations(totals, delta, 1)
+        del delta
+        budget.set("checkpoint", _normal_equations_nbytes(totals))
+        if (stop == len(remaining)
+            or time.time() - last_saved >= _CHECKPOINT_INTERVAL):
+            _save_checkpoint(checkpoint_path, fingerprint, position + stop,
+                             totals)
+            last_saved = time.time()
+    if totals is None:
+        # No data at all
+        totals = _continuous_normal_equations(dataset, [], design_offsets,
+                                              full_design_width, log_stream,
+                                              budget=budget, check_rows=False)
+    _check_rows(totals[3], full_design_width)
+    return totals
+
+def _check_rows(rows, full_design_width):
     if rows < full_design_width:
         raise ValueError("This analysis has more predictors than data "
                          "points. I'm afraid this isn't going to work out.")
-    if np.linalg.cond(XtX) > 1e7:
-        raise ValueError("Your predictors appear to be perfectly "
-                         "collinear. I could make up an answer, but I'd "
-                         "rather not.")
-    all_betas = np.linalg.solve(XtX, XtY)
-    # Extract each rerp's betas from the big beta matrix.
+
+def _subspans_by_recspan(analysis_subspans):
+    # Analysis subspans never cross recspan boundaries, so each recspan's
+    # contribution to the normal equations is independent of the others.
+    by_recspan = {}
+    for subspan in analysis_subspans:
+        by_recspan.setdefault(subspan.start[0], []).append(subspan)
+    return by_recspan
+
+def _update_normal_equations(totals, delta, sign):
+    # Adds (sign=1) or subtracts (sign=-1) one set of (XtX, XtY, YtY, rows)
+    # to or from another. XtX might be dense or sparse, depending on how
+    # much memory there was when it was accumulated; the totals keep
+    # whichever format they started with.
+    XtX, XtY, YtY, rows = totals
+    delta_XtX, delta_XtY, delta_YtY, delta_rows = delta
+    if sp.issparse(XtX):
+        XtX = (XtX + sign * sp.csc_matrix(delta_XtX)).tocsc()
+    else:
+        if sp.issparse(delta_XtX):
+            delta_XtX = delta_XtX.toarray()
+        XtX = XtX + sign * delta_XtX
+    return (XtX, XtY + sign * delta_XtY, YtY + sign * delta_YtY,
+            rows + sign * delta_rows)
+
+def test__update_normal_equations():
+    r = np.random.RandomState(0)
+    def random_equations():
+        X = r.normal(size=(10, 3))
+        Y = r.normal(size=(10, 2))
+        return (np.dot(X.T, X), np.dot(X.T, Y), np.sum(Y ** 2, axis=0), 10)
+    a = random_equations()
+    b = random_equations()
+    for a_XtX, b_XtX in itertools.product([a[0], sp.csc_matrix(a[0])],
+                                          [b[0], sp.csc_matrix(b[0])]):
+        totals = (a_XtX,) + a[1:]
+        delta = (b_XtX,) + b[1:]
+        added = _update_normal_equations(totals, delta, 1)
+        assert sp.issparse(added[0]) == sp.issparse(a_XtX)
+        for got, x, y in zip(added, a, b):
+            if sp.issparse(got):
+                got = got.toarray()
+            assert np.allclose(got, x + y)
+        back = _update_normal_equations(added, delta, -1)
+        for got, x in zip(back, a):
+            if sp.issparse(got):
+                got = got.toarray()
+            assert np.allclose(got, x)
+
+def _continuous_XtY(dataset, analysis_subspans, design_offsets,
+                    full_design_width, log_stream, budget=None):
+    # For when we already have XtX factored, and just need XtY (and YtY).
+    if budget is None:
+        budget = _MemoryBudget()
+    num_channels = dataset.data_format.num_channels
+    budget.set("XtY", full_design_width * num_channels * 8)
+    XtY = np.zeros((full_design_width, num_channels))
+    YtY = np.zeros(num_channels)
+    analysis_subspans, plan = _plan_strips(
+        analysis_subspans, num_channels, budget,
+        itemsize=dataset.data_format.dtype.itemsize)
+    with ProgressBar(len(analysis_subspans),
+                     stream=log_stream) as progress_bar:
+        for start, stop in _strip_batches(analysis_subspans, plan.max_rows):
+            batch = analysis_subspans[start:stop]
+            batch_rows = sum([s.stop[1] - s.start[1] for s in batch])
+            budget.set("strip", batch_rows * plan.bytes_per_row)
+            x_strip = _continuous_strip(batch, design_offsets,
+                                        full_design_width)
+            data = _continuous_strip_data(dataset, batch)
+            _add_XtY(XtY, x_strip, data, budget)
+            YtY += np.sum(np.square(data, dtype=np.float64), axis=0)
+            for _ in xrange(len(batch)):
+                progress_bar.increment()
+    budget.clear("strip")
+    return XtY, YtY
+
+# How many columns of the identity matrix _inverse_diagonal solves for at
+# once (if the memory budget allows).
+_INVERSE_BLOCK = 256
+
+def _inverse_diagonal(solve, width, budget=None, expansion=None):
+    # The diagonal of XtX^-1, given a function that solves XtX x = b (from
+    # _factor_normal_equations or _factor_blocks). If 'expansion' (a sparse
+    # matrix E, see _latency_expansion) is given, then we return the
+    # diagonal of E.T XtX^-1 E instead. Dense factorizations know how to
+    # invert themselves directly; otherwise see _solved_inverse_diagonal.
+    if budget is None:
+        budget = _MemoryBudget()
+    if expansion is None and hasattr(solve, "inverse_diagonal"):
+        return solve.inverse_diagonal(budget)
+    return _solved_inverse_diagonal(solve, width, budget, expansion)
+
+def _solved_inverse_diagonal(solve, width, budget, expansion=None):
+    # Like _inverse_diagonal, but works for any 'solve': we solve for the
+    # columns of the identity matrix (or of E) a block at a time, so that we
+    # never need more than a (width x block) scratch matrix.
+    num_columns = width if expansion is None else expansion.shape[1]
+    column_bytes = 2 * width * 8
+    block = int(max(1, min(num_columns, _INVERSE_BLOCK,
+                           budget.available("inverse diagonal")
+                           // column_bytes)))
+    diagonal = np.empty(num_columns)
+    for start in xrange(0, num_columns, block):
+        stop = min(num_columns, start + block)
+        budget.set("inverse diagonal", (stop - start) * column_bytes)
+        if expansion is None:
+            rows = np.arange(start, stop)
+            columns = np.arange(stop - start)
+            E = np.zeros((width, stop - start))
+            E[rows, columns] = 1
+            diagonal[start:stop] = solve(E)[rows, columns]
+        else:
+            E = expansion[:, start:stop].toarray()
+            diagonal[start:stop] = np.sum(E * solve(E), axis=0)
+    budget.clear("inverse diagonal")
+    return diagonal
+
+def _continuous_inverse_diagonal(solve, width, budget, expansion=None):
+    # _inverse_diagonal for a continuous fit, while we still have the
+    # factorization. Standard errors aren't worth failing an otherwise
+    # successful fit over, so if memory_limit= doesn't leave room for even
+    # one column of scratch space, we skip them (and .stderr and .tvalues
+    # are None).
+    if not budget.fits("inverse diagonal", 2 * width * 8):
+        return None
+    return _inverse_diagonal(solve, width, budget, expansion)
+
+def test__continuous_inverse_diagonal():
+    r = np.random.RandomState(0)
+    X = r.normal(size=(40, 6))
+    XtX = np.dot(X.T, X)
+    solve = _factor_normal_equations(XtX)
+    for limit in [None, 2 * 6 * 8]:
+        got = _continuous_inverse_diagonal(solve, 6, _MemoryBudget(limit))
+        assert np.allclose(got, np.diag(np.linalg.inv(XtX)))
+    assert _continuous_inverse_diagonal(solve, 6,
+                                        _MemoryBudget(2 * 6 * 8 - 1)) is None
+
+def test__inverse_diagonal():
+    r = np.random.RandomState(0)
+    X = r.normal(size=(40, 10))
+    XtX = np.dot(X.T, X)
+    expected = np.diag(np.linalg.inv(XtX))
+    for block in [1, 3, 256]:
+        old_block = _INVERSE_BLOCK
+        try:
+            globals()["_INVERSE_BLOCK"] = block
+            got = _inverse_diagonal(_factor_normal_equations(XtX), 10)
+        finally:
+            globals()["_INVERSE_BLOCK"] = old_block
+        assert np.allclose(got, expected)
+    # Blocks shrink to fit the budget
+    budget = _MemoryBudget(3 * 2 * 10 * 8)
+    got = _inverse_diagonal(_factor_normal_equations(XtX), 10, budget)
+    assert np.allclose(got, expected)
+    assert budget.peak == 3 * 2 * 10 * 8
+    from nose.tools import assert_raises
+    assert_raises(ValueError, _inverse_diagonal,
+                  _factor_normal_equations(XtX), 10, _MemoryBudget(100))
+    E = sp.csc_matrix(r.normal(size=(10, 25)))
+    expected = np.diag(np.dot(E.T.toarray(),
+                              np.dot(np.linalg.inv(XtX), E.toarray())))
+    for limit in [None, 3 * 2 * 10 * 8]:
+        got = _inverse_diagonal(_factor_normal_equations(XtX), 10,
+                                _MemoryBudget(limit), expansion=E)
+        assert np.allclose(got, expected)
+    # Dense factors invert themselves with potri if there's room, and
+    # otherwise fall back on solving
+    expected = np.diag(np.linalg.inv(XtX))
+    for limit in [None, 10 * 10 * 8, 10 * 10 * 8 - 1]:
+        budget = _MemoryBudget(limit)
+        got = _inverse_diagonal(_factor_normal_equations(XtX), 10, budget)
+        assert np.allclose(got, expected)
+    # Including nearly singular ones, which are factored by eigh
+    Q, _ = np.linalg.qr(r.normal(size=(10, 10)))
+    near = np.dot(Q * np.logspace(0, 6.9, 10), Q.T)
+    near = (near + near.T) / 2
+    assert np.allclose(_inverse_diagonal(_factor_normal_equations(near), 10),
+                       np.diag(np.linalg.inv(near)))
+    # And block diagonal ones, a block at a time
+    blocks = [np.arange(4), np.arange(4, 10)]
+    XtX[:4, 4:] = XtX[4:, :4] = 0
+    for matrix in [XtX, sp.csc_matrix(XtX)]:
+        got = _inverse_diagonal(_factor_blocks(matrix, blocks), 10)
+        assert np.allclose(got, np.diag(np.linalg.inv(XtX)))
+
+def _continuous_residuals(rerps, rss, df, inverse_diagonal):
+    # Splits up the inverse_diagonal (if any) into each rerp's _Residuals,
+    # laid out like _continuous_betas. It has one entry for each beta, i.e.
+    # for each predictor at each tick of each rerp in turn (see
+    # _latency_expansion).
+    i = 0
+    for rerp in rerps:
+        num_predictors = len(rerp.design_info.column_names)
+        rerp_diagonal = None
+        if inverse_diagonal is not None:
+            rerp_diagonal = inverse_diagonal[
+                i:i + num_predictors * rerp.ticks].reshape((num_predictors,
+                                                            rerp.ticks))
+        i += num_predictors * rerp.ticks
+        yield _residuals(rss, df, rerp_diagonal)
+
+def _latency_expansion(rerps, design_offsets, full_design_width):
+    # If any rerp has a latency basis, returns the sparse matrix E such that
+    # E.T maps the full design's coefficients to the betas at each tick of
+    # each rerp in turn (so the betas' covariance is E.T XtX^-1 E, times the
+    # residual variance). Otherwise, returns None (meaning the identity).
+    if all([rerp.latency_basis is None for rerp in rerps]):
+        return None
+    blocks = []
+    for rerp in rerps:
+        assert design_offsets[rerp] == sum([block.shape[0]
+                                            for block in blocks])
+        if rerp.latency_basis is None:
+            block = sp.identity(rerp.ticks, format="csc")
+        else:
+            block = sp.csc_matrix(rerp.latency_basis.T)
+        blocks += [block] * len(rerp.design_info.column_names)
+    expansion = sp.block_diag(blocks, format="csc")
+    assert expansion.shape[0] == full_design_width
+    return expansion
+
+def _continuous_betas(rerps, design_offsets, all_betas):
+    # Extract each rerp's betas from the big beta matrix. Rerps with a latency
+    # basis have their basis coefficients turned back into a beta at every
+    # tick.
     for rerp in rerps:
         i = design_offsets[rerp]
         num_predictors = len(rerp.design_info.column_names)
-        num_columns = rerp.ticks * num_predictors
-        betas = all_betas[i:i + num_columns, :]
-        rerp._set_betas(betas.reshape((num_predictors, rerp.ticks, -1)))
+        width = _latency_width(rerp)
+        betas = all_betas[i:i + num_predictors * width, :]
+        betas = betas.reshape((num_predictors, width, -1))
+        if rerp.latency_basis is not None:
+            betas = np.einsum("lk,pkc->plc", rerp.latency_basis, betas)
+        yield betas
+
+def _fit_continuous(dataset, analysis_subspans, rerps, log_stream,
+                    workers=1, budget=None, penalty=0, smoothness_penalty=0,
+                    penalty_path=None, checkpoint_path=None):
+    if budget is None:
+        budget = _MemoryBudget()
+    design_offsets, full_design_width = _continuous_design_layout(rerps)
+    if checkpoint_path is None:
+        XtX, XtY, YtY, rows = _continuous_normal_equations(
+            dataset, analysis_subspans, design_offsets, full_design_width,
+            log_stream, workers=workers, budget=budget)
+    else:
+        XtX, XtY, YtY, rows = _checkpointed_normal_equations(
+            dataset, analysis_subspans, rerps, design_offsets,
+            full_design_width, log_stream, checkpoint_path,
+            workers=workers, budget=budget)
+    _solve_continuous(rerps, design_offsets, full_design_width,
+                      XtX, XtY, YtY, rows, budget, penalty,
+                      smoothness_penalty, penalty_path, workers=workers)
+    # The fit is done, so the checkpoint is no longer needed
+    if checkpoint_path is not None:
+        os.remove(checkpoint_path)
+
+def _solve_continuous(rerps, design_offsets, full_design_width,
+                      XtX, XtY, YtY, rows, budget, penalty,
+                      smoothness_penalty, penalty_path, workers=1):
+    # Given the accumulated normal equations, fills in the betas (and
+    # everything else) on each rerp.
+    all_residuals = [None] * len(rerps)
+    if penalty_path is None:
+        penalty_matrix = _continuous_penalty(rerps, design_offsets,
+                                             full_design_width, penalty,
+                                             smoothness_penalty)
+        XtX = _add_penalty(XtX, penalty_matrix)
+        solve = _factor_blocks(XtX,
+                               _continuous_blocks(XtX, rerps, design_offsets),
+                               budget=budget, workers=workers)
+        all_betas = [solve(XtY)]
+        scores = None
+        if penalty_matrix is None:
+            rss = YtY - np.sum(all_betas[0] * XtY, axis=0)
+            expansion = _latency_expansion(rerps, design_offsets,
+                                           full_design_width)
+            all_residuals = list(_continuous_residuals(
+                rerps, rss, rows - full_design_width,
+                _continuous_inverse_diagonal(solve, full_design_width,
+                                             budget, expansion)))
+        del solve
+    else:
+        smoothing = _continuous_penalty(rerps, design_offsets,
+                                        full_design_width, 0,
+                                        smoothness_penalty)
+        all_betas, scores = _penalty_path(XtX, XtY, YtY, rows, smoothing,
+                                          penalty_path, budget=budget)
+    budget.set("betas", sum([betas.nbytes for betas in all_betas
+                             if betas is not None]))
+    split_betas = [None if betas is None
+                   else list(_continuous_betas(rerps, design_offsets, betas))
+                   for betas in all_betas]
+    for i, rerp in enumerate(rerps):
+        _set_penalized_betas(rerp,
+                             [None if betas is None else betas[i]
+                              for betas in split_betas],
+                             scores, penalty, smoothness_penalty,
+                             penalty_path, residuals=all_residuals[i])
+
+def _iterative_betas(dataset, analysis_subspans, rerps, log_stream,
+                     tolerance, max_iterations, budget=None, penalty=0,
+                     smoothness_penalty=0):
+    # Like _fit_continuous, except that instead of forming XtX (which needs
+    # full_design_width**2 memory) we solve the normal equations by conjugate
+    # gradients, which only need to multiply by XtX. And we can do that
+    # without forming it by regenerating the design strips and computing
+    #   XtX * P = sum over strips of X_strip.T * (X_strip * P)
+    # on each iteration. The strips are cheap to rebuild from the subspans,
+    # and the data itself is only read once, up front.
+    if budget is None:
+        budget = _MemoryBudget()
+    design_offsets, full_design_width = _continuous_design_layout(rerps)
+    num_channels = dataset.data_format.num_channels
+    # XtY, plus the betas, residuals, search directions, XtX * directions,
+    # and preconditioned residuals that _block_pcg keeps.
+    budget.set("XtY", 6 * full_design_width * num_channels * 8)
+    analysis_subspans, plan = _plan_strips(
+        analysis_subspans, num_channels, budget,
+        itemsize=dataset.data_format.dtype.itemsize)
+    def strips():
+        for start, stop in _strip_batches(analysis_subspans, plan.max_rows):
+            batch = analysis_subspans[start:stop]
+            batch_rows = sum([s.stop[1] - s.start[1] for s in batch])
+            budget.set("strip", batch_rows * plan.bytes_per_row)
+            yield batch, _continuous_strip(batch, design_offsets,
+                                           full_design_width)
+        budget.clear("strip")
+    XtY = np.zeros((full_design_width, num_channels))
+    YtY = np.zeros(num_channels)
+    diagonal = np.zeros(full_design_width)
+    rows = 0
+    with ProgressBar(len(analysis_subspans),
+                     stream=log_stream) as progress_bar:
+        for batch, x_strip in strips():
+            data = _continuous_strip_data(dataset, batch)
+            rows += data.shape[0]
+            _add_XtY(XtY, x_strip, data, budget)
+            YtY += np.sum(np.square(data, dtype=np.float64), axis=0)
+            diagonal += np.asarray(x_strip.multiply(x_strip).sum(axis=0))[0]
+            for _ in xrange(len(batch)):
+                progress_bar.increment()
+    if rows < full_design_width:
+        raise ValueError("This analysis has more predictors than data "
+                         "points. I'm afraid this isn't going to work out.")
+    penalty_matrix = _continuous_penalty(rerps, design_offsets,
+                                         full_design_width, penalty,
+                                         smoothness_penalty)
+    if penalty_matrix is not None:
+        diagonal += penalty_matrix.diagonal()
+    def XtX_times(P):
+        result = np.zeros(P.shape)
+        for _, x_strip in strips():
+            result += np.asarray(x_strip.T * (x_strip * P))
+        if penalty_matrix is not None:
+            result += penalty_matrix * P
+        return result
+    if max_iterations is None:
+        # In exact arithmetic CG always converges in this many steps.
+        max_iterations = full_design_width
+    all_betas, iterations, residuals = _block_pcg(XtX_times, XtY, diagonal,
+                                                  tolerance, max_iterations)
+    # The residual sum of squares for each channel is
+    #   ||Y - X b||^2 = YtY - 2 b.XtY + b.XtX b
+    # and CG has already given us XtX b = XtY - residuals, so we can get it
+    # without going back to the data. (With a penalty, CG is actually
+    # solving (XtX + P) b = XtY, so we also have to take off the b.P b.)
+    rss = YtY - np.sum(all_betas * (XtY + residuals), axis=0)
+    if penalty_matrix is not None:
+        rss -= np.sum(all_betas * (penalty_matrix * all_betas), axis=0)
+    residual_norm = np.sqrt(np.maximum(rss, 0))
+    log_stream.write("  converged after %s iterations\n" % (iterations,))
+    betas = list(_continuous_betas(rerps, design_offsets, all_betas))
+    # CG never gives us XtX^-1, so no standard errors, and the residual
+    # variance is only meaningful without a penalty.
+    residuals = None
+    if penalty_matrix is None:
+        residuals = _residuals(rss, rows - full_design_width, None)
+    return betas, iterations, residual_norm, residuals
+
+def _fit_iterative(dataset, analysis_subspans, rerps, log_stream,
+                   tolerance, max_iterations, budget=None, penalty=0,
+                   smoothness_penalty=0):
+    all_betas, iterations, residual_norm, residuals = _iterative_betas(
+        dataset, analysis_subspans, rerps, log_stream,
+        tolerance, max_iterations, budget=budget, penalty=penalty,
+        smoothness_penalty=smoothness_penalty)
+    for rerp, betas in zip(rerps, all_betas):
+        _set_penalized_betas(rerp, [betas], None, penalty,
+                             smoothness_penalty, None, residuals=residuals)
+        rerp._set_iterative_info(iterations, residual_norm)
 
 ################################################################
 
@@ -1429,6 +5290,11 @@ class rERP(object):
         self.start_tick = start_tick
         self.stop_tick = stop_tick
         self.ticks = stop_tick - start_tick
+        self.latency_basis = _latency_basis(request, self.ticks)
+        # _continuous_strip looks up rows of this
+        self._latency_basis_csr = None
+        if self.latency_basis is not None:
+            self._latency_basis_csr = sp.csr_matrix(self.latency_basis)
 
         assert 0 <= this_rerp_index < total_rerps
         self.this_rerp_index = this_rerp_index
@@ -1442,18 +5308,120 @@ class rERP(object):
     def _set_fit_info(self, regression_strategy, overlap_correction):
         self.regression_strategy = regression_strategy
         self.overlap_correction = overlap_correction
+        # Only filled in by the "iterative" strategy
+        self.iterations = None
+        self.residual_norm = None
+        # Filled in once the fit is done
+        self.peak_memory = None
+        self._memory_limit = None
+        self.timings = None
+        self.penalty = 0
+        self.smoothness_penalty = 0
+        # Only filled in when fitting with penalty_path=
+        self.penalty_path = None
+        self.path_betas = None
+        # Only filled in for unpenalized fits (and only residual_variance
+        # for the "iterative" strategy)
+        self.residual_variance = None
+        self.stderr = None
+        self.tvalues = None
+        # Only filled in by the "by-epoch" strategy; these are used by
+        # permutation_test and bootstrap.
+        self._epochs = None
         self._add_part("fit-info")
 
-    def _set_betas(self, betas):
+    def _set_epochs(self, epochs):
+        assert self.regression_strategy == "by-epoch"
+        self._epochs = epochs
+
+    def _set_peak_memory(self, peak_memory, memory_limit):
+        self.peak_memory = peak_memory
+        # permutation_test and bootstrap stay inside the same limit
+        self._memory_limit = memory_limit
+
+    def _set_timings(self, timings):
+        self.timings = timings
+
+    def _unfitted_copy(self, data_format):
+        # A copy of a rERP that has everything except the fit results, ready
+        # to have new ones filled in (see rERPSolver).
+        assert not self._has("betas")
+        new = copy.copy(self)
+        new._parts = set(self._parts)
+        new.data_format = data_format
+        return new
+
+    def _set_iterative_info(self, iterations, residual_norm):
+        assert self.regression_strategy == "iterative"
+        self.iterations = iterations
+        self.residual_norm = pandas.Series(residual_norm,
+                                           index=self.data_format.channel_names)
+
+    def _set_penalty(self, penalty, smoothness_penalty):
+        self.penalty = penalty
+        self.smoothness_penalty = smoothness_penalty
+
+    def _set_penalty_path(self, smoothness_penalty, penalties, scores,
+                          all_betas):
+        # Also sets .betas, to whichever penalty got the best score.
+        scores = np.asarray(scores)
+        if not np.any(np.isfinite(scores)):
+            raise ValueError("none of the penalties in penalty_path= left "
+                             "enough residual degrees of freedom to score "
+                             "(or the design was too close to collinear); "
+                             "try larger penalties, or more data")
+        best = int(np.argmin(scores))
+        self._set_penalty(penalties[best], smoothness_penalty)
+        self.penalty_path = pandas.Series(scores, index=list(penalties))
+        self.path_betas = [None if betas is None
+                           else self._betas_panel(betas)
+                           for betas in all_betas]
+        self._set_betas(all_betas[best])
+
+    def _time_array(self):
+        tick_array = np.arange(self.start_tick, self.stop_tick)
+        return self.data_format.ticks_to_ms(tick_array)
+
+    def _betas_panel(self, betas):
         num_predictors = len(self.design_info.column_names)
         num_channels = len(self.data_format.channel_names)
         assert (num_predictors, self.ticks, num_channels) == betas.shape
-        tick_array = np.arange(self.start_tick, self.stop_tick)
-        time_array = self.data_format.ticks_to_ms(tick_array)
-        self.betas = pandas.Panel(betas,
-                                  items=self.design_info.column_names,
-                                  major_axis=time_array,
-                                  minor_axis=self.data_format.channel_names)
+        return pandas.Panel(betas,
+                            items=self.design_info.column_names,
+                            major_axis=self._time_array(),
+                            minor_axis=self.data_format.channel_names)
+
+    def _set_residuals(self, residuals):
+        # residuals.rss is per channel (for continuous fits, which have a
+        # single error variance for each channel) or per latency and channel
+        # (by-epoch fits, which fit each latency separately); either way,
+        # .residual_variance is a (latency x channel) DataFrame.
+        # residuals.inverse_diagonal is the diagonal of XtX^-1, per predictor
+        # (by-epoch) or per predictor and latency (continuous).
+        assert self._has("betas")
+        num_channels = len(self.data_format.channel_names)
+        variance = np.empty((self.ticks, num_channels))
+        if residuals.df > 0:
+            variance[...] = residuals.rss * 1.0 / residuals.df
+        else:
+            variance.fill(np.nan)
+        self.residual_variance = pandas.DataFrame(
+            variance, index=self._time_array(),
+            columns=self.data_format.channel_names)
+        self.stderr = None
+        self.tvalues = None
+        if residuals.inverse_diagonal is not None:
+            inverse_diagonal = np.asarray(residuals.inverse_diagonal)
+            if inverse_diagonal.ndim == 1:
+                inverse_diagonal = np.repeat(inverse_diagonal[:, np.newaxis],
+                                             self.ticks, axis=1)
+            stderr = np.sqrt(inverse_diagonal[:, :, np.newaxis]
+                             * variance[np.newaxis, :, :])
+            self.stderr = self._betas_panel(stderr)
+            self.tvalues = self._betas_panel(self.betas.values / stderr)
+
+    def _set_betas(self, betas):
+        self.betas = self._betas_panel(betas)
         self._add_part("betas")
 
     ################################################################
@@ -1522,6 +5490,38 @@ class rERP(object):
                              "several predictions at once, use predict_many")
         return prediction.iloc[0, :, :]
 
+    # Cluster-based permutation test, for rERPs fit with
+    # regression_strategy="by-epoch". 'dataset' should be the data this
+    # rERP was fit to. Each of the n permutations shuffles the predictors in
+    # the terms named by 'permute' (default: every term except the
+    # intercept) between epochs, and refits. stat= is "t" or "beta";
+    # clusters are runs of consecutive latencies in a single channel where
+    # |stat| is above 'threshold' (default, for "t": the two-tailed p = 0.05
+    # critical value), and a cluster's mass is the sum of stat over it.
+    # Returns an rerpy.inference.rERPPermutationTest, which has the observed
+    # statistics, the null distribution of the largest cluster mass, and
+    # the observed clusters with their p values. The refits stay within the
+    # memory_limit= the rERP was fit with; workers > 1 fits blocks of
+    # permutations in that many threads (unless there's a memory limit).
+    def permutation_test(self, dataset, n, permute=None, stat="t",
+                         threshold=None, random_state=None, workers=1):
+        from rerpy.inference import _permutation_test
+        return _permutation_test(self, dataset, n, permute=permute,
+                                 stat=stat, threshold=threshold,
+                                 random_state=random_state, workers=workers)
+
+    # Resamples this (by-epoch) rERP's epochs with replacement n times, and
+    # returns the betas for each sample, as an array with shape
+    # (n, predictors, latencies, channels). A sample that leaves the design
+    # too close to singular -- e.g., one that happens not to draw any
+    # epochs with some rare level of a factor -- gets NaN betas, so use
+    # np.nanmean and friends to summarize. memory_limit= and workers= work
+    # as for permutation_test.
+    def bootstrap(self, dataset, n, random_state=None, workers=1):
+        from rerpy.inference import _bootstrap
+        return _bootstrap(self, dataset, n, random_state=random_state,
+                          workers=workers)
+
     # Not sure what more API to provide, some ideas:
 
     # def events_predictor(self, events):
@@ -16,10 +16,11 @@ class FakeLazyRecspan(object):
         return self._data[start:stop, :]
 
 def mock_dataset(num_channels=4, num_recspans=4, ticks_per_recspan=100,
-                 hz=250, lazy="mixed"):
+                 hz=250, lazy="mixed", dtype=np.float64):
     assert lazy in ["all", "mixed", "none"]
     data_format = DataFormat(hz, "uV",
-                             ["MOCK%s" % (i,) for i in xrange(num_channels)])
+                             ["MOCK%s" % (i,) for i in xrange(num_channels)],
+                             dtype=dtype)
     dataset = Dataset(data_format)
     r = np.random.RandomState(0)
     for i in xrange(num_recspans):
@@ -146,6 +147,36 @@ def test_Dataset_add_recspan():
     assert_raises(ValueError,
                   dataset.add_recspan, [[1, 2, 3], [4, 5, 6]], {})
 
+def test_Dataset_raw_storage():
+    # In-memory recspans are stored as plain arrays, raw_slice just slices
+    # them, and the DataFrames are only made on request.
+    dataset = mock_dataset(num_channels=2, num_recspans=2, lazy="none")
+    data = np.arange(10, dtype=float).reshape((5, 2))
+    dataset.add_recspan(data, {})
+    stored = dataset._recspans[2]
+    assert type(stored) is np.ndarray
+    assert stored.flags.c_contiguous
+    got = dataset.raw_slice(2, 1, 3)
+    assert type(got) is np.ndarray
+    assert np.may_share_memory(got, stored)
+    assert np.array_equal(got, data[1:3])
+    recspan = dataset[2]
+    assert isinstance(recspan, pandas.DataFrame)
+    assert np.all(recspan.index == [0.0, 4.0, 8.0, 12.0, 16.0])
+    assert np.array_equal(recspan, data)
+    # Transforms are deferred until the data is read; the stored data is
+    # untouched, and DataFrames we already handed out don't change
+    dataset.transform([[0, 1], [1, 0]])
+    assert dataset._recspans[2] is stored
+    assert np.array_equal(recspan, data)
+    assert np.array_equal(dataset.raw_slice(2, 0, 5), data[:, ::-1])
+    assert np.array_equal(dataset[2], data[:, ::-1])
+    # float32 data stays float32
+    dataset32 = mock_dataset(num_channels=2, num_recspans=1, lazy="none",
+                             dtype=np.float32)
+    assert dataset32._recspans[0].dtype == np.float32
+    assert dataset32.raw_slice(0, 0, 3).dtype == np.float32
+
 def test_Dataset_events():
     # Thorough tests are in test_events; here we just make sure the basic API
     # is functioning.
@@ -187,6 +218,10 @@ def test_transforms():
     for saved_data, data in zip(saved_datas, dataset):
         assert np.allclose(np.dot(saved_data, tr1.T), data)
 
+    # Transforms are saved up rather than applied to the stored data; all
+    # the recspans share one composed transform.
+    assert len(set(map(id, dataset._transforms))) == 1
+
     dataset_copy = Dataset(dataset.data_format)
     dataset_copy.add_dataset(dataset)
     assert len(saved_datas) == len(dataset_copy)
@@ -204,6 +239,98 @@ def test_transforms():
     tr_both = np.dot(tr2, tr1)
     for saved_data, data in zip(saved_datas, dataset):
         assert np.allclose(np.dot(saved_data, tr_both.T), data)
+    for i, saved_data in enumerate(saved_datas):
+        assert np.allclose(dataset.raw_slice(i, 10, 13),
+                           np.dot(saved_data[10:13], tr_both.T))
+
+    # A calibration-style scaling, followed by a re-reference, with float32
+    # storage
+    dataset32 = mock_dataset(num_channels=3, dtype=np.float32)
+    saved_datas = [np.array(data) for data in dataset32]
+    scale = np.diag([2.0, 0.5, 4.0])
+    dataset32.transform(scale)
+    for saved_data, data in zip(saved_datas, dataset32):
+        assert data.values.dtype == np.float32
+        assert np.allclose(np.asarray(data), saved_data * [2.0, 0.5, 4.0],
+                           atol=1e-5)
+    reref = np.eye(3)
+    reref[:, 2] -= 0.5
+    dataset32.transform(reref)
+    for saved_data, data in zip(saved_datas, dataset32):
+        assert np.allclose(np.asarray(data),
+                           np.dot(saved_data, np.dot(reref, scale).T),
+                           atol=1e-5)
+    # Undoing it goes back to the identity
+    dataset32.transform(np.linalg.inv(np.dot(reref, scale)))
+    assert dataset32._transforms == [None] * len(dataset32)
+
+def test_spill_to_disk():
+    import os
+    import shutil
+    import tempfile
+    import cPickle
+    from rerpy.data import MemmapRecspan
+    from rerpy.rerp import rERPRequest
+    directory = tempfile.mkdtemp()
+    try:
+        for dtype in [np.float64, np.float32]:
+            dataset = mock_dataset(num_channels=3, num_recspans=4,
+                                   ticks_per_recspan=200, dtype=dtype)
+            for tick in xrange(5, 190, 7):
+                dataset.add_event(tick % 4, tick, tick + 1, {"x": tick % 3})
+            saved_datas = [np.array(data) for data in dataset]
+            req = rERPRequest("has x", 0, 6, "x")
+            expected, = dataset.multi_rerp([req], verbose=False)
+            in_memory = [i for i in xrange(len(dataset))
+                         if dataset._recspans[i] is not None]
+            assert in_memory
+            dataset.spill_to_disk(os.path.join(directory, "sub"))
+            assert dataset._recspans == [None] * len(dataset)
+            for i, saved_data in enumerate(saved_datas):
+                assert np.array_equal(dataset[i], saved_data)
+                got = dataset.raw_slice(i, 10, 20)
+                assert got.dtype == dtype
+                assert np.array_equal(got, saved_data[10:20])
+            # Reads are views into the file, not copies
+            for i in in_memory:
+                recspan = dataset._lazy_recspans[i]
+                assert isinstance(recspan, MemmapRecspan)
+                assert os.path.dirname(recspan.path) == os.path.join(
+                    directory, "sub")
+                assert np.may_share_memory(dataset.raw_slice(i, 10, 20),
+                                           recspan._data)
+                assert_raises(IndexError, recspan.get_slice, 0, 201)
+                # and they survive pickling without dragging the data along
+                pickled = cPickle.dumps(recspan)
+                assert len(pickled) < 1000
+                assert np.array_equal(cPickle.loads(pickled).get_slice(0, 5),
+                                      saved_datas[i][:5])
+            got, = dataset.multi_rerp([req], verbose=False)
+            assert np.allclose(got.betas, expected.betas)
+            # Transforms still work, they're just applied as the data is read
+            tr = np.eye(3)
+            tr[0, 1] = 2
+            dataset.transform(tr)
+            for i, saved_data in enumerate(saved_datas):
+                assert np.allclose(dataset.raw_slice(i, 0, 200),
+                                   np.dot(saved_data, tr.T))
+            # Spilling again is a no-op
+            files = os.listdir(os.path.join(directory, "sub"))
+            dataset.spill_to_disk(os.path.join(directory, "sub"))
+            assert os.listdir(os.path.join(directory, "sub")) == files
+            shutil.rmtree(os.path.join(directory, "sub"))
+        # An existing file can be added directly
+        path = os.path.join(directory, "data.npy")
+        np.save(path, np.arange(12, dtype=float).reshape((4, 3)))
+        dataset = Dataset(DataFormat(250, "uV", ["A", "B", "C"]))
+        recspan = MemmapRecspan(path)
+        dataset.add_lazy_recspan(recspan, recspan.ticks, {})
+        assert np.array_equal(dataset.raw_slice(0, 1, 3), [[3, 4, 5],
+                                                           [6, 7, 8]])
+        np.save(path, np.arange(3))
+        assert_raises(ValueError, MemmapRecspan, path)
+    finally:
+        shutil.rmtree(directory)
 
 def test_Dataset_merge_df():
     def make_events():
@@ -233,6 +233,39 @@ def test_events_method():
     e2 = Events()
     assert_raises(ValueError, e.events_query, e2.events_query(True))
 
+def test_Query__spans_and_values():
+    e = Events()
+    e.add_recspan_info(0, 100, {})
+    e.add_recspan_info(1, 100, {})
+    e.add_event(1, 5, 6, {"a": 1, "b": "x", "c": True})
+    e.add_event(0, 20, 25, {"a": 2, "c": None})
+    e.add_event(0, 10, 11, {"a": 3, "b": "y", "c": False})
+    e.add_event(0, 30, 31, {"d": 1})
+
+    q = e.events_query("has a")
+    recspan_ids, start_ticks, stop_ticks, values = q._spans_and_values("b")
+    assert np.all(recspan_ids == [0, 0, 1])
+    assert np.all(start_ticks == [10, 20, 5])
+    assert np.all(stop_ticks == [11, 25, 6])
+    assert values == ["y", None, "x"]
+    _, _, _, values = q._spans_and_values("b", default="nope")
+    assert values == ["y", "nope", "x"]
+    # bools come back as bools, NULLs as None
+    _, _, _, values = q._spans_and_values("c")
+    assert values == [False, None, True]
+    assert type(values[0]) is bool
+    # works when the query itself joins against the same attribute table
+    _, start_ticks, _, values = e.events_query("b == 'x'")._spans_and_values("b")
+    assert np.all(start_ticks == [5])
+    assert values == ["x"]
+    # keys that have never been seen
+    _, _, _, values = q._spans_and_values("zzz", 0)
+    assert values == [0, 0, 0]
+    # no matches
+    recspan_ids, _, _, values = e.events_query(False)._spans_and_values("a")
+    assert recspan_ids.shape == (0,)
+    assert values == []
+
 def test_python_query():
     # all operators
     # types (esp. including None)
@@ -523,3 +556,27 @@ def test_add_events():
                   {"string_type": ["a", 1.0]})
     assert_raises(ValueError, e.add_events, [0], [-1], [10], {})
     assert_raises(ValueError, e.add_events, [0], [10], [10], {})
+
+def test_Events__version():
+    e = Events()
+    versions = [e._version]
+    def changed():
+        assert e._version > versions[-1]
+        versions.append(e._version)
+    e.add_recspan_info(0, 100, {})
+    changed()
+    ev = e.add_event(0, 10, 11, {"a": 1})
+    changed()
+    e.add_events([0], [20], [21], {"a": [2]})
+    changed()
+    ev["b"] = True
+    changed()
+    del ev["b"]
+    changed()
+    ev.move(5)
+    changed()
+    ev.delete()
+    changed()
+    # Queries don't count
+    list(e.events_query({"a": 2}))
+    assert e._version == versions[-1]
@@ -143,7 +143,12 @@ def test_multi_rerp():
                                        artifact_query="has maybe_artifact",
                                        regression_strategy=regression_strategy,
                                        overlap_correction=overlap_correction)
-            assert both_erp3.regression_strategy == "continuous"
+            # No overlap, so "auto" can fit the partially rejected epoch
+            # one latency at a time
+            if regression_strategy == "auto":
+                assert both_erp3.regression_strategy == "by-latency"
+            else:
+                assert both_erp3.regression_strategy == regression_strategy
             assert both_erp3.global_stats.epochs.requested == 5
             assert both_erp3.global_stats.epochs.fully_accepted == 4
             assert both_erp3.global_stats.epochs.partially_accepted == 1
@@ -189,7 +194,10 @@ def test_multi_rerp():
                                        artifact_query="has maybe_artifact",
                                        regression_strategy=regression_strategy,
                                        overlap_correction=overlap_correction)
-            assert both_erp5.regression_strategy == "continuous"
+            if regression_strategy == "auto":
+                assert both_erp5.regression_strategy == "by-latency"
+            else:
+                assert both_erp5.regression_strategy == regression_strategy
             # standard_epoch1 is knocked out by bad_event_query
             assert np.allclose(both_erp5.betas["type[standard]"],
                                standard_epoch0)
@@ -443,4 +451,1042 @@ def test_perfect_collinearity():
                       ds.rerp, "has x1", 0, 5, "0 + type",
                       bad_event_query="type == 'b'")
 
-# XX TODO: make continuous do some amount of batching
+def test_workers():
+    # Parallel continuous fits give the same answer as serial ones
+    ds = mock_dataset(num_channels=3, num_recspans=6, ticks_per_recspan=200,
+                      hz=1000)
+    r = np.random.RandomState(0)
+    for recspan_id in xrange(6):
+        for tick in xrange(5, 190, 7):
+            ds.add_event(recspan_id, tick, tick + 1,
+                         {"type": r.choice(["a", "b"]), "x": r.normal()})
+    ds.add_event(2, 50, 60, {"maybe_artifact": True})
+    req = rERPRequest("has type", -3, 10, "type + x")
+    serial, = ds.multi_rerp([req], artifact_query="has maybe_artifact",
+                            regression_strategy="continuous")
+    for workers in [1, 2, 3]:
+        parallel, = ds.multi_rerp([req], artifact_query="has maybe_artifact",
+                                  regression_strategy="continuous",
+                                  workers=workers)
+        assert np.allclose(serial.betas, parallel.betas)
+    assert np.allclose(serial.betas,
+                       ds.rerp("has type", -3, 10, "type + x",
+                               artifact_query="has maybe_artifact",
+                               regression_strategy="continuous",
+                               workers=2).betas)
+    assert_raises(ValueError, ds.multi_rerp, [req], workers=0)
+    # A worker that gets interrupted sends back None, which turns back into
+    # a KeyboardInterrupt here. (The worker processes are forked, so they
+    # see the patched function.)
+    import rerpy.rerp
+    old_accumulate = rerpy.rerp._accumulate_continuous
+    def interrupted(*args, **kwargs):
+        raise KeyboardInterrupt
+    try:
+        rerpy.rerp._accumulate_continuous = interrupted
+        assert_raises(KeyboardInterrupt, ds.multi_rerp, [req],
+                      regression_strategy="continuous", workers=2,
+                      verbose=False)
+    finally:
+        rerpy.rerp._accumulate_continuous = old_accumulate
+
+    # by-epoch fits use threads instead, one rerp each
+    reqs = [rERPRequest("type == 'a'", -3, 3, "x", all_or_nothing=True),
+            rERPRequest("type == 'b'", 0, 5, "x", all_or_nothing=True),
+            rERPRequest("has x", 0, 2, "type", all_or_nothing=True)]
+    kwargs = dict(artifact_query="has maybe_artifact",
+                  regression_strategy="by-epoch", overlap_correction=False)
+    serial = ds.multi_rerp(reqs, **kwargs)
+    for workers in [2, 3]:
+        threaded = ds.multi_rerp(reqs, workers=workers, **kwargs)
+        solver = ds.multi_rerp_solver(reqs, workers=workers, **kwargs)
+        for s, t, f in zip(serial, threaded, solver.fit(ds)):
+            assert np.allclose(s.betas, t.betas)
+            assert np.allclose(s.betas, f.betas)
+
+    # Including with lazily-loaded data read from disk by each worker
+    from rerpy.test import test_data_path
+    from rerpy.io.erpss import load_erpss
+    results = []
+    for lazy, workers in [(False, 1), (True, 1), (True, 2)]:
+        erpss_ds = load_erpss(test_data_path("erpss/tiny-complete.crw"),
+                              test_data_path("erpss/tiny-complete.log"),
+                              lazy=lazy)
+        erp = erpss_ds.rerp("has code", -20, 100, "1",
+                            regression_strategy="continuous",
+                            workers=workers)
+        results.append(np.asarray(erp.betas))
+    assert np.allclose(results[0], results[1])
+    assert np.allclose(results[0], results[2])
+    # by-epoch threads all read through the same lazy recspans at once
+    erpss_reqs = [rERPRequest("has code", -i, 20 + 5 * i, "1",
+                              all_or_nothing=True, name="r%s" % (i,))
+                  for i in xrange(6)]
+    erpss_kwargs = dict(regression_strategy="by-epoch",
+                        overlap_correction=False, verbose=False)
+    eager = load_erpss(test_data_path("erpss/tiny-complete.crw"),
+                       test_data_path("erpss/tiny-complete.log"),
+                       lazy=False).multi_rerp(erpss_reqs, **erpss_kwargs)
+    for i in xrange(5):
+        erpss_ds = load_erpss(test_data_path("erpss/tiny-complete.crw"),
+                              test_data_path("erpss/tiny-complete.log"),
+                              lazy=True)
+        threaded = erpss_ds.multi_rerp(erpss_reqs, workers=6, **erpss_kwargs)
+        for e, t in zip(eager, threaded):
+            assert np.allclose(np.asarray(e.betas), np.asarray(t.betas))
+
+def test_iterative():
+    ds = mock_dataset(num_channels=3, num_recspans=3, ticks_per_recspan=300,
+                      hz=1000)
+    r = np.random.RandomState(1)
+    for recspan_id in xrange(3):
+        for tick in xrange(5, 290, 6):
+            ds.add_event(recspan_id, tick, tick + 1,
+                         {"type": r.choice(["a", "b"]), "x": r.normal()})
+    ds.add_event(1, 100, 120, {"maybe_artifact": True})
+    reqs = [rERPRequest("type == 'a'", -3, 10, "x"),
+            rERPRequest("type == 'b'", 0, 12, "1")]
+    direct = ds.multi_rerp(reqs, artifact_query="has maybe_artifact",
+                           regression_strategy="continuous")
+    iterative = ds.multi_rerp(reqs, artifact_query="has maybe_artifact",
+                              regression_strategy="iterative",
+                              iterative_tolerance=1e-12)
+    for d, i in zip(direct, iterative):
+        assert d.iterations is None
+        assert d.residual_norm is None
+        assert i.regression_strategy == "iterative"
+        assert np.allclose(d.betas, i.betas)
+        assert 0 < i.iterations
+        assert np.all(i.residual_norm.index == ds.data_format.channel_names)
+    # Check the residual norm against the one we get the hard way
+    full = ds.rerp("has type", -3, 10, "type + x",
+                   regression_strategy="iterative",
+                   iterative_tolerance=1e-12)
+    predicted = np.zeros((3, 300, 3))
+    # Only data inside some epoch goes into the regression
+    in_epoch = np.zeros((3, 300), dtype=bool)
+    for ev in ds.events_query("has type"):
+        p = full.predict({"type": ev["type"], "x": ev["x"]})
+        start = ev.start_tick + full.start_tick
+        stop = ev.start_tick + full.stop_tick
+        predicted[ev.recspan_id, start:stop, :] += np.asarray(p)
+        in_epoch[ev.recspan_id, start:stop] = True
+    residuals = np.asarray([np.asarray(ds[i]) for i in xrange(3)]) - predicted
+    residuals[~in_epoch] = 0
+    expected = np.sqrt(np.sum(residuals ** 2, axis=(0, 1)))
+    assert np.allclose(full.residual_norm, expected)
+    # Loose tolerances stop sooner
+    loose = ds.rerp("has type", -3, 10, "type + x",
+                    regression_strategy="iterative",
+                    iterative_tolerance=1e-2)
+    assert loose.iterations < full.iterations
+    assert_raises(ValueError, ds.rerp, "has type", -3, 10, "type + x",
+                  regression_strategy="iterative",
+                  iterative_max_iterations=1)
+    assert_raises(ValueError, ds.rerp, "has type", -3, 10, "type + x",
+                  regression_strategy="iterative",
+                  iterative_tolerance=0)
+
+def test_multi_rerp_solver():
+    ds = mock_dataset(num_channels=3, num_recspans=3, ticks_per_recspan=200,
+                      hz=1000)
+    r = np.random.RandomState(2)
+    for recspan_id in xrange(3):
+        for tick in xrange(5, 190, 7):
+            ds.add_event(recspan_id, tick, tick + 1,
+                         {"type": r.choice(["a", "b"]), "x": r.normal()})
+    ds.add_event(1, 100, 120, {"maybe_artifact": True})
+    def check_same(expected, got):
+        assert len(expected) == len(got)
+        for e, g in zip(expected, got):
+            assert e.regression_strategy == g.regression_strategy
+            assert e.global_stats.ticks.accepted == g.global_stats.ticks.accepted
+            assert np.allclose(e.betas, g.betas)
+            assert np.all(g.betas.minor_axis == g.data_format.channel_names)
+
+    for (regression_strategy, overlap_correction) in [
+            ("continuous", True), ("iterative", True), ("by-epoch", False)]:
+        all_or_nothing = (regression_strategy == "by-epoch")
+        reqs = [rERPRequest("type == 'a'", -3, 10, "x",
+                            all_or_nothing=all_or_nothing),
+                rERPRequest("type == 'b'", 0, 12, "1",
+                            all_or_nothing=all_or_nothing)]
+        kwargs = dict(artifact_query="has maybe_artifact",
+                      regression_strategy=regression_strategy,
+                      overlap_correction=overlap_correction,
+                      iterative_tolerance=1e-12)
+        solver = ds.multi_rerp_solver(reqs, **kwargs)
+        assert solver.regression_strategy == regression_strategy
+        check_same(ds.multi_rerp(reqs, **kwargs), solver.fit(ds))
+        # Refitting after a re-reference gives the same answer as fitting
+        # from scratch
+        ds.transform([[1, -1, 0], [0, 1, 0], [0, -1, 1]])
+        check_same(ds.multi_rerp(reqs, **kwargs), solver.fit(ds))
+        # Fitting a different montage of the same data, with its own events
+        # object
+        montage = mock_dataset(num_channels=2, num_recspans=3,
+                               ticks_per_recspan=200, hz=1000)
+        montage._recspans = []
+        for i in xrange(3):
+            montage._recspans.append(
+                np.ascontiguousarray(np.asarray(ds[i])[:, :2]))
+        for ev in ds.events_query():
+            montage.add_event(ev.recspan_id, ev.start_tick, ev.stop_tick,
+                              dict(ev))
+        check_same(montage.multi_rerp(reqs, **kwargs), solver.fit(montage))
+        # But if the events have changed, then the design has too
+        montage.add_event(2, 30, 40, {"maybe_artifact": True})
+        assert_raises(ValueError, solver.fit, montage)
+        # Unless the change doesn't affect this analysis
+        list(ds.events_query({"type": "a"}))[0]["irrelevant"] = 1
+        check_same(ds.multi_rerp(reqs, **kwargs), solver.fit(ds))
+
+    assert ds.multi_rerp_solver([]).fit(ds) == []
+    assert_raises(ValueError, ds.multi_rerp_solver, reqs, workers=0)
+
+def test_memory_limit():
+    # Fitting within a memory budget gives the same answer, in less memory
+    ds = mock_dataset(num_channels=3, num_recspans=3, ticks_per_recspan=300,
+                      hz=1000)
+    r = np.random.RandomState(3)
+    for recspan_id in xrange(3):
+        for tick in xrange(5, 290, 6):
+            ds.add_event(recspan_id, tick, tick + 1,
+                         {"type": r.choice(["a", "b"]), "x": r.normal()})
+    req = rERPRequest("has type", -3, 10, "type + x")
+    for regression_strategy in ["continuous", "iterative"]:
+        kwargs = dict(regression_strategy=regression_strategy,
+                      iterative_tolerance=1e-12)
+        expected, = ds.multi_rerp([req], **kwargs)
+        limit = expected.peak_memory // 8
+        got, = ds.multi_rerp([req], memory_limit=limit, **kwargs)
+        assert np.allclose(expected.betas, got.betas)
+        assert got.peak_memory <= limit
+        solver = ds.multi_rerp_solver([req], memory_limit=limit, **kwargs)
+        refit, = solver.fit(ds)
+        assert np.allclose(expected.betas, refit.betas)
+        assert refit.peak_memory <= limit
+        assert_raises(ValueError, ds.multi_rerp, [req], memory_limit=100,
+                      **kwargs)
+    assert_raises(ValueError, ds.multi_rerp, [req], memory_limit=0)
+
+def test_float32():
+    # float32 data gives (nearly) the same answers as float64
+    datasets = [mock_dataset(num_channels=2, num_recspans=3,
+                             ticks_per_recspan=200, hz=1000, dtype=dtype)
+                for dtype in [np.float64, np.float32]]
+    r = np.random.RandomState(4)
+    for recspan_id in xrange(3):
+        for tick in xrange(5, 190, 7):
+            attrs = {"type": r.choice(["a", "b"]), "x": r.normal()}
+            for ds in datasets:
+                ds.add_event(recspan_id, tick, tick + 1, attrs)
+    ds64, ds32 = datasets
+    assert ds32.raw_slice(0, 0, 10).dtype == np.float32
+    assert ds32[1].values.dtype == np.float32
+    for regression_strategy in ["continuous", "iterative", "by-epoch"]:
+        kwargs = dict(regression_strategy=regression_strategy,
+                      overlap_correction=(regression_strategy != "by-epoch"),
+                      iterative_tolerance=1e-12)
+        expected = ds64.rerp("has type", -3, 10, "type + x", **kwargs)
+        got = ds32.rerp("has type", -3, 10, "type + x", **kwargs)
+        assert np.asarray(got.betas).dtype == np.float64
+        assert np.allclose(expected.betas, got.betas, atol=1e-5)
+    # Transforms keep the dtype
+    ds32.transform([[1, -1], [0, 1]])
+    assert ds32.raw_slice(0, 0, 10).dtype == np.float32
+    assert ds32.raw_slice(1, 0, 10).dtype == np.float32
+
+def test_permutation_test():
+    ds = mock_dataset(num_channels=2, num_recspans=3, ticks_per_recspan=300,
+                      hz=1000)
+    r = np.random.RandomState(5)
+    for recspan_id in xrange(3):
+        for tick in xrange(5, 280, 15):
+            ds.add_event(recspan_id, tick, tick + 1,
+                         {"type": r.choice(["a", "b"]), "x": r.normal()})
+    rerp = ds.rerp("has x", 0, 9, "x + type", regression_strategy="by-epoch",
+                   overlap_correction=False)
+    result = rerp.permutation_test(ds, 50, random_state=0)
+    assert result.n == 50
+    assert list(result.observed.items) == ["type[T.b]", "x"]
+    assert result.null_distribution.shape == (50, 2)
+    assert np.all(np.asarray(result.null_distribution) >= 0)
+    # The observed t values match the regular fit
+    X = np.asarray([[1, ev["type"] == "b", ev["x"]]
+                    for ev in ds.events_query("has x")], dtype=float)
+    Y = np.asarray([ds.raw_slice(ev.recspan_id, ev.start_tick,
+                                 ev.start_tick + 10).ravel()
+                    for ev in ds.events_query("has x")])
+    betas, rss = np.linalg.lstsq(X, Y, rcond=None)[:2]
+    assert np.allclose(betas.reshape((3, 10, 2)), rerp.betas)
+    XtX_inv = np.linalg.inv(np.dot(X.T, X))
+    stderr = np.sqrt(np.outer(np.diag(XtX_inv), rss / (X.shape[0] - 3)))
+    t = (betas / stderr).reshape((3, 10, 2))
+    assert np.allclose(result.observed["x"], t[2])
+    assert np.allclose(result.observed["type[T.b]"], t[1])
+    assert list(result.clusters.columns) == ["predictor", "channel",
+                                            "start_time", "stop_time",
+                                            "mass", "p_value"]
+    assert np.all(np.asarray(result.clusters["p_value"]) > 0)
+    assert np.all(np.asarray(result.clusters["p_value"]) <= 1)
+    # Same answers whatever the number of workers, and only permuting one
+    # term
+    threaded = rerp.permutation_test(ds, 50, random_state=0, workers=3)
+    assert np.allclose(result.null_distribution, threaded.null_distribution)
+    only_x = rerp.permutation_test(ds, 10, permute="x", stat="beta",
+                                   threshold=0.1, random_state=0)
+    assert list(only_x.observed.items) == ["x"]
+    assert np.allclose(only_x.observed["x"], rerp.betas["x"])
+    assert_raises(ValueError, rerp.permutation_test, ds, 10, stat="beta")
+    assert_raises(ValueError, rerp.permutation_test, ds, 10, permute="z")
+    assert_raises(ValueError, rerp.permutation_test, ds, 10, stat="F")
+
+    # Bootstrap
+    boot = rerp.bootstrap(ds, 20, random_state=0)
+    assert boot.shape == (20, 3, 10, 2)
+    assert np.allclose(boot, rerp.bootstrap(ds, 20, random_state=0,
+                                            workers=2))
+    # The bootstrap distribution is centered around the real betas
+    assert np.allclose(boot.mean(axis=0), rerp.betas, atol=0.5)
+    # Samples that happen to leave the design singular -- here, by missing
+    # the one event with a rare level of 'type' -- get NaN betas, instead
+    # of spoiling the whole bootstrap
+    rare = mock_dataset(num_channels=2, num_recspans=1,
+                        ticks_per_recspan=300, hz=1000)
+    for i, tick in enumerate(xrange(5, 280, 15)):
+        rare.add_event(0, tick, tick + 1,
+                       {"type": "c" if i == 0 else r.choice(["a", "b"])})
+    rare_rerp = rare.rerp("has type", 0, 9, "type",
+                          regression_strategy="by-epoch",
+                          overlap_correction=False)
+    boot = rare_rerp.bootstrap(rare, 50, random_state=0)
+    singular = np.any(np.isnan(boot), axis=(1, 2, 3))
+    assert np.any(singular) and not np.all(singular)
+    assert np.all(np.isnan(boot[singular]))
+    assert np.all(np.isfinite(boot[~singular]))
+    # The permutations and bootstrap samples stay within the fit's
+    # memory_limit=
+    limit = 10 ** 5
+    limited = ds.rerp("has x", 0, 9, "x + type",
+                      regression_strategy="by-epoch",
+                      overlap_correction=False, memory_limit=limit)
+    assert np.allclose(rerp.bootstrap(ds, 20, random_state=0),
+                       limited.bootstrap(ds, 20, random_state=0))
+    assert np.allclose(
+        result.null_distribution,
+        limited.permutation_test(ds, 50, random_state=0).null_distribution)
+    tiny = ds.rerp("has x", 0, 9, "x + type", regression_strategy="by-epoch",
+                   overlap_correction=False, memory_limit=limit)
+    tiny._memory_limit = 1000
+    assert_raises(ValueError, tiny.bootstrap, ds, 20)
+
+    # Continuous fits aren't supported
+    continuous = ds.rerp("has x", 0, 9, "x + type",
+                         regression_strategy="continuous")
+    assert_raises(ValueError, continuous.permutation_test, ds, 10)
+    assert_raises(ValueError, continuous.bootstrap, ds, 10)
+
+def test_penalty():
+    ds = mock_dataset(num_channels=2, num_recspans=3, ticks_per_recspan=300,
+                      hz=1000)
+    r = np.random.RandomState(6)
+    for recspan_id in xrange(3):
+        for tick in xrange(5, 280, 15):
+            ds.add_event(recspan_id, tick, tick + 1,
+                         {"type": r.choice(["a", "b"]), "x": r.normal()})
+    req = rERPRequest("has x", 0, 9, "x + type")
+    strategies = ["by-epoch", "continuous", "iterative"]
+    def fit(regression_strategy, **kwargs):
+        rerp, = ds.multi_rerp([req], regression_strategy=regression_strategy,
+                              iterative_tolerance=1e-12, **kwargs)
+        return rerp
+    # The epochs don't overlap, so all the strategies fit the same model,
+    # penalized or not.
+    X = np.asarray([[1, ev["type"] == "b", ev["x"]]
+                    for ev in ds.events_query("has x")], dtype=float)
+    Y = np.asarray([ds.raw_slice(ev.recspan_id, ev.start_tick,
+                                 ev.start_tick + 10)
+                    for ev in ds.events_query("has x")])
+    D = np.diff(np.eye(10), axis=0)
+    for penalty, smoothness_penalty in [(0, 0), (5, 0), (0, 3), (2, 7)]:
+        # For each channel, minimize
+        #   ||Y - X B||^2 + penalty ||B||^2 + smoothness ||B D'||^2
+        # where B is (predictors x latencies), by brute force.
+        big_X = np.kron(X, np.eye(10))
+        A = (np.dot(big_X.T, big_X) + penalty * np.eye(30)
+             + smoothness_penalty * np.kron(np.eye(3), np.dot(D.T, D)))
+        expected = np.empty((3, 10, 2))
+        for channel in xrange(2):
+            y = Y[:, :, channel].ravel()
+            expected[:, :, channel] = np.linalg.solve(
+                A, np.dot(big_X.T, y)).reshape((3, 10))
+        for regression_strategy in strategies:
+            rerp = fit(regression_strategy, penalty=penalty,
+                       smoothness_penalty=smoothness_penalty)
+            assert np.allclose(rerp.betas, expected)
+            assert rerp.penalty == penalty
+            assert rerp.smoothness_penalty == smoothness_penalty
+            assert rerp.penalty_path is None
+            solver = ds.multi_rerp_solver(
+                [req], regression_strategy=regression_strategy,
+                iterative_tolerance=1e-12, penalty=penalty,
+                smoothness_penalty=smoothness_penalty)
+            refit, = solver.fit(ds)
+            assert np.allclose(refit.betas, expected)
+            assert refit.penalty == penalty
+
+    # Penalty paths
+    penalties = [0, 1, 10, 1000]
+    for regression_strategy in ["by-epoch", "continuous"]:
+        path = fit(regression_strategy, penalty_path=penalties,
+                   smoothness_penalty=1)
+        assert list(path.penalty_path.index) == penalties
+        assert path.penalty == path.penalty_path.idxmin()
+        assert len(path.path_betas) == len(penalties)
+        for penalty, betas in zip(penalties, path.path_betas):
+            single = fit(regression_strategy, penalty=penalty,
+                         smoothness_penalty=1)
+            assert np.allclose(betas, single.betas)
+        assert np.allclose(path.betas,
+                           fit(regression_strategy, penalty=path.penalty,
+                               smoothness_penalty=1).betas)
+    # The two strategies compute the same GCV scores
+    assert np.allclose(fit("by-epoch", penalty_path=penalties).penalty_path,
+                       fit("continuous", penalty_path=penalties).penalty_path)
+
+    # An exactly collinear design can be fit with a penalty, and penalty
+    # paths skip penalties that are too small
+    collinear = rERPRequest("has x", 0, 9, "x + I(2 * x)")
+    for regression_strategy in ["by-epoch", "continuous"]:
+        kwargs = dict(regression_strategy=regression_strategy)
+        assert_raises(ValueError, ds.multi_rerp, [collinear], **kwargs)
+        rerp, = ds.multi_rerp([collinear], penalty=1, **kwargs)
+        # The penalty splits the effect between x and x2 in proportion
+        assert np.allclose(2 * rerp.betas["x"], rerp.betas["I(2 * x)"])
+        rerp, = ds.multi_rerp([collinear], penalty_path=[0, 1], **kwargs)
+        assert rerp.penalty == 1
+    # Nearly collinear designs are accepted or rejected the same way by
+    # both strategies
+    near = rERPRequest("has x", 0, 9, "x + I(x + 1e-4 * x ** 2)")
+    for regression_strategy in ["by-epoch", "continuous"]:
+        rerp, = ds.multi_rerp([near], penalty_path=[0, 1],
+                              regression_strategy=regression_strategy)
+        assert rerp.path_betas[0] is None
+        assert rerp.penalty == 1
+    # If no penalty can be scored (here, because there are exactly as many
+    # epochs as predictors), there's no best one to pick
+    tiny = mock_dataset(num_channels=2, ticks_per_recspan=100)
+    tiny.add_event(0, 10, 11, {"x": 1.0})
+    tiny.add_event(0, 50, 51, {"x": -2.0})
+    for regression_strategy in ["by-epoch", "continuous"]:
+        assert_raises(ValueError, tiny.multi_rerp,
+                      [rERPRequest("has x", 0, 9, "x")], penalty_path=[0],
+                      regression_strategy=regression_strategy)
+        assert rerp.path_betas[0] is None
+        assert rerp.penalty_path[0] == np.inf
+
+    # Penalized rERPs can't be permutation tested
+    rerp = fit("by-epoch", penalty=1)
+    assert_raises(ValueError, rerp.permutation_test, ds, 10)
+    # Bad options
+    assert_raises(ValueError, fit, "continuous", penalty=-1)
+    assert_raises(ValueError, fit, "continuous", smoothness_penalty=-1)
+    assert_raises(ValueError, fit, "continuous", penalty_path=[])
+    assert_raises(ValueError, fit, "continuous", penalty_path=[-1, 1])
+    assert_raises(ValueError, fit, "continuous", penalty=1,
+                  penalty_path=[1, 2])
+    assert_raises(ValueError, fit, "iterative", penalty_path=[1, 2])
+
+def test_multi_dataset_rerp():
+    from rerpy.rerp import multi_dataset_rerp
+    datasets = []
+    r = np.random.RandomState(7)
+    for i in xrange(3):
+        ds = mock_dataset(num_channels=2, num_recspans=2,
+                          ticks_per_recspan=200, hz=1000)
+        for recspan_id in xrange(2):
+            for tick in xrange(5, 190, 9):
+                ds.add_event(recspan_id, tick, tick + 1,
+                             {"type": r.choice(["a", "b"]),
+                              # Different means in different datasets
+                              "x": r.normal() + i})
+        datasets.append(ds)
+    reqs = [rERPRequest("has x", -2, 6, "type + x", name="plain"),
+            rERPRequest("type == 'a'", 0, 4, "center(x)", name="centered")]
+    # The two requests share events, so we can't use overlap correction
+    kwargs = dict(verbose=False, overlap_correction=False)
+    groups = multi_dataset_rerp(datasets, reqs, **kwargs)
+    assert [group.name for group in groups] == ["plain", "centered"]
+    plain, centered = groups
+    assert plain.num_datasets == 3
+    assert plain.betas.shape == (3, 3, 9, 2)
+    assert centered.betas.shape == (3, 2, 5, 2)
+    assert list(plain.grand_average.items) == ["Intercept", "type[T.b]", "x"]
+    assert np.allclose(plain.grand_average, plain.betas.mean(axis=0))
+    # Each dataset's design comes from its own events, so center(x) uses
+    # each dataset's own mean, just like fitting them one at a time
+    for i, ds in enumerate(datasets):
+        mean_x = np.mean([ev["x"] for ev in ds.events_query("type == 'a'")])
+        expected_plain, expected_centered = ds.multi_rerp(
+            [reqs[0],
+             rERPRequest("type == 'a'", 0, 4, "I(x - mean_x)")],
+            **kwargs)
+        assert np.allclose(plain.betas[i], expected_plain.betas)
+        assert np.allclose(centered.betas[i], expected_centered.betas)
+    # Worker processes give the same answer
+    for workers in [2, 5]:
+        parallel = multi_dataset_rerp(datasets, reqs, workers=workers,
+                                      **kwargs)
+        for group, parallel_group in zip(groups, parallel):
+            assert np.allclose(group.betas, parallel_group.betas)
+    # An interrupted worker interrupts the whole thing
+    import rerpy.rerp
+    old_multi_rerp_impl = rerpy.rerp.multi_rerp_impl
+    def interrupted(*args, **kwargs):
+        raise KeyboardInterrupt
+    try:
+        rerpy.rerp.multi_rerp_impl = interrupted
+        assert_raises(KeyboardInterrupt, multi_dataset_rerp, datasets, reqs,
+                      workers=2, **kwargs)
+    finally:
+        rerpy.rerp.multi_rerp_impl = old_multi_rerp_impl
+
+    assert multi_dataset_rerp(datasets, [], verbose=False) == []
+    assert_raises(ValueError, multi_dataset_rerp, [], reqs)
+    assert_raises(ValueError, multi_dataset_rerp,
+                  datasets + [mock_dataset(num_channels=3, hz=1000)], reqs)
+    assert_raises(ValueError, multi_dataset_rerp, datasets,
+                  [rERPRequest("has nothing", 0, 4, "1")])
+    # The datasets' designs have to have the same columns, so their betas
+    # can be stacked
+    only_a = mock_dataset(num_channels=2, num_recspans=1,
+                          ticks_per_recspan=200, hz=1000)
+    for tick in xrange(5, 190, 9):
+        only_a.add_event(0, tick, tick + 1, {"type": "a", "x": r.normal()})
+    assert_raises(ValueError, multi_dataset_rerp, datasets + [only_a], reqs,
+                  **kwargs)
+    # (which fixing the levels takes care of)
+    from rerpy.rerp import _compile_designs
+    fixed = rERPRequest("has x", -2, 6, "C(type, levels=['a', 'b']) + x")
+    all_builders = _compile_designs(datasets + [only_a], [fixed])
+    assert len(set([tuple(builder.design_info.column_names)
+                    for (builder,) in all_builders])) == 1
+
+def test_residuals():
+    ds = mock_dataset(num_channels=2, num_recspans=3, ticks_per_recspan=300,
+                      hz=1000)
+    r = np.random.RandomState(8)
+    for recspan_id in xrange(3):
+        for tick in xrange(5, 280, 15):
+            ds.add_event(recspan_id, tick, tick + 1,
+                         {"type": r.choice(["a", "b"]), "x": r.normal()})
+    req = rERPRequest("has x", 0, 9, "x + type")
+    X = np.asarray([[1, ev["type"] == "b", ev["x"]]
+                    for ev in ds.events_query("has x")], dtype=float)
+    Y = np.asarray([ds.raw_slice(ev.recspan_id, ev.start_tick,
+                                 ev.start_tick + 10)
+                    for ev in ds.events_query("has x")])
+    n = X.shape[0]
+    XtX_inv_diagonal = np.diag(np.linalg.inv(np.dot(X.T, X)))
+    betas = np.linalg.lstsq(X, Y.reshape((n, -1)), rcond=None)[0]
+    residuals = (Y.reshape((n, -1)) - np.dot(X, betas)).reshape((n, 10, 2))
+    # By-epoch fits get a separate variance for each latency and channel
+    by_epoch_variance = np.sum(residuals ** 2, axis=0) / (n - 3)
+    # Continuous fits (which here fit the same model, since there is no
+    # overlap) pool over latencies
+    continuous_variance = (np.sum(residuals ** 2, axis=(0, 1))
+                           / (n * 10 - 3 * 10))
+    def check(rerp, variance, expect_stderr=True):
+        assert rerp.residual_variance.shape == (10, 2)
+        assert np.allclose(rerp.residual_variance, variance)
+        if not expect_stderr:
+            assert rerp.stderr is None
+            assert rerp.tvalues is None
+            return
+        stderr = np.sqrt(XtX_inv_diagonal[:, np.newaxis, np.newaxis]
+                         * np.asarray(rerp.residual_variance)[np.newaxis])
+        assert np.allclose(rerp.stderr, stderr)
+        assert list(rerp.stderr.items) == list(rerp.betas.items)
+        assert np.allclose(rerp.tvalues,
+                           np.asarray(rerp.betas) / stderr)
+    for regression_strategy, variance in [("by-epoch", by_epoch_variance),
+                                          ("continuous",
+                                           continuous_variance),
+                                          ("iterative",
+                                           continuous_variance)]:
+        kwargs = dict(regression_strategy=regression_strategy,
+                      iterative_tolerance=1e-12)
+        expect_stderr = (regression_strategy != "iterative")
+        rerp, = ds.multi_rerp([req], **kwargs)
+        check(rerp, variance, expect_stderr)
+        refit, = ds.multi_rerp_solver([req], **kwargs).fit(ds)
+        check(refit, variance, expect_stderr)
+        # Penalized fits don't get any of these
+        penalized, = ds.multi_rerp([req], penalty=1, **kwargs)
+        assert penalized.residual_variance is None
+        assert penalized.stderr is None
+    # Streaming QR (when there isn't room for the whole design) gives the
+    # same answers
+    by_epoch, = ds.multi_rerp([req], regression_strategy="by-epoch")
+    streamed, = ds.multi_rerp([req], regression_strategy="by-epoch",
+                              memory_limit=by_epoch.peak_memory // 3)
+    check(streamed, by_epoch_variance)
+    # Continuous fits work out the standard errors inside their own
+    # memory_limit=, and rERPSolver only works them out once for all its
+    # fits.
+    import rerpy.rerp
+    calls = []
+    old_inverse_diagonal = rerpy.rerp._inverse_diagonal
+    def counting_inverse_diagonal(*args, **kwargs):
+        calls.append(None)
+        return old_inverse_diagonal(*args, **kwargs)
+    try:
+        rerpy.rerp._inverse_diagonal = counting_inverse_diagonal
+        continuous, = ds.multi_rerp([req], regression_strategy="continuous")
+        assert len(calls) == 1
+        tight, = ds.multi_rerp([req], regression_strategy="continuous",
+                               memory_limit=continuous.peak_memory)
+        assert tight.peak_memory <= continuous.peak_memory
+        solver = ds.multi_rerp_solver([req],
+                                      regression_strategy="continuous")
+        refits = [solver.fit(ds)[0] for i in xrange(2)]
+        assert len(calls) == 3
+    finally:
+        rerpy.rerp._inverse_diagonal = old_inverse_diagonal
+    for rerp in [continuous, tight] + refits:
+        check(rerp, continuous_variance)
+
+def test_updater():
+    def session(seed):
+        ds = mock_dataset(num_channels=2, num_recspans=2,
+                          ticks_per_recspan=200, hz=1000)
+        r = np.random.RandomState(seed)
+        for recspan_id in xrange(2):
+            for tick in xrange(5, 190, 6):
+                ds.add_event(recspan_id, tick, tick + 1,
+                             {"type": r.choice(["a", "b"]),
+                              "x": r.normal()})
+        return ds
+    ds = session(9)
+    reqs = [rERPRequest("has x", -2, 8, "type + x")]
+    updater = ds.multi_rerp_updater(reqs)
+    def check(rescanned):
+        got = updater.fit()
+        assert updater.rescanned == rescanned
+        expected = ds.multi_rerp(reqs, regression_strategy="continuous")
+        for got_rerp, expected_rerp in zip(got, expected):
+            assert got_rerp.regression_strategy == "continuous"
+            assert np.allclose(got_rerp.betas, expected_rerp.betas)
+            assert np.allclose(got_rerp.stderr, expected_rerp.stderr)
+            assert (got_rerp.global_stats.ticks.accepted
+                    == expected_rerp.global_stats.ticks.accepted)
+    check([0, 1])
+    # Nothing changed
+    check([])
+    # A new session
+    ds.add_dataset(session(10))
+    check([2, 3])
+    # New artifacts
+    ds.add_event(1, 50, 60, {"_ARTIFACT_TYPE": "blink"})
+    check([1])
+    # Removed events
+    list(ds.events_query({"_RECSPAN_ID": 2}))[0].delete()
+    check([2])
+    # Changed predictors
+    list(ds.events_query({"_RECSPAN_ID": 3}))[3]["x"] = 10
+    check([3])
+    # Changes that don't affect the design
+    list(ds.events_query({"_RECSPAN_ID": 0}))[0]["irrelevant"] = 1
+    check([])
+    # A new predictor column means starting over
+    list(ds.events_query({"_RECSPAN_ID": 3}))[5]["type"] = "c"
+    check([0, 1, 2, 3])
+    # And so does changing the data
+    ds.transform([[2, 0], [1, 1]])
+    check([0, 1, 2, 3])
+    # Many add/remove cycles don't let rounding error pile up in the sums:
+    # after _UPDATER_MAX_REMOVALS subtractions, it starts over
+    import rerpy.rerp
+    old_max_removals = rerpy.rerp._UPDATER_MAX_REMOVALS
+    try:
+        rerpy.rerp._UPDATER_MAX_REMOVALS = 5
+        # Each add or delete means subtracting recspan 1's old sums
+        removals = 0
+        for cycle in xrange(10):
+            blink = ds.add_event(1, 100, 110, {"_ARTIFACT_TYPE": "blink"})
+            for change in [None, blink.delete]:
+                if change is not None:
+                    change()
+                removals += 1
+                if removals > 5:
+                    check([0, 1, 2, 3])
+                    removals = 0
+                else:
+                    check([1])
+            got, = updater.fit()
+            expected, = ds.multi_rerp(reqs, regression_strategy="continuous")
+            assert np.allclose(got.residual_variance,
+                               expected.residual_variance)
+    finally:
+        rerpy.rerp._UPDATER_MAX_REMOVALS = old_max_removals
+
+    # Penalties work too
+    penalized = ds.multi_rerp_updater(reqs, penalty_path=[1, 10])
+    got, = penalized.fit()
+    expected, = ds.multi_rerp(reqs, penalty_path=[1, 10])
+    assert np.allclose(got.betas, expected.betas)
+    assert np.allclose(got.penalty_path, expected.penalty_path)
+
+    assert ds.multi_rerp_updater([]).fit() == []
+    assert_raises(ValueError, ds.multi_rerp_updater, reqs, workers=0)
+
+def test_checkpoint():
+    import os
+    import tempfile
+    import shutil
+    import rerpy.rerp
+    ds = mock_dataset(num_channels=2, num_recspans=4, ticks_per_recspan=200,
+                      hz=1000, lazy="all")
+    r = np.random.RandomState(10)
+    for recspan_id in xrange(4):
+        for tick in xrange(5, 190, 6):
+            ds.add_event(recspan_id, tick, tick + 1,
+                         {"type": r.choice(["a", "b"]), "x": r.normal()})
+    # Recspans that count how often they're read, and can be made to fail
+    class FlakyRecspan(object):
+        def __init__(self, recspan):
+            self.recspan = recspan
+            self.crash = False
+            self.reads = 0
+        def get_slice(self, start, stop):
+            self.reads += 1
+            if self.crash:
+                raise RuntimeError("pre-empted!")
+            return self.recspan.get_slice(start, stop)
+    recspans = [FlakyRecspan(recspan) for recspan in ds._lazy_recspans]
+    ds._lazy_recspans = recspans
+    kwargs = dict(regression_strategy="continuous")
+    expected = ds.rerp("has x", -2, 8, "type + x", **kwargs)
+    old_chunk_rows = rerpy.rerp._CHECKPOINT_CHUNK_ROWS
+    old_interval = rerpy.rerp._CHECKPOINT_INTERVAL
+    tmpdir = tempfile.mkdtemp()
+    try:
+        rerpy.rerp._CHECKPOINT_CHUNK_ROWS = 100
+        rerpy.rerp._CHECKPOINT_INTERVAL = 0
+        path = os.path.join(tmpdir, "checkpoint")
+        recspans[2].crash = True
+        assert_raises(RuntimeError, ds.rerp, "has x", -2, 8, "type + x",
+                      checkpoint_path=path, **kwargs)
+        assert os.path.exists(path)
+        recspans[2].crash = False
+        # The checkpoint can't be used for a different analysis
+        assert_raises(ValueError, ds.rerp, "has x", -2, 8, "x",
+                      checkpoint_path=path, **kwargs)
+        for recspan in recspans:
+            recspan.reads = 0
+        got = ds.rerp("has x", -2, 8, "type + x", checkpoint_path=path,
+                      **kwargs)
+        assert np.allclose(got.betas, expected.betas)
+        assert np.allclose(got.stderr, expected.stderr)
+        # The data that was done before the crash wasn't read again
+        assert recspans[0].reads == 0
+        assert recspans[2].reads > 0 and recspans[3].reads > 0
+        # And the checkpoint is cleaned up afterwards
+        assert os.listdir(tmpdir) == []
+        # Without any crashes, it's the same as not checkpointing
+        got = ds.rerp("has x", -2, 8, "type + x", checkpoint_path=path,
+                      **kwargs)
+        assert np.allclose(got.betas, expected.betas)
+        assert os.listdir(tmpdir) == []
+        # By-epoch fits ignore it
+        ds.rerp("has x", 0, 4, "type + x", regression_strategy="by-epoch",
+                overlap_correction=False, checkpoint_path=path)
+        assert os.listdir(tmpdir) == []
+    finally:
+        rerpy.rerp._CHECKPOINT_CHUNK_ROWS = old_chunk_rows
+        rerpy.rerp._CHECKPOINT_INTERVAL = old_interval
+        shutil.rmtree(tmpdir)
+
+def test_timings():
+    from rerpy.rerp import multi_dataset_rerp
+    ds = mock_dataset(num_channels=2, num_recspans=3, ticks_per_recspan=300,
+                      hz=1000, lazy="none")
+    r = np.random.RandomState(11)
+    for recspan_id in xrange(3):
+        for tick in xrange(5, 280, 15):
+            ds.add_event(recspan_id, tick, tick + 1,
+                         {"type": r.choice(["a", "b", "b"]),
+                          "x": r.choice([0, r.normal()])})
+    n = len(ds.events("has x"))
+    X = np.asarray([[1, ev["type"] == "b", ev["x"]]
+                    for ev in ds.events_query("has x")], dtype=float)
+    all_phases = ["epochs", "artifacts", "all_or_nothing", "subspans",
+                  "accounting", "fit", "reads"]
+    epoch_bytes = 10 * 2 * 8
+    for strategy in ["by-epoch", "continuous", "iterative"]:
+        seen = []
+        def callback(phase, wall, cpu):
+            assert wall >= 0 and cpu >= 0
+            seen.append(phase)
+        rerp = ds.rerp("has x", 0, 9, "x + type",
+                       regression_strategy=strategy,
+                       timing_callback=callback)
+        timings = rerp.timings
+        assert seen == all_phases
+        assert list(timings.phases.index) == all_phases
+        assert np.all(timings.phases.values >= 0)
+        assert timings.counters["subspans"] == n
+        assert timings.counters["in_memory_reads"] == (
+            timings.counters["read_calls"])
+        if strategy == "by-epoch":
+            assert timings.counters["design_width"] == 3
+            assert timings.counters["nonzeros"] == np.count_nonzero(X)
+        else:
+            assert timings.counters["design_width"] == 3 * 10
+            assert timings.counters["nonzeros"] == 10 * np.count_nonzero(X)
+        # Every strategy reads the data just once, and the epochs don't
+        # touch, so each needs its own read
+        assert timings.counters["read_calls"] == n
+        assert timings.counters["read_bytes"] == n * epoch_bytes
+    # Reads in worker processes are counted too
+    rerp = ds.rerp("has x", 0, 9, "x + type",
+                   regression_strategy="continuous", workers=2)
+    assert rerp.timings.counters["read_bytes"] == n * epoch_bytes
+    # Lazy data
+    lazy_ds = mock_dataset(num_channels=2, num_recspans=3,
+                           ticks_per_recspan=300, hz=1000, lazy="all")
+    for ev in ds.events_query("has x"):
+        lazy_ds.add_event(ev.recspan_id, ev.start_tick, ev.stop_tick,
+                          dict(ev))
+    rerp = lazy_ds.rerp("has x", 0, 9, "x + type")
+    assert rerp.timings.counters["read_calls"] == n
+    assert rerp.timings.counters["in_memory_reads"] == 0
+    # The rERPs fit together share their timings
+    rerps = ds.multi_rerp([rERPRequest("has x", 0, 9, "x", name="x"),
+                           rERPRequest("has x", 0, 9, "type", name="type")],
+                          overlap_correction=False)
+    assert rerps[0].timings is rerps[1].timings
+    # Solvers already found the epochs
+    solver = ds.multi_rerp_solver([rERPRequest("has x", 0, 9, "x + type")])
+    rerp, = solver.fit(ds)
+    assert list(rerp.timings.phases.index) == ["fit", "reads"]
+    assert rerp.timings.counters["read_bytes"] == n * epoch_bytes
+    # One set of timings per dataset
+    groups = multi_dataset_rerp([ds, ds],
+                                [rERPRequest("has x", 0, 9, "x + type")])
+    assert len(groups[0].timings) == 2
+    for timings in groups[0].timings:
+        assert timings.counters["read_bytes"] == n * epoch_bytes
+
+def test_latency_basis():
+    from rerpy.rerp import _bspline_basis
+    ds = mock_dataset(num_channels=2, num_recspans=3, ticks_per_recspan=400,
+                      hz=1000)
+    r = np.random.RandomState(12)
+    for recspan_id in xrange(3):
+        for tick in xrange(5, 370, 25):
+            ds.add_event(recspan_id, tick, tick + 1,
+                         {"type": r.choice(["a", "b"]), "x": r.normal()})
+    events = ds.events_query("has x")
+    n = len(ds.events("has x"))
+    ticks = 21
+    X = np.asarray([[1, ev["type"] == "b", ev["x"]] for ev in events],
+                   dtype=float)
+    Y = np.asarray([ds.raw_slice(ev.recspan_id, ev.start_tick,
+                                 ev.start_tick + ticks)
+                    for ev in events])
+    basis = _bspline_basis(ticks, 6, 3)
+    # Without overlap, fitting on the basis is the same as projecting the
+    # ordinary betas onto it
+    plain_betas = np.linalg.lstsq(X, Y.reshape((n, -1)),
+                                  rcond=None)[0].reshape((3, ticks, 2))
+    H = np.dot(basis, np.linalg.pinv(basis))
+    expected_betas = np.einsum("lm,pmc->plc", H, plain_betas)
+    residuals = Y - np.einsum("ep,plc->elc", X, expected_betas)
+    variance = np.sum(residuals ** 2, axis=(0, 1)) / (n * ticks - 3 * 6)
+    expected_stderr = np.sqrt(
+        np.diag(np.linalg.inv(np.dot(X.T, X)))[:, np.newaxis, np.newaxis]
+        * np.diag(H)[np.newaxis, :, np.newaxis]
+        * variance[np.newaxis, np.newaxis, :])
+    for kwargs in [dict(latency_basis=6), dict(latency_basis=basis)]:
+        rerp = ds.rerp("has x", 0, 20, "type + x", **kwargs)
+        # A basis rules out by-epoch fitting
+        assert rerp.regression_strategy == "continuous"
+        assert rerp.latency_basis.shape == (ticks, 6)
+        assert rerp.betas.shape == (3, ticks, 2)
+        assert np.allclose(rerp.betas, expected_betas)
+        assert np.allclose(rerp.residual_variance, variance[np.newaxis, :])
+        assert np.allclose(rerp.stderr, expected_stderr)
+        # The design is much narrower
+        assert rerp.timings.counters["design_width"] == 3 * 6
+    assert_raises(ValueError, ds.rerp, "has x", 0, 20, "type + x",
+                  latency_basis=6, regression_strategy="by-epoch")
+    # With overlap, every way of fitting still agrees
+    req = rERPRequest("has x", -10, 40, "type + x", latency_basis=8,
+                      latency_basis_degree=1)
+    expected = ds.multi_rerp([req])[0]
+    assert expected.betas.shape == (3, 51, 2)
+    # (The design here is so narrow that CG needs a few more iterations
+    # than the default limit, which is the number of columns.)
+    for kwargs in [dict(regression_strategy="iterative",
+                        iterative_max_iterations=100),
+                   dict(workers=2)]:
+        got = ds.multi_rerp([req], **kwargs)[0]
+        assert np.allclose(got.betas, expected.betas)
+    got = ds.multi_rerp_solver([req]).fit(ds)[0]
+    assert np.allclose(got.betas, expected.betas)
+    assert np.allclose(got.stderr, expected.stderr)
+    got = ds.multi_rerp_updater([req]).fit()[0]
+    assert np.allclose(got.betas, expected.betas)
+    # The waveforms are made out of the basis functions -- for tent
+    # functions, they're piecewise linear between the 8 knots
+    basis = _bspline_basis(51, 8, 1)
+    for waveform in expected.betas.values.transpose((0, 2, 1)).reshape(
+            (6, 51)):
+        coefs = np.linalg.lstsq(basis, waveform, rcond=None)[0]
+        assert np.allclose(np.dot(basis, coefs), waveform)
+    # e.g., the first two knots are at latencies 0 and 50 / 7
+    assert np.allclose(np.diff(expected.betas.values[:, :8, :], 2, axis=1),
+                       0)
+    # A basis with a tent at every tick is no basis at all
+    plain = ds.rerp("has x", -10, 40, "type + x")
+    got = ds.rerp("has x", -10, 40, "type + x", latency_basis=51,
+                  latency_basis_degree=1)
+    assert np.allclose(got.betas, plain.betas)
+    assert np.allclose(got.stderr, plain.stderr)
+    # Penalties apply to the basis coefficients
+    got = ds.rerp("has x", -10, 40, "type + x", latency_basis=51,
+                  latency_basis_degree=1, penalty=3, smoothness_penalty=5)
+    expected = ds.rerp("has x", -10, 40, "type + x", penalty=3,
+                       smoothness_penalty=5)
+    assert np.allclose(got.betas, expected.betas)
+    # Mixing rERPs with and without a basis
+    rerps = ds.multi_rerp([req, rERPRequest("has x", 0, 5, "x", name="x")])
+    assert rerps[0].betas.shape == (3, 51, 2)
+    assert rerps[1].betas.shape == (2, 6, 2)
+    assert rerps[1].stderr.shape == (2, 6, 2)
+
+def test_by_latency():
+    # Without overlap, partially rejected epochs can be fit one latency (or
+    # rather, one pattern of accepted epochs) at a time, and give the same
+    # answers as the continuous fit.
+    from rerpy.test_data import mock_dataset
+    ds = mock_dataset(num_channels=2, num_recspans=2, ticks_per_recspan=300,
+                      hz=1000)
+    r = np.random.RandomState(5)
+    for recspan_id in xrange(2):
+        for tick in xrange(5, 280, 13):
+            ds.add_event(recspan_id, tick, tick + 1,
+                         {"type": r.choice(["a", "b"]), "x": r.normal()})
+    # Artifacts that take out part of several epochs, including one that
+    # runs off the end of the first recspan
+    ds.add_event(0, 40, 47, {"maybe_artifact": True})
+    ds.add_event(0, 120, 122, {"maybe_artifact": True})
+    ds.add_event(1, 200, 209, {"maybe_artifact": True})
+    reqs = [rERPRequest("type == 'a'", -2, 10, "x"),
+            rERPRequest("type == 'b'", 0, 12, "1"),
+            rERPRequest("type == 'a'", 0, 30, "1", name="long")]
+    kwargs = dict(artifact_query="has maybe_artifact",
+                  overlap_correction=False, verbose=False)
+    expected = ds.multi_rerp(reqs, regression_strategy="continuous",
+                             **kwargs)
+    assert expected[0].global_stats.epochs.partially_accepted > 0
+    def check(got):
+        assert len(got) == len(expected)
+        for e, g in zip(expected, got):
+            assert g.regression_strategy == "by-latency"
+            assert np.allclose(g.betas, e.betas)
+            assert np.allclose(g.residual_variance, e.residual_variance)
+            assert np.allclose(g.stderr, e.stderr)
+            assert np.allclose(g.tvalues, e.tvalues)
+    # "auto" picks it
+    check(ds.multi_rerp(reqs, **kwargs))
+    by_latency = ds.multi_rerp(reqs, regression_strategy="by-latency",
+                               **kwargs)
+    check(by_latency)
+    check(ds.multi_rerp(reqs, regression_strategy="by-latency", workers=2,
+                        **kwargs))
+    # Streaming through the data a few epochs at a time
+    streamed = ds.multi_rerp(reqs, regression_strategy="by-latency",
+                             memory_limit=by_latency[0].peak_memory // 2,
+                             **kwargs)
+    check(streamed)
+    assert streamed[0].peak_memory <= by_latency[0].peak_memory // 2
+    solver = ds.multi_rerp_solver(reqs, regression_strategy="auto", **kwargs)
+    assert solver.regression_strategy == "by-latency"
+    check(solver.fit(ds))
+    timings = by_latency[0].timings
+    assert timings.counters["design_width"] == 2 + 1 + 1
+    # Penalties tie the latencies together, so "auto" falls back on
+    # continuous, and asking for by-latency is an error
+    assert ds.multi_rerp(reqs, penalty=1,
+                         **kwargs)[0].regression_strategy == "continuous"
+    assert_raises(ValueError, ds.multi_rerp, reqs, penalty=1,
+                  regression_strategy="by-latency", **kwargs)
+    # As does overlap
+    assert_raises(ValueError, ds.multi_rerp, reqs,
+                  regression_strategy="by-latency",
+                  artifact_query="has maybe_artifact")
+    # Too few epochs left at some latency
+    ds.add_event(0, 0, 300, {"maybe_artifact": True})
+    ds.add_event(1, 0, 150, {"maybe_artifact": True})
+    ds.add_event(1, 160, 300, {"maybe_artifact": True})
+    assert_raises(ValueError, ds.multi_rerp, reqs,
+                  regression_strategy="by-latency", **kwargs)
+
+    # Threaded fits reading lazily loaded data from disk
+    from rerpy.test import test_data_path
+    from rerpy.io.erpss import load_erpss
+    def erpss_dataset(lazy):
+        erpss_ds = load_erpss(test_data_path("erpss/tiny-complete.crw"),
+                              test_data_path("erpss/tiny-complete.log"),
+                              lazy=lazy)
+        erpss_ds.add_event(0, 30, 33, {"maybe_artifact": True})
+        erpss_ds.add_event(0, 340, 345, {"maybe_artifact": True})
+        erpss_ds.add_event(1, 260, 263, {"maybe_artifact": True})
+        return erpss_ds
+    erpss_reqs = [rERPRequest("has code", -i, 20 + 5 * i, "1",
+                              name="r%s" % (i,))
+                  for i in xrange(6)]
+    expected = erpss_dataset(False).multi_rerp(
+        erpss_reqs, regression_strategy="continuous", **kwargs)
+    assert expected[0].global_stats.epochs.partially_accepted > 0
+    for i in xrange(5):
+        check(erpss_dataset(True).multi_rerp(
+            erpss_reqs, regression_strategy="by-latency", workers=6,
+            **kwargs))
+
+def test_independent_blocks():
+    # Requests whose epochs never share any data have independent blocks in
+    # XtX, which are factored separately -- with the same results as
+    # factoring the whole thing.
+    import rerpy.rerp
+    ds = mock_dataset(num_channels=2, num_recspans=2, ticks_per_recspan=400,
+                      hz=1000)
+    r = np.random.RandomState(3)
+    # Overlapping epochs, but the "a" ones are all in recspan 0 and the "b"
+    # ones are all in recspan 1
+    for tick in xrange(5, 380, 4):
+        ds.add_event(0, tick, tick + 1, {"type": "a", "x": r.normal()})
+        ds.add_event(1, tick, tick + 1, {"type": "b", "x": r.normal()})
+    reqs = [rERPRequest("type == 'a'", 0, 10, "x"),
+            rERPRequest("type == 'b'", 0, 16, "x")]
+    def fits(**kwargs):
+        kwargs.setdefault("regression_strategy", "continuous")
+        yield ds.multi_rerp(reqs, **kwargs)
+        yield ds.multi_rerp_solver(reqs, **kwargs).fit(ds)
+    old_min_block_width = rerpy.rerp._MIN_BLOCK_WIDTH
+    for kwargs in [{}, {"workers": 2},
+                   {"penalty": 2, "smoothness_penalty": 1}]:
+        try:
+            rerpy.rerp._MIN_BLOCK_WIDTH = 10 ** 9
+            expected = list(fits(**kwargs))[0]
+            rerpy.rerp._MIN_BLOCK_WIDTH = 1
+            for got in fits(**kwargs):
+                for e, g in zip(expected, got):
+                    assert np.allclose(g.betas, e.betas)
+                    if "penalty" not in kwargs:
+                        assert np.allclose(g.stderr, e.stderr)
+        finally:
+            rerpy.rerp._MIN_BLOCK_WIDTH = old_min_block_width
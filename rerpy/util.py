@@ -6,6 +6,7 @@ import os.path
 import functools
 import types
 import sys
+import time
 
 import numpy as np
 
@@ -59,6 +60,10 @@ def test_memoized_method():
     assert t2.return_x() == 2
     assert t2.multiply_by_x(3) == 6
 
+# CPU time used by this process, in seconds. (On Windows, Python 2's
+# time.clock is actually wall-clock time, so there this is too.)
+process_time = getattr(time, "process_time", time.clock)
+
 def indent(string, chars, indent_first=True):
     lines = string.split("\n")
     indented = "\n".join([" " * chars + line for line in lines])